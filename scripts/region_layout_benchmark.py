@@ -0,0 +1,170 @@
+"""\
+Compare region search on the nested and the binned region doc layouts.
+
+Loads the same peaks into a nested and a binned index on one chrom, then times
+the same random overlap queries against each and checks they find the same files.
+
+Examples
+
+Synthetic peaks, 200 files of 20000 peaks:
+
+    %(prog)s --es localhost:9200 --files 200 --peaks 20000
+
+Real peak files, each treated as one file:
+
+    %(prog)s --es localhost:9200 --bed ENCFF002COS.bed.gz ENCFF296FFD.bed.gz
+"""
+import argparse
+import gzip
+import random
+import statistics
+import time
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
+
+from encoded.region_indexer import (
+    bed_regions,
+    bin_batches,
+    binned_index,
+    get_binned_mapping,
+    get_mapping,
+    index_settings,
+    region_batches,
+    region_bin_doc_id,
+    region_doc_id,
+    region_doc_uuid,
+)
+from encoded.region_search import (
+    get_binned_peak_query,
+    get_peak_query,
+)
+
+EPILOG = __doc__
+
+ASSEMBLY = 'hg19'
+CHROM_LENGTH = 249250621  # hg19 chr1
+
+
+def synthetic_files(count, peaks, seed):
+    rng = random.Random(seed)
+    for n in range(count):
+        regions = []
+        for _ in range(peaks):
+            start = rng.randint(1, CHROM_LENGTH - 2000)
+            regions.append(('chr1', start, start + rng.randint(150, 2000)))
+        yield ('bench-%d' % n, regions)
+
+
+def bed_files(paths):
+    for path in paths:
+        with gzip.open(path, 'rt') as fh:
+            regions = bed_regions(line.rstrip('\n') for line in fh)
+            regions = [region for region in regions if region[0] == 'chr1']
+        yield (path, regions)
+
+
+def actions(files, nested_index, binned, batch_size):
+    for (uuid, regions) in files:
+        for (chrom, part, positions) in region_batches(regions, batch_size):
+            yield {
+                '_index': nested_index, '_type': ASSEMBLY, '_id': region_doc_id(uuid, part),
+                '_source': {'uuid': uuid, 'positions': positions}
+            }
+        for (chrom, rbin, positions) in bin_batches(regions):
+            yield {
+                '_index': binned, '_type': ASSEMBLY, '_id': region_bin_doc_id(uuid, rbin),
+                '_source': {
+                    'uuid': uuid, 'bin': rbin,
+                    'positions': [{'gte': p['start'], 'lte': p['end']} for p in positions]
+                }
+            }
+
+
+def time_queries(es, index, queries, build):
+    took = []
+    wall = []
+    found = []
+    for (start, end) in queries:
+        before = time.time()
+        res = es.search(
+            index=index, doc_type=ASSEMBLY, body=build(start, end), size=99999, request_timeout=60
+        )
+        wall.append((time.time() - before) * 1000)
+        took.append(res['took'])
+        found.append(set(region_doc_uuid(hit['_id']) for hit in res['hits']['hits']))
+    return (took, wall, found)
+
+
+def report(name, took, wall):
+    took = sorted(took)
+    line = '{:8} es took ms: median {:7.1f} p95 {:7.1f} mean {:7.1f}   wall ms: median {:7.1f}'
+    print(line.format(
+        name, statistics.median(took), took[int(len(took) * 0.95)], statistics.mean(took),
+        statistics.median(wall)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark nested vs binned region docs", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--es', default='localhost:9200', help="Elasticsearch to load into")
+    parser.add_argument(
+        '--bed', nargs='*', help="gzipped bed files to load instead of synthetic peaks"
+    )
+    parser.add_argument('--files', type=int, default=100, help="Synthetic files")
+    parser.add_argument('--peaks', type=int, default=20000, help="Synthetic peaks per file")
+    parser.add_argument('--batch-size', type=int, default=50000, help="Peaks per nested doc")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per layout")
+    parser.add_argument('--width', type=int, default=1000, help="Largest query width")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="Keep the benchmark indices")
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es], timeout=600)
+    nested_index = 'benchmark_chr1'
+    binned = binned_index(nested_index)
+    layouts = [(nested_index, get_mapping(ASSEMBLY)), (binned, get_binned_mapping(ASSEMBLY))]
+    for (index, mapping) in layouts:
+        es.indices.delete(index=index, ignore=404)
+        es.indices.create(index=index, body=index_settings())
+        es.indices.put_mapping(index=index, doc_type=ASSEMBLY, body=mapping)
+
+    files = bed_files(args.bed) if args.bed else synthetic_files(args.files, args.peaks, args.seed)
+    before = time.time()
+    bulk(es, actions(files, nested_index, binned, args.batch_size), chunk_size=500,
+         max_chunk_bytes=100 * 1024 * 1024, request_timeout=600)
+    es.indices.refresh(index=','.join([nested_index, binned]))
+    print('loaded in %.1fs' % (time.time() - before))
+    for index in (nested_index, binned):
+        stats = es.indices.stats(index=index)['indices'][index]['primaries']
+        print('{:20} docs {:10} store {:8.1f} MB'.format(
+            index, stats['docs']['count'], stats['store']['size_in_bytes'] / 1024.0 / 1024.0))
+
+    rng = random.Random(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        start = rng.randint(1, CHROM_LENGTH - args.width)
+        queries.append((start, start + rng.randint(0, args.width)))
+
+    # One pass of each first, so neither layout pays for a cold cache alone
+    time_queries(es, nested_index, queries[:10], get_peak_query)
+    time_queries(es, binned, queries[:10], get_binned_peak_query)
+    (nested_took, nested_wall, nested_found) = time_queries(
+        es, nested_index, queries, get_peak_query
+    )
+    (binned_took, binned_wall, binned_found) = time_queries(
+        es, binned, queries, get_binned_peak_query
+    )
+    report('nested', nested_took, nested_wall)
+    report('binned', binned_took, binned_wall)
+    mismatched = sum(1 for (nested, bins) in zip(nested_found, binned_found) if nested != bins)
+    print('queries finding different files: %d of %d' % (mismatched, len(queries)))
+
+    if not args.keep:
+        es.indices.delete(index=','.join([nested_index, binned]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""\
+Compare vis_cache storage of plain and compressed vis_datasets.
+
+Reads vis_datasets from an existing vis_cache, reports how big and how slow to
+encode and decode they are at each zlib level, then loads them into a plain and
+a compressed index and times the same random mgets against each.
+
+Examples
+
+The first 2000 vis_datasets of a local vis_cache:
+
+    %(prog)s --es localhost:9200 --count 2000
+
+Hub sized mgets of 500 vis_datasets:
+
+    %(prog)s --es localhost:9200 --count 5000 --batch 500
+"""
+import argparse
+import base64
+import json
+import random
+import statistics
+import time
+import zlib
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import (
+    bulk,
+    scan,
+)
+
+from encoded.vis_defines import (
+    VIS_CACHE_INDEX,
+    decode_vis_dataset,
+    encode_vis_dataset,
+)
+
+EPILOG = __doc__
+
+DOC_TYPE = 'default'
+
+
+def read_vis_datasets(es, index, count):
+    vis_datasets = {}
+    for hit in scan(es, index=index, doc_type=DOC_TYPE, query={'query': {'match_all': {}}}):
+        vis_dataset = decode_vis_dataset(hit['_source'])
+        if vis_dataset:
+            vis_datasets[hit['_id']] = vis_dataset
+            if len(vis_datasets) >= count:
+                break
+    return vis_datasets
+
+
+def compare_levels(vis_datasets):
+    texts = [json.dumps(vis_dataset) for vis_dataset in vis_datasets.values()]
+    plain = sum(len(text) for text in texts)
+    print('{:8} bytes {:12} ratio {:5.2f}'.format('plain', plain, 1.0))
+    for level in (1, 6, 9):
+        before = time.time()
+        packed = [base64.b64encode(zlib.compress(text.encode('utf-8'), level)) for text in texts]
+        encode_ms = (time.time() - before) * 1000
+        before = time.time()
+        for data in packed:
+            json.loads(zlib.decompress(base64.b64decode(data)).decode('utf-8'))
+        decode_ms = (time.time() - before) * 1000
+        size = sum(len(data) for data in packed)
+        print('{:8} bytes {:12} ratio {:5.2f}   encode ms/doc {:6.3f} decode ms/doc {:6.3f}'.format(
+            'zlib %d' % level, size, plain / size, encode_ms / len(texts), decode_ms / len(texts)))
+
+
+def time_mgets(es, index, batches):
+    wall = []
+    for ids in batches:
+        before = time.time()
+        res = es.mget(index=index, doc_type=DOC_TYPE, body={'ids': ids})
+        for doc in res['docs']:
+            decode_vis_dataset(doc['_source'])
+        wall.append((time.time() - before) * 1000)
+    return wall
+
+
+def report(name, wall):
+    wall = sorted(wall)
+    print('{:12} mget + decode ms: median {:7.1f} p95 {:7.1f} mean {:7.1f}'.format(
+        name, statistics.median(wall), wall[int(len(wall) * 0.95)], statistics.mean(wall)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark plain vs compressed vis_cache storage", epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--es', default='localhost:9200', help="Elasticsearch with a vis_cache")
+    parser.add_argument('--index', default=VIS_CACHE_INDEX, help="vis_cache index to read from")
+    parser.add_argument('--count', type=int, default=2000, help="vis_datasets to read")
+    parser.add_argument('--batch', type=int, default=100, help="vis_datasets per mget")
+    parser.add_argument('--queries', type=int, default=100, help="mgets per index")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="Keep the benchmark indices")
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es], timeout=600)
+    vis_datasets = read_vis_datasets(es, args.index, args.count)
+    if not vis_datasets:
+        print('no vis_datasets in %s' % args.index)
+        return
+    print('read %d vis_datasets' % len(vis_datasets))
+    compare_levels(vis_datasets)
+
+    plain_index = 'benchmark_vis_cache_plain'
+    compressed_index = 'benchmark_vis_cache_zlib'
+    for (index, compress) in [(plain_index, False), (compressed_index, True)]:
+        es.indices.delete(index=index, ignore=404)
+        es.indices.create(index=index, body={'index': {'number_of_shards': 1}})
+        es.indices.put_mapping(index=index, doc_type=DOC_TYPE, body={DOC_TYPE: {'enabled': False}})
+        bulk(es, (
+            {
+                '_index': index,
+                '_type': DOC_TYPE,
+                '_id': vis_id,
+                '_source': encode_vis_dataset(vis_dataset, compress)
+            }
+            for (vis_id, vis_dataset) in vis_datasets.items()
+        ), chunk_size=500, request_timeout=600)
+    es.indices.refresh(index=','.join([plain_index, compressed_index]))
+    es.indices.forcemerge(index=','.join([plain_index, compressed_index]), max_num_segments=1)
+    for index in (plain_index, compressed_index):
+        stats = es.indices.stats(index=index)['indices'][index]['primaries']
+        print('{:28} docs {:8} store {:8.1f} MB'.format(
+            index, stats['docs']['count'], stats['store']['size_in_bytes'] / 1024.0 / 1024.0))
+
+    rng = random.Random(args.seed)
+    vis_ids = list(vis_datasets)
+    batches = [rng.sample(vis_ids, min(args.batch, len(vis_ids))) for _ in range(args.queries)]
+    # One pass of each first, so neither index pays for a cold cache alone
+    time_mgets(es, plain_index, batches[:10])
+    time_mgets(es, compressed_index, batches[:10])
+    report('plain', time_mgets(es, plain_index, batches))
+    report('zlib', time_mgets(es, compressed_index, batches))
+
+    if not args.keep:
+        es.indices.delete(index=','.join([plain_index, compressed_index]))
+
+
+if __name__ == '__main__':
+    main()
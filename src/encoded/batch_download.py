@@ -12,6 +12,7 @@ from urllib.parse import (
     quote,
 )
 from encoded.search_views import search_generator
+from .region_indexer import region_doc_uuid
 from .vis_defines import is_file_visualizable
 import csv
 import io
@@ -62,54 +63,133 @@ def get_peak_metadata_links(request):
     return [peak_metadata_tsv_link, peak_metadata_json_link]
 
 
+PEAK_METADATA_HEADER = [
+    'assay_term_name',
+    'coordinates',
+    'target.label',
+    'biosample.accession',
+    'file.accession',
+    'experiment.accession'
+]
+PEAK_METADATA_ROWS_PER_CHUNK = 1000  # rows per chunk of a streamed peak metadata response
+
+
+def get_peak_metadata_files(request, results):
+    """
+    Returns {file uuid: (file, experiment)} for every file of the experiments in region search
+    results. Experiments come embedded with their files, so files are only embedded when that copy
+    lacks an accession.
+    """
+    files = {}
+    for experiment in results['@graph']:
+        for file_json in experiment.get('files', []):
+            if 'accession' not in file_json:
+                file_json = request.embed(file_json['uuid'])
+            files[file_json['uuid']] = (file_json, experiment)
+    return files
+
+
+def get_peak_metadata_columns(file_json, experiment_json):
+    """
+    Returns the per-file columns of peak metadata, so they are worked out once per file, not per
+    peak.
+    """
+    return {
+        'assay_term_name': experiment_json['assay_term_name'],
+        # not all experiments have targets
+        'target.label': experiment_json.get('target', {}).get('label'),
+        'biosample.accession': get_biosample_accessions(file_json, experiment_json),
+        'file.accession': file_json['accession'],
+        'experiment.accession': experiment_json['accession'],
+    }
+
+
+def get_peak_metadata_rows(peaks, columns_by_file):
+    """Yields (coordinates, per-file columns) for every peak position of region search peak hits."""
+    for row in peaks:
+        columns = columns_by_file.get(region_doc_uuid(row['_id']))
+        if columns is None:
+            continue
+        for hit in row['inner_hits']['positions']['hits']['hits']:
+            coordinates = '{}:{}-{}'.format(
+                row['_index'], hit['_source']['start'], hit['_source']['end']
+            )
+            yield (coordinates, columns)
+
+
+def peak_metadata_tsv(rows):
+    fout = io.StringIO()
+    writer = csv.writer(fout, delimiter='\t')
+    writer.writerow(PEAK_METADATA_HEADER)
+    for n, (coordinates, columns) in enumerate(rows, 1):
+        writer.writerow([
+            columns['assay_term_name'],
+            coordinates,
+            columns['target.label'],
+            columns['biosample.accession'],
+            columns['file.accession'],
+            columns['experiment.accession'],
+        ])
+        if n % PEAK_METADATA_ROWS_PER_CHUNK == 0:
+            yield fout.getvalue().encode('utf-8')
+            fout.seek(0)
+            fout.truncate()
+    yield fout.getvalue().encode('utf-8')
+
+
+def peak_metadata_json(peaks, columns_by_file):
+    """Streams {assay_term_name: [peak, ...]}, one assay after another."""
+    peaks_by_assay = OrderedDict()
+    for row in peaks:
+        columns = columns_by_file.get(region_doc_uuid(row['_id']))
+        if columns is not None:
+            peaks_by_assay.setdefault(columns['assay_term_name'], []).append(row)
+    yield b'{'
+    for i, (assay_name, assay_peaks) in enumerate(peaks_by_assay.items()):
+        yield '{}{}: ['.format(', ' if i else '', json.dumps(assay_name)).encode('utf-8')
+        records = []
+        rows = get_peak_metadata_rows(assay_peaks, columns_by_file)
+        for n, (coordinates, columns) in enumerate(rows):
+            records.append(json.dumps({
+                'coordinates': coordinates,
+                'target.name': columns['target.label'],
+                'biosample.accession': list(columns['biosample.accession'].split(', ')),
+                'file.accession': columns['file.accession'],
+                'experiment.accession': columns['experiment.accession']
+            }))
+            if len(records) == PEAK_METADATA_ROWS_PER_CHUNK:
+                yield ((', ' if n >= len(records) else '') + ', '.join(records)).encode('utf-8')
+                records = []
+        if records:
+            yield ((', ' if n >= len(records) else '') + ', '.join(records)).encode('utf-8')
+        yield b']'
+    yield b'}'
+
+
 @view_config(route_name='peak_metadata', request_method='GET')
 def peak_metadata(context, request):
     param_list = parse_qs(request.matchdict['search_params'])
     param_list['field'] = []
-    header = ['assay_term_name', 'coordinates', 'target.label', 'biosample.accession', 'file.accession', 'experiment.accession']
     param_list['limit'] = ['all']
     path = '/region-search/?{}&{}'.format(quote(urlencode(param_list, True)),'referrer=peak_metadata')
     results = request.embed(path, as_user=True)
-    uuids_in_results = get_file_uuids(results)
-    rows = []
-    json_doc = {}
-    for row in results['peaks']:
-        if row['_id'] in uuids_in_results:
-            file_json = request.embed(row['_id'])
-            experiment_json = request.embed(file_json['dataset'])
-            for hit in row['inner_hits']['positions']['hits']['hits']:
-                data_row = []
-                coordinates = '{}:{}-{}'.format(row['_index'], hit['_source']['start'], hit['_source']['end'])
-                file_accession = file_json['accession']
-                experiment_accession = experiment_json['accession']
-                assay_name = experiment_json['assay_term_name']
-                target_name = experiment_json.get('target', {}).get('label') # not all experiments have targets
-                biosample_accession = get_biosample_accessions(file_json, experiment_json)
-                data_row.extend([assay_name, coordinates, target_name, biosample_accession, file_accession, experiment_accession])
-                rows.append(data_row)
-                if assay_name not in json_doc:
-                    json_doc[assay_name] = []
-                else:
-                    json_doc[assay_name].append({
-                        'coordinates': coordinates,
-                        'target.name': target_name,
-                        'biosample.accession': list(biosample_accession.split(', ')),
-                        'file.accession': file_accession,
-                        'experiment.accession': experiment_accession
-                    })
+    uuids_in_results = set(get_file_uuids(results))
+    # Files and experiments are looked up once per export, however many peaks they have
+    columns_by_file = {}
+    files = get_peak_metadata_files(request, results)
+    for file_uuid, (file_json, experiment_json) in files.items():
+        if file_uuid in uuids_in_results:
+            columns_by_file[file_uuid] = get_peak_metadata_columns(file_json, experiment_json)
+    peaks = results.get('peaks', [])
     if 'peak_metadata.json' in request.url:
         return Response(
             content_type='text/plain',
-            body=json.dumps(json_doc),
+            app_iter=peak_metadata_json(peaks, columns_by_file),
             content_disposition='attachment;filename="%s"' % 'peak_metadata.json'
         )
-    fout = io.StringIO()
-    writer = csv.writer(fout, delimiter='\t')
-    writer.writerow(header)
-    writer.writerows(rows)
     return Response(
         content_type='text/tsv',
-        body=fout.getvalue(),
+        app_iter=peak_metadata_tsv(get_peak_metadata_rows(peaks, columns_by_file)),
         content_disposition='attachment;filename="%s"' % 'peak_metadata.tsv'
     )
 
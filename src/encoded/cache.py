@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class LRUCache(object):
+    '''
+    Thread safe least recently used cache whose entries expire ttl seconds after being set
+    '''
+
+    def __init__(self, size, ttl):
+        self.entries = OrderedDict()  # key: (expires, value), least recently used first
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
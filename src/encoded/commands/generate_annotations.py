@@ -72,6 +72,12 @@ def all_annotations(url):
                             annotation['end'] = location['end']
                             doc['annotations'].append(annotation)
 
+                    # Lets suggest ask only for the species and assembly being searched
+                    doc['suggest']['contexts'] = {
+                        'species': [species_for_payload],
+                        'assembly': sorted(set(a['assembly_name'] for a in doc['annotations']))
+                    }
+
                     annotations.append({
                         'index': {
                             '_index': 'annotations',
@@ -42,6 +42,16 @@ def run(app):
         'properties': {
             'suggest': {
                 'type': 'completion',
+                'contexts': [
+                    {
+                        'name': 'species',
+                        'type': 'category'
+                    },
+                    {
+                        'name': 'assembly',
+                        'type': 'category'
+                    }
+                ]
             }
         }
     }
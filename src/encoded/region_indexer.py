@@ -1,6 +1,5 @@
 import urllib3
-import io
-import gzip
+import zlib
 import csv
 import logging
 import collections
@@ -8,12 +7,27 @@ import certifi
 import json
 import requests
 import os
+import datetime
+import hashlib
+import tempfile
+import threading
+import humanfriendly
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
 from pyramid.view import view_config
+from pyramid.settings import asbool
 from sqlalchemy.sql import text
 from elasticsearch.exceptions import (
-    NotFoundError
+    NotFoundError,
+    RequestError,
+)
+from elasticsearch.helpers import (
+    bulk,
+    scan,
 )
-from elasticsearch.helpers import scan
 from snovault import DBSESSION, COLLECTIONS
 #from snovault.storage import (
 #    TransactionRecord,
@@ -32,6 +46,7 @@ from snovault.elasticsearch.interfaces import (
     SNP_SEARCH_ES,
     INDEXER,
 )
+from .region_intervals import IntervalIndex
 
 log = logging.getLogger(__name__)
 
@@ -53,6 +68,32 @@ SUPPORTED_ASSEMBLIES = ['hg19', 'mm10', 'mm9', 'GRCh38']
 ENCODED_ALLOWED_FILE_FORMATS = ['bed']
 ENCODED_ALLOWED_STATUSES = ['released']
 RESIDENT_REGIONSET_KEY = 'resident_regionsets'  # in regions_es, keeps track of what datsets are resident in one place
+RESIDENT_MAPPING = {'default': {"enabled": False}}
+
+# Bulk ingestion defaults, overridden by regionindexer.bulk_* settings
+BULK_CHUNK_SIZE = 500                     # documents per bulk request
+BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024  # per-chromosome docs of big peak files can be large
+
+# Streaming ingestion: peaks per region document and bytes per read from the download
+REGION_BATCH_SIZE = 50000
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Region doc layouts: 'nested' docs of up to REGION_BATCH_SIZE peaks per chrom, or 'binned' docs of
+# the peaks in one UCSC bin kept as integer_range fields in separate '<chrom>_bins' indices, so
+# lookups need no nested query
+NESTED_LAYOUT = 'nested'
+BINNED_LAYOUT = 'binned'
+BINNED_INDEX_SUFFIX = '_bins'
+
+# UCSC hierarchical binning: 128kb bins up to 512Mb bins, each level 8 times bigger than the last
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX_END = 1 << 29
+
+# Local cache of downloaded peak files, keyed on md5sum.
+# Disabled unless regionindexer.file_cache_dir is set.
+FILE_CACHE_SIZE = '20GB'
 
 ENCODED_REGION_REQUIREMENTS = {
     'ChIP-seq': {
@@ -69,6 +110,16 @@ ENCODED_REGION_REQUIREMENTS = {
     }
 }
 
+# Bump whenever region docs or peak parsing change, so that incremental cycles re-ingest every file
+REGIONS_VERSION = 1
+# Part of each resident file's fingerprint: changes when what or how files are indexed changes
+REQUIREMENTS_VERSION = hashlib.md5(json.dumps([
+    REGIONS_VERSION,
+    ENCODED_REGION_REQUIREMENTS,
+    ENCODED_ALLOWED_FILE_FORMATS,
+    ENCODED_ALLOWED_STATUSES,
+], sort_keys=True).encode('utf-8')).hexdigest()
+
 # On local instance, these are the only files that can be downloaded and regionalizable.  Currently only one is!
 TESTABLE_FILES = ['ENCFF002COS']  # '/static/test/peak_indexer/ENCFF002COS.bed.gz']
                                   # '/static/test/peak_indexer/ENCFF296FFD.tsv',     # tsv's some day?
@@ -89,6 +140,230 @@ def tsvreader(file):
     for row in reader:
         yield row
 
+
+def gunzip_lines(chunks):
+    '''Incrementally gunzips an iterable of byte chunks, yielding decoded lines.'''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        while decompressor.unused_data:  # concatenated gzip members (e.g. bgzip)
+            unused = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(unused)
+        pending += data
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    pending += decompressor.flush()
+    for line in pending.split(b'\n'):
+        if line:
+            yield line.decode('utf-8')
+
+
+def bed_regions(lines):
+    '''Yields (chrom, start, end) for each peak in bed lines.  Coordinates are made 1-based.'''
+    for row in tsvreader(lines):
+        if len(row) < 3 or row[0].startswith(('#', 'track', 'browser')):
+            continue
+        yield (row[0].lower(), int(row[1]) + 1, int(row[2]) + 1)
+
+
+def region_batches(regions, batch_size=REGION_BATCH_SIZE):
+    '''Groups (chrom, start, end) regions into per-chrom batches of positions.
+       Yields (chrom, part, positions) as soon as a batch fills, then the remainder of each
+       chrom.'''
+    batches = {}
+    parts = {}
+    for (chrom, start, end) in regions:
+        batch = batches.setdefault(chrom, [])
+        batch.append({'start': start, 'end': end})
+        if len(batch) >= batch_size:
+            part = parts.get(chrom, 0)
+            yield (chrom, part, batch)
+            parts[chrom] = part + 1
+            batches[chrom] = []
+    for chrom, batch in batches.items():
+        if batch:
+            yield (chrom, parts.get(chrom, 0), batch)
+
+
+def region_bin(start, end):
+    '''Returns the UCSC bin of the smallest bin holding [start, end], ends inclusive.'''
+    if start < 0 or end >= BIN_MAX_END:
+        raise ValueError('Region %d-%d is outside of binnable range' % (start, end))
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = end >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    raise ValueError('Region %d-%d is outside of binnable range' % (start, end))
+
+
+def overlapping_bins(start, end):
+    '''Returns every UCSC bin that may hold a region overlapping [start, end], ends inclusive.'''
+    start_bin = max(start, 0) >> BIN_FIRST_SHIFT
+    end_bin = min(end, BIN_MAX_END - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return bins
+
+
+def bin_batches(regions):
+    '''Groups (chrom, start, end) regions by UCSC bin.  Yields (chrom, bin, positions).
+       Unlike region_batches the whole file is held, since peak files are rarely sorted on
+       position.'''
+    bins = {}
+    for (chrom, start, end) in regions:
+        bins.setdefault((chrom, region_bin(start, end)), []).append({'start': start, 'end': end})
+    for (chrom, rbin) in sorted(bins):
+        yield (chrom, rbin, bins.pop((chrom, rbin)))
+
+
+def binned_index(chrom):
+    return chrom + BINNED_INDEX_SUFFIX
+
+
+def file_fingerprint(afile, layout=NESTED_LAYOUT):
+    '''Returns what must be unchanged for a resident file to be left alone by incremental cycles.'''
+    return {
+        'md5sum': afile.get('md5sum'),
+        'file_format': afile.get('file_format'),
+        'output_type': afile.get('output_type'),
+        'status': afile.get('status'),
+        'layout': layout,
+        'requirements_version': REQUIREMENTS_VERSION
+    }
+
+
+def region_doc_id(uuid, part=0):
+    '''Id of one part of a file's regions on a chrom.  The first part is keyed on the uuid alone.'''
+    if part == 0:
+        return str(uuid)
+    return '%s:%d' % (uuid, part)
+
+
+def region_bin_doc_id(uuid, rbin):
+    '''Returns the id of the binned region doc for one bin of a file.'''
+    return '%s:b%d' % (uuid, rbin)
+
+
+def region_doc_uuid(doc_id):
+    '''Returns the file uuid of a region doc id.'''
+    return doc_id.split(':')[0]
+
+
+def file_chunks(fh, chunk_size=STREAM_CHUNK_BYTES):
+    '''Yields chunks of an open binary file, closing it when done.'''
+    with fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class PeakFileCache(object):
+    # Content addressed on-disk cache of downloaded peak files, keyed on md5sum.
+    # Least recently used files are evicted once the cache grows beyond max_size bytes.
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # md5sum: size, least recently used first
+        self.size = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+
+    def load(self):
+        '''Picks up files cached by earlier processes, oldest first.'''
+        found = []
+        for subdir in os.listdir(self.path):
+            subpath = os.path.join(self.path, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                filepath = os.path.join(subpath, name)
+                if name.startswith('.'):
+                    os.remove(filepath)  # partial download from an interrupted process
+                    continue
+                stat = os.stat(filepath)
+                found.append((stat.st_mtime, name, stat.st_size))
+        for (mtime, md5sum, size) in sorted(found):
+            self.entries[md5sum] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+
+    def file_path(self, md5sum):
+        return os.path.join(self.path, md5sum[:2], md5sum)
+
+    def open(self, md5sum):
+        '''Returns the cached file opened for reading and marks it as recently used,
+           or None if not cached.'''
+        with self.lock:
+            if md5sum not in self.entries:
+                return None
+            try:
+                fh = open(self.file_path(md5sum), 'rb')  # still readable if evicted while open
+            except FileNotFoundError:  # removed by another process sharing the cache
+                self.size -= self.entries.pop(md5sum)
+                return None
+            self.entries.move_to_end(md5sum)
+            # so that recency survives a restart, through the fd in case of eviction
+            os.utime(fh.fileno())
+        return fh
+
+    def tee(self, md5sum, chunks):
+        '''Yields chunks while writing them to the cache.
+           The file is only kept if all chunks were read and the md5sum matches.'''
+        subpath = os.path.dirname(self.file_path(md5sum))
+        os.makedirs(subpath, exist_ok=True)
+        partial = tempfile.NamedTemporaryFile(dir=subpath, prefix='.', delete=False)
+        digest = hashlib.md5()
+        complete = False
+        try:
+            for chunk in chunks:
+                partial.write(chunk)
+                digest.update(chunk)
+                yield chunk
+            complete = True
+        finally:
+            partial.close()
+            if complete and digest.hexdigest() == md5sum:
+                self.add(md5sum, partial.name)
+            else:
+                if complete:
+                    log.warn("Not caching %s: downloaded md5sum is %s" %
+                             (md5sum, digest.hexdigest()))
+                os.remove(partial.name)
+
+    def add(self, md5sum, filepath):
+        size = os.path.getsize(filepath)
+        os.replace(filepath, self.file_path(md5sum))
+        with self.lock:
+            self.size -= self.entries.pop(md5sum, 0)
+            self.entries[md5sum] = size
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        '''Removes least recently used files until the cache fits. Caller holds the lock.'''
+        while self.size > self.max_size and self.entries:
+            (md5sum, size) = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.file_path(md5sum))
+            except OSError:
+                pass
+
 # Mapping should be generated dynamically for each assembly type
 
 
@@ -121,6 +396,30 @@ def get_mapping(assembly_name='hg19'):
     }
 
 
+def get_binned_mapping(assembly_name='hg19'):
+    return {
+        assembly_name: {
+            '_all': {
+                'enabled': False
+            },
+            '_source': {
+                'enabled': True
+            },
+            'properties': {
+                'uuid': {
+                    'type': 'keyword'
+                },
+                'bin': {
+                    'type': 'integer'
+                },
+                'positions': {
+                    'type': 'integer_range'
+                }
+            }
+        }
+    }
+
+
 def index_settings():
     return {
         'index': {
@@ -156,8 +455,11 @@ class RegionIndexerState(IndexerState):
         super(RegionIndexerState, self).__init__(es,key, title='region')
         self.files_added_set    = self.title + '_files_added'
         self.files_dropped_set  = self.title + '_files_dropped'
+        self.assemblies_changed_set = self.title + '_assemblies_changed'
         self.success_set        = self.files_added_set
-        self.cleanup_last_cycle.extend([self.files_added_set,self.files_dropped_set])  # Clean up at beginning of next cycle
+        # Clean up at beginning of next cycle
+        self.cleanup_last_cycle.extend([self.files_added_set,self.files_dropped_set,
+                                        self.assemblies_changed_set])
         # DO NOT INHERIT! These keys are for passing on to other indexers
         self.followup_prep_list = None                        # No followup to a following indexer
         self.staged_cycles_list = None                        # Will take all of primary self.staged_for_regions_list
@@ -166,7 +468,10 @@ class RegionIndexerState(IndexerState):
         self.list_extend(self.files_added_set, [uuid])
 
     def file_dropped(self, uuid):
-        self.list_extend(self.files_added_set, [uuid])
+        self.list_extend(self.files_dropped_set, [uuid])
+
+    def assembly_changed(self, assembly):
+        self.list_extend(self.assemblies_changed_set, [assembly])
 
     def all_indexable_uuids(self, request):
         '''returns list of uuids pertinant to this indexer.'''
@@ -273,6 +578,11 @@ class RegionIndexerState(IndexerState):
         state['status'] = 'done'
         state['cycles'] = state.get('cycles', 0) + 1
         state['cycle_took'] = self.elapsed('cycle')
+        # Last cycle to change each assembly, so region search knows which cached results are stale
+        assembly_cycles = state.get('assembly_cycles', {})
+        for assembly in set(self.get_list(self.assemblies_changed_set)):
+            assembly_cycles[assembly] = state['cycles']
+        state['assembly_cycles'] = assembly_cycles
 
         self.put(state)
         self._del_is_reindex()
@@ -386,6 +696,44 @@ class RegionIndexer(Indexer):
         self.residents_index = RESIDENT_REGIONSET_KEY
         self.state = RegionIndexerState(self.encoded_es,self.encoded_INDEX)  # WARNING, race condition is avoided because there is only one worker
         self.test_instance = registry.settings.get('testing',False)
+        settings = registry.settings
+        self.bulk_ingest = asbool(settings.get('regionindexer.bulk', True))
+        self.bulk_chunk_size = int(settings.get('regionindexer.bulk_chunk_size', BULK_CHUNK_SIZE))
+        self.bulk_max_chunk_bytes = int(
+            settings.get('regionindexer.bulk_max_chunk_bytes', BULK_MAX_CHUNK_BYTES)
+        )
+        self.batch_size = int(settings.get('regionindexer.batch_size', REGION_BATCH_SIZE))
+        self.layout = settings.get('regionindexer.layout', NESTED_LAYOUT)
+        if self.layout not in (NESTED_LAYOUT, BINNED_LAYOUT):
+            raise ValueError('Unknown regionindexer.layout %r' % self.layout)
+        # Incremental: resident files are only re-ingested, even when forced, if their fingerprint
+        # changed
+        self.incremental = asbool(settings.get('regionindexer.incremental', False))
+        self.assemblies_changed = set()
+        # (index, doc_type) pairs known to exist in regions_es for this process
+        self.known_mappings = set()
+        self.mappings_lock = threading.Lock()
+        # Files are downloaded, parsed and indexed by a pool of threads, since that is mostly
+        # waiting on I/O
+        self.workers = int(settings.get('regionindexer.workers', 1) or 1)
+        self.http = urllib3.PoolManager(
+            maxsize=self.workers,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where()
+        )
+        self.file_cache = None
+        file_cache_dir = settings.get('regionindexer.file_cache_dir')
+        if file_cache_dir:
+            file_cache_size = humanfriendly.parse_size(
+                settings.get('regionindexer.file_cache_size', FILE_CACHE_SIZE)
+            )
+            self.file_cache = PeakFileCache(file_cache_dir, file_cache_size)
+        # Regions are also written to the local interval index that region search may use instead
+        # of es
+        self.interval_index = None
+        interval_index_dir = settings.get('region_search.interval_index_dir')
+        if interval_index_dir:
+            self.interval_index = IntervalIndex(interval_index_dir)
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
@@ -394,16 +742,75 @@ class RegionIndexer(Indexer):
     def update_objects(self, request, uuids, force):
         # pylint: disable=too-many-arguments, unused-argument
         '''Run indexing process on uuids'''
+        self.assemblies_changed = set()  # only tell the state about each assembly once a cycle
+        if self.workers > 1:
+            errors = self.update_objects_in_pool(request, uuids, force)
+        else:
+            errors = []
+            for i, uuid in enumerate(uuids):
+                errors.extend(self.update_object(request, uuid, force))
+                if (i + 1) % 1000 == 0:
+                    log.info('Indexing %d', i + 1)
+        if self.interval_index is not None:
+            try:
+                self.interval_index.compact()  # once per cycle, since merging rewrites whole chroms
+            except Exception:
+                log.error('Region indexer failed to merge the interval index', exc_info=True)
+        return errors
+
+    def update_objects_in_pool(self, request, uuids, force):
+        '''Run indexing process on uuids, with files handled concurrently by regionindexer.workers
+           threads.
+           Datasets are embedded and the indexer state is updated only on this thread.'''
+        errors = []
+        # enough queued to keep workers busy without holding every file
+        max_pending = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            for i, uuid in enumerate(uuids):
+                for task in self.file_tasks(request, uuid, force):
+                    pending[pool.submit(self.index_file, task)] = task
+                    if len(pending) >= max_pending:
+                        errors.extend(self.collect_file_tasks(pending, return_when=FIRST_COMPLETED))
+                if (i + 1) % 1000 == 0:
+                    log.info('Indexing %d', i + 1)
+            errors.extend(self.collect_file_tasks(pending))
+        return errors
+
+    def collect_file_tasks(self, pending, return_when=None):
+        '''Waits on pending file futures, records their outcomes and returns their errors.'''
+        if return_when is None:
+            (done, not_done) = wait(pending)
+        else:
+            (done, not_done) = wait(pending, return_when=return_when)
         errors = []
-        for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, force)
-            if error is not None:
-                errors.append(error)
-            if (i + 1) % 1000 == 0:
-                log.info('Indexing %d', i + 1)
+        for future in done:
+            task = pending.pop(future)
+            try:
+                outcome = future.result()
+            except Exception as e:
+                log.error('Error indexing regions of %s', task['afile']['uuid'], exc_info=True)
+                errors.append(self.file_error(task, e))
+                continue
+            self.record_file_task(task, outcome)
         return errors
 
     def update_object(self, request, dataset_uuid, force):
+        '''Indexes the files of one dataset.  Returns list of errors.'''
+        errors = []
+        for task in self.file_tasks(request, dataset_uuid, force):
+            try:
+                outcome = self.index_file(task)
+            except Exception as e:
+                log.error('Error indexing regions of %s', task['afile']['uuid'], exc_info=True)
+                errors.append(self.file_error(task, e))
+                continue
+            self.record_file_task(task, outcome)
+        return errors
+
+    def file_tasks(self, request, dataset_uuid, force):
+        '''Yields a task for each file of a dataset that may need to be added to or dropped from
+           regions es.'''
         request.datastore = 'elasticsearch'  # Let's be explicit
 
         try:
@@ -423,36 +830,85 @@ class RegionIndexer(Indexer):
         if assay_term_name is None:
             return
 
-        files = dataset.get('files',[])
-        for afile in files:
-            if afile.get('file_format') not in ENCODED_ALLOWED_FILE_FORMATS:
-                continue  # Note: if file_format changed to not allowed but file already in regions es, it doesn't get removed.
-
-            file_uuid = afile['uuid']
-
-            if self.encoded_candidate_file(afile, assay_term_name):
-
-                using = ""
-                if force:
-                    using = "with FORCE"
-                    #log.debug("file is a candidate: %s %s", afile['accession'], using)
-                    self.remove_from_regions_es(file_uuid)  # remove all regions first
-                else:
-                    #log.debug("file is a candidate: %s", afile['accession'])
-                    if self.in_regions_es(file_uuid):
-                        continue
-
-                if self.add_encoded_file_to_regions_es(request, assay_term_name, afile):
-                    log.info("added file: %s %s %s", dataset['accession'], afile['href'], using)
-                    self.state.file_added(file_uuid)
-
-            else:
-                if self.remove_from_regions_es(file_uuid):
-                    log.info("dropped file: %s %s %s", dataset['accession'], afile['@id'], using)
-                    self.state.file_dropped(file_uuid)
+        files = [afile for afile in dataset.get('files',[])
+                 if afile.get('file_format') in ENCODED_ALLOWED_FILE_FORMATS]
+        # Note: if file_format changed to not allowed but file already in regions es, it doesn't get
+        # removed.
+        if not files:
+            return
 
-        # TODO: gather and return errors
+        # One round trip for the residency of every file in the dataset
+        residents = self.get_residencies([afile['uuid'] for afile in files])
+        for afile in files:
+            candidate = self.encoded_candidate_file(afile, assay_term_name)
+            task = {
+                'accession': dataset['accession'],
+                'assay_term_name': assay_term_name,
+                'afile': afile,
+                'href': self.file_href(request, afile) if candidate else None,
+                'candidate': candidate,
+                'force': force
+            }
+            if residents is not None:
+                task['resident'] = residents.get(afile['uuid'])
+            yield task
+
+    def index_file(self, task):
+        '''Adds or drops one file in regions es.  Safe to run on a worker thread: no request is
+           used.
+           Returns 'added', 'dropped' or None.'''
+        afile = task['afile']
+        file_uuid = afile['uuid']
+        if 'resident' in task:
+            resident = task['resident']  # already looked up with the rest of the dataset
+        else:
+            resident = self.get_residency(file_uuid)
+        if not task['candidate']:
+            if resident is not None and self.remove_from_regions_es(file_uuid, resident):
+                return 'dropped'
+            return None
+
+        fingerprint = file_fingerprint(afile, self.layout)
+        if resident is not None:
+            if self.incremental:
+                if resident.get('fingerprint') == fingerprint:
+                    return None
+            elif not task['force']:
+                return None
+            #log.debug("file is a candidate: %s with FORCE", afile['accession'])
+            self.remove_from_regions_es(file_uuid, resident)  # remove all regions first
+
+        if self.add_encoded_file_to_regions_es(None, task['assay_term_name'], afile,
+                                               href=task['href'], fingerprint=fingerprint):
+            return 'added'
+        return None
 
+    def record_file_task(self, task, outcome):
+        '''Accounts for the outcome of a file task in the indexer state.'''
+        afile = task['afile']
+        using = "with FORCE" if task['force'] else ""
+        if outcome == 'added':
+            log.info("added file: %s %s %s", task['accession'], afile['href'], using)
+            self.state.file_added(afile['uuid'])
+        elif outcome == 'dropped':
+            log.info("dropped file: %s %s %s", task['accession'], afile['@id'], using)
+            self.state.file_dropped(afile['uuid'])
+        else:
+            return
+        assembly = afile.get('assembly', 'unknown')
+        if assembly == 'mm10-minimal':        # Treat mm10-minimal as mm10
+            assembly = 'mm10'
+        if assembly not in self.assemblies_changed:
+            self.assemblies_changed.add(assembly)
+            self.state.assembly_changed(assembly)
+
+    def file_error(self, task, exc):
+        timestamp = datetime.datetime.now().isoformat()
+        return {
+            'error_message': repr(exc),
+            'timestamp': timestamp,
+            'uuid': str(task['afile']['uuid'])
+        }
 
     def encoded_candidate_file(self, afile, assay_term_name):
         '''returns True if an encoded file should be in regions es'''
@@ -496,85 +952,275 @@ class RegionIndexer(Indexer):
             return False
         return True
 
-    def in_regions_es(self, id):
-        '''returns True if an id is in regions es'''
-        #return False # DEBUG
+    def get_residency(self, id):
+        '''Returns the residency doc of an id in regions es, or None if not resident.'''
         try:
             doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
-            if doc:
-                return True
         except NotFoundError:
-            return False
+            return None
         except:
             #raise
-            pass
+            return None
+        return doc or None
+
+    def get_residencies(self, ids):
+        '''Returns {id: residency doc} for those ids resident in regions es, using a single mget.
+           Returns None if the lookup failed, so callers can fall back to looking at ids one at a
+           time.'''
+        if not ids:
+            return {}
+        try:
+            res = self.regions_es.mget(index=self.residents_index, doc_type='default',
+                                       body={'ids': [str(id) for id in ids]})
+        except NotFoundError:
+            return {}  # No residents index yet
+        except:
+            log.warn("Region indexer failed to mget %d residents", len(ids), exc_info=True)
+            return None
+        return {doc['_id']: doc['_source'] for doc in res.get('docs', [])
+                if doc.get('found') and doc.get('_source')}
 
-        return False
+    def in_regions_es(self, id):
+        '''returns True if an id is in regions es'''
+        #return False # DEBUG
+        return self.get_residency(id) is not None
 
 
-    def remove_from_regions_es(self, id):
+    def remove_from_regions_es(self, id, doc=None):
         '''Removes all traces of an id (usually uuid) from region search elasticsearch index.'''
         #return True # DEBUG
-        try:
-            doc = self.regions_es.get(index=self.residents_index, doc_type='default', id=str(id)).get('_source',{})
-            if not doc:
-                return False
-        except:
-            return False  # Not an error: remove may be called without looking first
+        if doc is None:
+            doc = self.get_residency(id)
+            if doc is None:
+                return False  # Not an error: remove may be called without looking first
 
-        for chrom in doc['chroms']:
+        if self.interval_index is not None:
+            self.interval_index.remove_file(doc['assembly'], id, doc['chroms'])
+
+        if self.bulk_ingest:
+            return self.bulk_remove(id, doc)
+
+        for (index, doc_id) in self.resident_region_docs(id, doc):
             try:
-                self.regions_es.delete(index=chrom, doc_type=doc['assembly'], id=str(uuid))
+                self.regions_es.delete(index=index, doc_type=doc['assembly'], id=doc_id)
             except:
                 #log.error("Region indexer failed to remove %s regions of %s" % (chrom,id))
                 return False # Will try next full cycle
 
         try:
-            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(uuid))
+            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(id))
         except:
             log.error("Region indexer failed to remove %s from %s" % (id, self.residents_index))
             return False # Will try next full cycle
 
         return True
 
-
-    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
-        '''Given regions from some source (most likely encoded file) loads the data into region search es'''
-        #return True # DEBUG
-        for key in regions:
-            doc = {
-                'uuid': str(id),
-                'positions': regions[key]
+    def resident_region_docs(self, id, doc):
+        '''Yields (index, doc id) of every region doc of an id, from its residency doc.'''
+        if doc.get('layout') == BINNED_LAYOUT:
+            for (chrom, bins) in doc['bins'].items():
+                for rbin in bins:
+                    yield (binned_index(chrom), region_bin_doc_id(id, rbin))
+            return
+        parts = doc.get('parts', {})
+        for chrom in doc['chroms']:
+            for part in range(parts.get(chrom, 1)):
+                yield (chrom, region_doc_id(id, part))
+
+    def removal_actions(self, id, doc):
+        '''Yields bulk delete actions for every region doc of an id across its chrom indices.'''
+        for (index, doc_id) in self.resident_region_docs(id, doc):
+            yield {
+                '_op_type': 'delete',
+                '_index': index,
+                '_type': doc['assembly'],
+                '_id': doc_id
             }
-            # Could be a chrom never seen before!
-            if not self.regions_es.indices.exists(key):
-                self.regions_es.indices.create(index=key, body=index_settings())
 
-            if not self.regions_es.indices.exists_type(index=key, doc_type=assembly):
-                self.regions_es.indices.put_mapping(index=key, doc_type=assembly, body=get_mapping(assembly))
+    def bulk_remove_regions(self, id, doc):
+        '''Removes the regions of an id in one bulk request.
+           Already missing regions are not an error.'''
+        try:
+            (_, errors) = bulk(self.regions_es, self.removal_actions(id, doc),
+                               chunk_size=self.bulk_chunk_size,
+                               max_chunk_bytes=self.bulk_max_chunk_bytes, raise_on_error=False)
+        except:
+            log.error("Region indexer failed to remove regions of %s" % (id), exc_info=True)
+            return False
+        errors = [error for error in errors if error.get('delete', {}).get('status') != 404]
+        if errors:
+            log.error("Region indexer failed to remove regions of %s: %s" % (id, errors[0]))
+            return False
+        return True
+
+    def bulk_remove(self, id, doc):
+        '''Removes the regions of an id in one bulk request, then its residency doc.'''
+        if not self.bulk_remove_regions(id, doc):
+            return False # Leave the residency doc, so removal is retried next full cycle
+
+        try:
+            self.regions_es.delete(index=self.residents_index, doc_type='default', id=str(id))
+        except:
+            log.error("Region indexer failed to remove %s from %s" % (id, self.residents_index))
+            return False # Will try next full cycle
+        return True
 
-            self.regions_es.index(index=key, doc_type=assembly, body=doc, id=str(id))
 
-        # Now add dataset to residency list
+    def ensure_regions_mapping(self, index, doc_type, mapping):
+        '''Creates index and mapping in regions es if needed. Only asks es once per process.'''
+        if (index, doc_type) in self.known_mappings:
+            return
+        with self.mappings_lock:  # worker threads may meet the same new chrom at once
+            if (index, doc_type) in self.known_mappings:
+                return
+            # Could be a chrom never seen before!
+            if not self.regions_es.indices.exists(index):
+                try:
+                    self.regions_es.indices.create(index=index, body=index_settings())
+                except RequestError:
+                    # else another process beat us to it
+                    if not self.regions_es.indices.exists(index):
+                        raise
+
+            if not self.regions_es.indices.exists_type(index=index, doc_type=doc_type):
+                self.regions_es.indices.put_mapping(index=index, doc_type=doc_type, body=mapping)
+            self.known_mappings.add((index, doc_type))
+
+    def residency_doc(self, id, assembly, assay_term_name, parts, source='encoded',
+                      fingerprint=None):
+        '''Returns the document that records which chroms (and how many parts, or which bins, of
+           each) hold regions for an id.'''
         doc = {
             'uuid': str(id),
             'source': source,
             'assay_term_name': assay_term_name,
             'assembly': assembly,
-            'chroms': list(regions.keys())
+            'chroms': list(parts.keys())
         }
-        # Make sure there is an index set up to handle whether uuids are resident
-        if not self.regions_es.indices.exists(self.residents_index):
-            self.regions_es.indices.create(index=self.residents_index, body=index_settings())
+        if self.layout == BINNED_LAYOUT:
+            doc['layout'] = BINNED_LAYOUT
+            doc['bins'] = parts
+        else:
+            doc['parts'] = parts
+        if fingerprint is not None:
+            doc['fingerprint'] = fingerprint
+        return doc
 
-        if not self.regions_es.indices.exists_type(index=self.residents_index, doc_type='default'):
-            mapping = {'default': {"enabled": False}}
-            self.regions_es.indices.put_mapping(index=self.residents_index, doc_type='default', body=mapping)
+    def add_to_regions_es(self, id, assembly, assay_term_name, regions, source='encoded'):
+        '''Given regions from some source (most likely encoded file) loads the data into region
+           search es'''
+        #return True # DEBUG
+        if self.layout == BINNED_LAYOUT:
+            batches = bin_batches(
+                (key, p['start'], p['end']) for key in regions for p in regions[key]
+            )
+        else:
+            batches = ((key, 0, regions[key]) for key in regions)
+        return self.load_regions(id, assembly, assay_term_name, batches, source)
+
+    def region_actions(self, id, assembly, batches, parts):
+        '''Yields index actions for each (chrom, part, positions) batch.
+           Fills in parts with the count of parts per chrom, or with the bins per chrom when
+           binned.'''
+        for (chrom, part, positions) in batches:
+            if self.layout == BINNED_LAYOUT:
+                index = binned_index(chrom)
+                self.ensure_regions_mapping(index, assembly, get_binned_mapping(assembly))
+                parts.setdefault(chrom, []).append(part)
+                yield {
+                    '_index': index,
+                    '_type': assembly,
+                    '_id': region_bin_doc_id(id, part),
+                    '_source': {
+                        'uuid': str(id),
+                        'bin': part,
+                        'positions': [{'gte': p['start'], 'lte': p['end']} for p in positions]
+                    }
+                }
+                continue
+            self.ensure_regions_mapping(chrom, assembly, get_mapping(assembly))
+            parts[chrom] = part + 1
+            yield {
+                '_index': chrom,
+                '_type': assembly,
+                '_id': region_doc_id(id, part),
+                '_source': {
+                    'uuid': str(id),
+                    'positions': positions
+                }
+            }
 
-        self.regions_es.index(index=self.residents_index, doc_type='default', body=doc, id=str(id))
+    def load_regions(self, id, assembly, assay_term_name, batches, source='encoded',
+                     fingerprint=None):
+        '''Loads batches of regions for one id into region search es, then its residency once every
+           region doc is in.  Batches are consumed lazily so a streamed file is written as it is
+           read.  Should any region doc fail, those already written are removed again, leaving the
+           id not resident.'''
+        parts = {}
+        if self.interval_index is not None:
+            batches = self.interval_index.tee(assembly, id, batches)
+        actions = self.region_actions(id, assembly, batches, parts)
+        try:
+            if self.bulk_ingest:
+                # Bulk items succeed or fail independently, so all are checked before the residency
+                (_, errors) = bulk(
+                    self.regions_es,
+                    actions,
+                    chunk_size=self.bulk_chunk_size,
+                    max_chunk_bytes=self.bulk_max_chunk_bytes,
+                    raise_on_error=False
+                )
+                if errors:
+                    log.error("Region indexer bulk load of %s failed on %d docs: %s" %
+                              (id, len(errors), errors[0]))
+                    self.unload_regions(id, assembly, assay_term_name, parts)
+                    return False
+            else:
+                for action in actions:
+                    self.regions_es.index(index=action['_index'], doc_type=action['_type'],
+                                          body=action['_source'], id=action['_id'])
+            if not parts:
+                return False
+            self.ensure_regions_mapping(self.residents_index, 'default', RESIDENT_MAPPING)
+            residency = self.residency_doc(
+                id, assembly, assay_term_name, parts, source, fingerprint)
+            self.regions_es.index(
+                index=self.residents_index, doc_type='default', id=str(id), body=residency)
+        except Exception:
+            self.unload_regions(id, assembly, assay_term_name, parts)
+            raise
         return True
 
-    def add_encoded_file_to_regions_es(self, request, assay_term_name, afile):
+    def unload_regions(self, id, assembly, assay_term_name, parts):
+        '''Removes the region docs and intervals of a load that failed part way.'''
+        if not parts:
+            return
+        doc = self.residency_doc(id, assembly, assay_term_name, parts)
+        if self.interval_index is not None:
+            self.interval_index.remove_file(assembly, id, doc['chroms'])
+        if self.bulk_ingest:
+            self.bulk_remove_regions(id, doc)
+            return
+        for (index, doc_id) in self.resident_region_docs(id, doc):
+            try:
+                self.regions_es.delete(index=index, doc_type=assembly, id=doc_id)
+            except NotFoundError:
+                pass
+            except:
+                log.error("Region indexer failed to remove %s of %s" % (doc_id, id), exc_info=True)
+
+    def file_href(self, request, afile):
+        '''Returns the url an encoded file is downloaded from.'''
+        # Special case local instace so that tests can work...
+        if self.test_instance:
+            #if request.host_url == 'http://localhost':
+            # assume we are running in dev-servers
+            #href = request.host_url + ':8000' + afile['submitted_file_name']
+            return 'http://www.encodeproject.org' + afile['href']
+        return request.host_url + afile['href']
+
+    def add_encoded_file_to_regions_es(self, request, assay_term_name, afile, href=None,
+                                       fingerprint=None):
         '''Given an encoded file object, reads the file to create regions data then loads that into region search es.'''
         #return True # DEBUG
 
@@ -584,14 +1230,8 @@ class RegionIndexer(Indexer):
         if assembly not in SUPPORTED_ASSEMBLIES:
             return False
 
-        # Special case local instace so that tests can work...
-        if self.test_instance:
-            #if request.host_url == 'http://localhost':
-            # assume we are running in dev-servers
-            #href = request.host_url + ':8000' + afile['submitted_file_name']
-            href = 'http://www.encodeproject.org' + afile['href']
-        else:
-            href = request.host_url + afile['href']
+        if href is None:
+            href = self.file_href(request, afile)
 
         ### Works with localhost:8000
         # NOTE: Using requests instead of http.request which works locally and doesn't require gzip.open
@@ -620,45 +1260,52 @@ class RegionIndexer(Indexer):
         ##else:  Other file types?
 
         ### Works with http://www.encodeproject.org
-        # Note: this reads the file into an in-memory byte stream.  If files get too large,
-        # We could replace this with writing a temp file, then reading it via gzip and tsvreader.
+        # Note: the response is streamed, gunzipped and parsed incrementally and region batches are
+        # flushed to es as they fill, so memory is bounded by batch size rather than file size.
+        if afile['file_format'] != 'bed':
+            return False  # Other file types?
+        md5sum = afile.get('md5sum')
+        if self.file_cache is not None and md5sum:
+            cached = self.file_cache.open(md5sum)
+            if cached is not None:
+                return self.load_file_chunks(
+                    file_chunks(cached), assembly, assay_term_name, afile, fingerprint
+                )
+
         urllib3.disable_warnings()
-        http = urllib3.PoolManager(
-            cert_reqs='CERT_REQUIRED',
-            ca_certs=certifi.where()
+        r = self.http.request('GET', href, preload_content=False)
+        read = False
+        try:
+            if r.status != 200:
+                log.warn("File (%s or %s) not found" %
+                         (afile.get('accession', afile['uuid']), href))
+                return False
+            chunks = r.stream(STREAM_CHUNK_BYTES)
+            if self.file_cache is not None and md5sum:
+                chunks = self.file_cache.tee(md5sum, chunks)
+            loaded = self.load_file_chunks(chunks, assembly, assay_term_name, afile, fingerprint)
+            read = True
+            return loaded
+        finally:
+            # Only a connection whose body was read through goes back to the pool for reuse
+            if read:
+                r.drain_conn()
+            else:
+                r.close()
+            r.release_conn()
+
+    def load_file_chunks(self, chunks, assembly, assay_term_name, afile, fingerprint=None):
+        '''Parses gzipped bed chunks and loads the regions into region search es.'''
+        # NOTE: requests doesn't require gzip but http.request does.
+        regions = bed_regions(gunzip_lines(chunks))
+        if self.test_instance:
+            regions = (region for region in regions if region[0] == 'chr1')
+        if self.layout == BINNED_LAYOUT:
+            batches = bin_batches(regions)
+        else:
+            batches = region_batches(regions, self.batch_size)
+        if fingerprint is None:
+            fingerprint = file_fingerprint(afile, self.layout)
+        return self.load_regions(
+            afile['uuid'], assembly, assay_term_name, batches, 'encoded', fingerprint
         )
-        r = http.request('GET', href)
-        if r.status != 200:
-            log.warn("File (%s or %s) not found" % (afile.get('accession', id), href))
-            return False
-        file_in_mem = io.BytesIO()
-        file_in_mem.write(r.data)
-        file_in_mem.seek(0)
-        r.release_conn()
-
-        file_data = {}
-        if afile['file_format'] == 'bed':
-            # NOTE: requests doesn't require gzip but http.request does.
-            with gzip.open(file_in_mem, mode='rt') as file:  # localhost:8000 would not require localhost
-                for row in tsvreader(file):
-                    chrom, start, end = row[0].lower(), int(row[1]), int(row[2])
-                    if isinstance(start, int) and isinstance(end, int):
-                        if chrom in file_data:
-                            file_data[chrom].append({
-                                'start': start + 1,
-                                'end': end + 1
-                            })
-                        else:
-                            file_data[chrom] = [{'start': start + 1, 'end': end + 1}]
-                    else:
-                        log.warn('positions are not integers, will not index file')
-        #else:  Other file types?
-
-        if file_data:
-            if self.test_instance:
-                chr1 = file_data['chr1']
-                file_data.clear()
-                file_data['chr1'] = chr1
-            return self.add_to_regions_es(afile['uuid'], assembly, assay_term_name, file_data, 'encoded')
-
-        return False
@@ -0,0 +1,366 @@
+'''Memory-mapped interval index of peak files, an alternative region search backend to regions es.
+
+Layout under the index directory:
+    <assembly>/segments/<chrom>/<file uuid>.ridx   one file's peaks on one chrom, written by the
+                                                    region indexer
+    <assembly>/<chrom>.ridx                         every segment of a chrom merged by compact()
+
+Segments and merged indices share one format: a header, a table of the file uuids covered, then
+one section per interval length class.  A section holds parallel uint32 arrays of start, end and
+file number sorted on start.  No interval in a section is longer than its max_len, so overlaps are
+found with a binary search and a scan bounded by max_len.  Files are only ever replaced by rename
+and read through read-only mmaps, so every web process shares one copy in the page cache.
+'''
+import bisect
+import collections
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+
+
+log = logging.getLogger(__name__)
+
+
+INTERVAL_INDEX = 'region_interval_index'  # registry key of the index used by region search
+
+MAGIC = b'ENCRIDX1'
+HEADER = struct.Struct('=8sII')     # magic, number of sections, bytes of uuid table
+SECTION = struct.Struct('=IIIQ')    # length class, count, max_len, offset of starts
+ITEM_SIZE = 4                       # array('I'), native byte order: indices never leave the host
+EXTENSION = '.ridx'
+WRITE_BATCH = 64 * 1024             # intervals buffered per array while writing a section
+
+Section = collections.namedtuple(
+    'Section', ['length_class', 'count', 'max_len', 'starts', 'ends', 'numbers']
+)
+
+
+def length_class(start, end):
+    '''Intervals within a class are at most twice as long as each other, which bounds overlap
+       scans.'''
+    return (end - start).bit_length()
+
+
+def section_intervals(section, renumber=None):
+    '''Yields (start, end, file number) of a section in start order, optionally mapping file
+       numbers.'''
+    for i in range(section.count):
+        number = section.numbers[i]
+        yield (section.starts[i], section.ends[i], number if renumber is None else renumber[number])
+
+
+def write_interval_file(path, uuids, sections):
+    '''Writes an interval file then renames it into place.
+       sections: (length_class, count, max_len, intervals) where intervals are
+       (start, end, file number) sorted on start.  Counts must be known up front, so intervals can
+       be a lazy merge.'''
+    table = json.dumps(uuids).encode('utf-8')
+    data_offset = HEADER.size + SECTION.size * len(sections) + len(table)
+    data_offset += -data_offset % ITEM_SIZE
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    (fd, tmp) = tempfile.mkstemp(prefix='.', suffix=EXTENSION, dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, len(sections), len(table)))
+            offset = data_offset
+            for (klass, count, max_len, _) in sections:
+                fh.write(SECTION.pack(klass, count, max_len, offset))
+                offset += 3 * ITEM_SIZE * count
+            fh.write(table)
+            fh.write(b'\0' * (data_offset - fh.tell()))
+            for (_, count, _, intervals) in sections:
+                write_section(fh, count, intervals)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def write_section(fh, count, intervals):
+    '''Writes starts, ends and file numbers of a section as three arrays, flushing each as it
+       fills.'''
+    base = fh.tell()
+    written = 0
+    buffers = (array('I'), array('I'), array('I'))
+
+    def flush():
+        for (n, buf) in enumerate(buffers):
+            fh.seek(base + ITEM_SIZE * (n * count + written))
+            buf.tofile(fh)
+        return len(buffers[0])
+
+    for (start, end, number) in intervals:
+        buffers[0].append(start)
+        buffers[1].append(end)
+        buffers[2].append(number)
+        if len(buffers[0]) >= WRITE_BATCH:
+            written += flush()
+            for buf in buffers:
+                del buf[:]
+    written += flush()
+    if written != count:
+        raise ValueError('Expected %d intervals in section but got %d' % (count, written))
+    fh.seek(base + 3 * ITEM_SIZE * count)
+
+
+def segment_sections(positions):
+    '''Sorts one file's positions on one chrom into sections for write_interval_file.'''
+    classes = {}
+    for (start, end) in positions:
+        classes.setdefault(length_class(start, end), []).append((start, end, 0))
+    sections = []
+    for klass in sorted(classes):
+        intervals = sorted(classes[klass])
+        max_len = max(end - start for (start, end, _) in intervals)
+        sections.append((klass, len(intervals), max_len, intervals))
+    return sections
+
+
+def run_intervals(view, offset, count):
+    '''Yields (start, end, 0) of a run spilled by IntervalRuns.'''
+    pairs = view[offset:offset + 2 * ITEM_SIZE * count].cast('I')
+    for i in range(count):
+        yield (pairs[2 * i], pairs[2 * i + 1], 0)
+
+
+class IntervalRuns(object):
+    '''One file's intervals spilled to an unnamed temp file a batch at a time, as runs sorted on
+       start per chrom and length class.  Segments are then written by merging the runs, so memory
+       is bounded by batch size.'''
+
+    def __init__(self, dirname):
+        self.fh = tempfile.TemporaryFile(dir=dirname)
+        self.runs = {}      # chrom: {length class: [(offset, count)]}
+        self.max_lens = {}  # (chrom, length class): max_len
+        self.offset = 0
+        self.view = None
+
+    def add(self, chrom, positions):
+        classes = {}
+        for (start, end) in positions:
+            classes.setdefault(length_class(start, end), []).append((start, end))
+        chrom_runs = self.runs.setdefault(chrom, {})
+        for (klass, intervals) in classes.items():
+            intervals.sort()
+            pairs = array('I')
+            max_len = self.max_lens.get((chrom, klass), 0)
+            for (start, end) in intervals:
+                pairs.append(start)
+                pairs.append(end)
+                max_len = max(max_len, end - start)
+            pairs.tofile(self.fh)
+            chrom_runs.setdefault(klass, []).append((self.offset, len(intervals)))
+            self.max_lens[(chrom, klass)] = max_len
+            self.offset += ITEM_SIZE * len(pairs)
+
+    def chroms(self):
+        return list(self.runs)
+
+    def sections(self, chrom):
+        '''Returns the sections of a chrom for write_interval_file, merging runs as they are
+           written.'''
+        if self.view is None:
+            self.fh.flush()
+            self.view = memoryview(mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ))
+        sections = []
+        for (klass, runs) in sorted(self.runs[chrom].items()):
+            sections.append((
+                klass,
+                sum(count for (_, count) in runs),
+                self.max_lens[(chrom, klass)],
+                heapq.merge(*[run_intervals(self.view, offset, count) for (offset, count) in runs])
+            ))
+        return sections
+
+    def close(self):
+        self.view = None
+        self.fh.close()
+
+
+class IntervalFile(object):
+    '''Read-only view of an interval file through mmap.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self.stat = os.fstat(fh.fileno())
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, nsections, table_len) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an interval index' % path)
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        self.sections = []
+        for _ in range(nsections):
+            (klass, count, max_len, offset) = SECTION.unpack_from(self.mm, pos)
+            pos += SECTION.size
+            size = ITEM_SIZE * count
+            arrays = [view[offset + size * n:offset + size * (n + 1)].cast('I') for n in range(3)]
+            self.sections.append(Section(klass, count, max_len, *arrays))
+        self.uuids = json.loads(self.mm[pos:pos + table_len].decode('utf-8'))
+
+    def replaced(self, stat):
+        return (stat.st_ino, stat.st_mtime) != (self.stat.st_ino, self.stat.st_mtime)
+
+    def overlaps(self, start, end):
+        '''Yields (file number, start, end) of every interval overlapping [start, end], ends
+           inclusive.'''
+        for section in self.sections:
+            lo = bisect.bisect_left(section.starts, start - section.max_len)
+            hi = bisect.bisect_right(section.starts, end, lo)
+            ends = section.ends
+            for i in range(lo, hi):
+                if ends[i] >= start:
+                    yield (section.numbers[i], section.starts[i], ends[i])
+
+
+class IntervalIndex(object):
+    '''Per assembly, per chrom interval indices under one directory.
+       The region indexer adds and removes segments, then compact() merges them for region
+       search.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # opened merged indices by path, reopened once replaced
+        self.lock = threading.Lock()
+
+    def index_path(self, assembly, chrom):
+        return os.path.join(self.path, assembly, chrom + EXTENSION)
+
+    def segment_dir(self, assembly, chrom):
+        return os.path.join(self.path, assembly, 'segments', chrom)
+
+    def segment_path(self, assembly, chrom, uuid):
+        return os.path.join(self.segment_dir(assembly, chrom), str(uuid) + EXTENSION)
+
+    def add_file(self, assembly, uuid, positions):
+        '''Writes a segment per chrom of {chrom: [(start, end), ...]} for one file.'''
+        for (chrom, chrom_positions) in positions.items():
+            write_interval_file(self.segment_path(assembly, chrom, uuid), [str(uuid)],
+                                segment_sections(chrom_positions))
+
+    def tee(self, assembly, uuid, batches):
+        '''Passes (chrom, part, positions) batches through, adding the file once they are all
+           consumed.
+           Batches are spilled to disk as they pass, so only one is held in memory.'''
+        dirname = os.path.join(self.path, assembly)
+        os.makedirs(dirname, exist_ok=True)
+        runs = IntervalRuns(dirname)
+        try:
+            for (chrom, part, batch) in batches:
+                if batch:
+                    runs.add(chrom, ((position['start'], position['end']) for position in batch))
+                yield (chrom, part, batch)
+            for chrom in runs.chroms():
+                write_interval_file(
+                    self.segment_path(assembly, chrom, uuid), [str(uuid)], runs.sections(chrom)
+                )
+        finally:
+            runs.close()
+
+    def remove_file(self, assembly, uuid, chroms):
+        for chrom in chroms:
+            try:
+                os.unlink(self.segment_path(assembly, chrom, uuid))
+            except FileNotFoundError:
+                pass
+
+    def stale_chroms(self, assembly):
+        '''Returns chroms whose merged index does not match their segments.'''
+        segments_dir = os.path.join(self.path, assembly, 'segments')
+        if not os.path.isdir(segments_dir):
+            return []
+        stale = []
+        for chrom in sorted(os.listdir(segments_dir)):
+            names = [name for name in os.listdir(self.segment_dir(assembly, chrom))
+                     if name.endswith(EXTENSION) and not name.startswith('.')]
+            index_path = self.index_path(assembly, chrom)
+            if not os.path.exists(index_path):
+                if names:
+                    stale.append(chrom)
+                continue
+            index = IntervalFile(index_path)
+            uuids = set(name[:-len(EXTENSION)] for name in names)
+            newest = max((os.stat(os.path.join(self.segment_dir(assembly, chrom), name)).st_mtime
+                          for name in names), default=0)
+            if set(index.uuids) != uuids or newest > index.stat.st_mtime:
+                stale.append(chrom)
+        return stale
+
+    def compact(self):
+        '''Merges the segments of every changed chrom into its index.  Returns the number of
+           chroms merged.'''
+        if not os.path.isdir(self.path):
+            return 0
+        merged = 0
+        for assembly in sorted(os.listdir(self.path)):
+            for chrom in self.stale_chroms(assembly):
+                self.compact_chrom(assembly, chrom)
+                merged += 1
+        return merged
+
+    def compact_chrom(self, assembly, chrom):
+        segment_dir = self.segment_dir(assembly, chrom)
+        names = sorted(name for name in os.listdir(segment_dir)
+                       if name.endswith(EXTENSION) and not name.startswith('.'))
+        if not names:
+            try:
+                os.unlink(self.index_path(assembly, chrom))
+            except FileNotFoundError:
+                pass
+            return
+        segments = [IntervalFile(os.path.join(segment_dir, name)) for name in names]
+        uuids = []
+        numbers = {}
+        for segment in segments:
+            for uuid in segment.uuids:
+                if uuid not in numbers:
+                    numbers[uuid] = len(uuids)
+                    uuids.append(uuid)
+        classes = {}
+        for segment in segments:
+            renumber = [numbers[uuid] for uuid in segment.uuids]
+            for section in segment.sections:
+                classes.setdefault(section.length_class, []).append((section, renumber))
+        sections = []
+        for klass in sorted(classes):
+            parts = classes[klass]
+            sections.append((
+                klass,
+                sum(section.count for (section, _) in parts),
+                max(section.max_len for (section, _) in parts),
+                heapq.merge(*[
+                    section_intervals(section, renumber) for (section, renumber) in parts
+                ])
+            ))
+        write_interval_file(self.index_path(assembly, chrom), uuids, sections)
+        log.info('Merged %d %s %s interval segments', len(names), assembly, chrom)
+
+    def open(self, assembly, chrom):
+        '''Returns the merged index of a chrom, or None if there is none.'''
+        path = self.index_path(assembly, chrom)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            index = self.files.get(path)
+            if index is None or index.replaced(stat):
+                index = self.files[path] = IntervalFile(path)
+            return index
+
+    def overlaps(self, assembly, chrom, start, end):
+        '''Returns {file uuid: [(start, end), ...]} of peaks overlapping [start, end].'''
+        index = self.open(assembly, chrom)
+        results = {}
+        if index is None:
+            return results
+        for (number, peak_start, peak_end) in index.overlaps(start, end):
+            results.setdefault(index.uuids[number], []).append((peak_start, peak_end))
+        return results
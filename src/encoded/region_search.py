@@ -1,21 +1,79 @@
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
 from pyramid.view import view_config
 from encoded.vis_defines import vis_format_url
 from snovault import TYPES
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
 from snovault.elasticsearch.indexer import MAX_CLAUSES_FOR_ES
+from elasticsearch.exceptions import RequestError
 from .batch_download import get_peak_metadata_links
+from .cache import LRUCache
+from .region_indexer import (
+    BINNED_LAYOUT,
+    NESTED_LAYOUT,
+    RegionIndexerState,
+    binned_index,
+    overlapping_bins,
+    region_doc_uuid,
+)
+from .region_intervals import (
+    INTERVAL_INDEX,
+    IntervalIndex,
+)
 from collections import OrderedDict
 import requests
 from urllib.parse import urlencode
 
+import copy
+import csv
+import gzip
+import io
+import json
 import logging
 import re
+import time
 
 
 log = logging.getLogger(__name__)
 
 
 _ENSEMBL_URL = 'http://rest.ensembl.org/'
+_ENSEMBL_TIMEOUT = 10  # seconds, so a slow Ensembl can't hold a worker for long
+
+COORDINATE_RESOLVER = 'region_coordinate_resolver'
+_COORDINATES_CACHE_SIZE = 10000
+_COORDINATES_CACHE_TTL = 24 * 60 * 60  # seconds
+
+SUGGEST_CACHE = 'region_suggest_cache'
+_SUGGEST_SIZE = 10
+_SUGGEST_CACHE_SIZE = 1000
+_SUGGEST_CACHE_TTL = 5 * 60  # seconds, annotations only change on reindexing them
+
+REGION_SEARCH_CACHE = 'region_search_cache'
+_RESULT_CACHE_SIZE = 1000
+_RESULT_CACHE_MAX_LIMIT = 100  # bigger pages are rare and costly to hold
+_RESULT_CACHE_CHECK = 30  # seconds between looks at which assemblies the region indexer changed
+_RESULT_CACHE_TTL = 10 * 60  # seconds, since experiment edits touching no files leave the cycle
+# Normalized into coordinates and assembly, or not used by the searches
+_RESULT_CACHE_IGNORED_PARAMS = [
+    'region', 'annotation', 'genome', 'limit', 'referrer', 'format', 'frame', 'field'
+]
+
+_BATCH_MAX_REGIONS = 100000
+_BATCH_CHUNK_SIZE = 200  # regions per msearch, and per write of the streamed response
+_BATCH_EXPERIMENT_FIELDS = [
+    'embedded.@id',
+    'embedded.accession',
+    'embedded.assay_term_name',
+    'embedded.target.label',
+    'embedded.biosample_ontology.term_name',
+    'embedded.files.uuid',
+    'embedded.files.accession'
+]
+_BATCH_TSV_HEADER = [
+    'region', 'coordinates', 'file.accession', 'experiment.accession',
+    'assay_term_name', 'target.label', 'biosample_ontology.term_name'
+]
 
 _REGION_FIELDS = [
     'embedded.files.uuid',
@@ -57,7 +115,28 @@ _GENOME_TO_ALIAS = {
 
 def includeme(config):
     config.add_route('region-search', '/region-search{slash:/?}')
+    config.add_route('region-search-batch', '/region-search-batch{slash:/?}')
     config.add_route('suggest', '/suggest{slash:/?}')
+    settings = config.registry.settings
+    config.registry[COORDINATE_RESOLVER] = CoordinateResolver(
+        table_path=settings.get('region_search.coordinates_table'),
+        cache_size=int(
+            settings.get('region_search.coordinates_cache_size', _COORDINATES_CACHE_SIZE)
+        ),
+        ttl=int(settings.get('region_search.coordinates_cache_ttl', _COORDINATES_CACHE_TTL))
+    )
+    config.registry[SUGGEST_CACHE] = LRUCache(_SUGGEST_CACHE_SIZE, _SUGGEST_CACHE_TTL)
+    result_cache_size = int(settings.get('region_search.result_cache_size', _RESULT_CACHE_SIZE))
+    if result_cache_size:
+        config.registry[REGION_SEARCH_CACHE] = RegionSearchCache(
+            config.registry,
+            result_cache_size,
+            int(settings.get('region_search.result_cache_check', _RESULT_CACHE_CHECK)),
+            int(settings.get('region_search.result_cache_ttl', _RESULT_CACHE_TTL))
+        )
+    interval_index_dir = config.registry.settings.get('region_search.interval_index_dir')
+    if interval_index_dir:
+        config.registry[INTERVAL_INDEX] = IntervalIndex(interval_index_dir)
     config.scan(__name__)
 
 
@@ -132,6 +211,112 @@ def get_peak_query(start, end, with_inner_hits=False, within_peaks=False):
     return query
 
 
+def get_binned_peak_query(start, end, with_positions=False):
+    """
+    return peak query for the binned region layout: term and range filters, no nested query
+    """
+    start = int(start)
+    end = int(end)
+    query = {
+        'query': {
+            'bool': {
+                'filter': [
+                    {
+                        'terms': {
+                            'bin': overlapping_bins(start, end)
+                        }
+                    },
+                    {
+                        'range': {
+                            'positions': {
+                                'gte': start,
+                                'lte': end,
+                                'relation': 'intersects'
+                            }
+                        }
+                    }
+                ]
+            }
+        },
+        '_source': ['positions'] if with_positions else False,
+    }
+    return query
+
+
+def format_binned_peak_hits(hits, chromosome, start, end):
+    '''
+    Gives binned hits the inner hits nested ones have, keeping only peaks that overlap
+    '''
+    start = int(start)
+    end = int(end)
+    for hit in hits:
+        positions = hit.pop('_source', {}).get('positions', [])
+        hit['_index'] = chromosome
+        hit['inner_hits'] = {
+            'positions': {
+                'hits': {
+                    'hits': [
+                        {'_source': {'start': position['gte'], 'end': position['lte']}}
+                        for position in positions
+                        if position['gte'] <= end and position['lte'] >= start
+                    ]
+                }
+            }
+        }
+
+
+def get_file_uuids_query(peak_query, size):
+    '''
+    Turns a peak query into one for the distinct file uuids of matching region docs, without hits
+    '''
+    peak_query['aggs'] = {
+        'file_uuids': {
+            'terms': {
+                'field': 'uuid',
+                'size': size
+            }
+        }
+    }
+    return peak_query
+
+
+def get_peak_file_uuids(peak_results):
+    '''
+    Returns the distinct file uuids of a peak search, from the file_uuids aggregation if there is
+    one
+    '''
+    if 'file_uuids' in peak_results.get('aggregations', {}):
+        return [bucket['key'] for bucket in peak_results['aggregations']['file_uuids']['buckets']]
+    # big files have several region docs per chrom
+    hits = peak_results.get('hits', {}).get('hits', [])
+    return list({region_doc_uuid(hit['_id']) for hit in hits})
+
+
+def get_interval_peak_results(interval_index, assembly, chromosome, start, end):
+    '''
+    Finds peaks in the local interval index, shaped like the hits of get_peak_query with inner hits
+    '''
+    hits = []
+    overlaps = interval_index.overlaps(assembly, chromosome, int(start), int(end))
+    for file_uuid, positions in overlaps.items():
+        hits.append({
+            '_id': file_uuid,
+            '_index': chromosome,
+            '_type': assembly,
+            'inner_hits': {
+                'positions': {
+                    'hits': {
+                        'hits': [
+                            {'_source': {'start': peak_start, 'end': peak_end}}
+                            for (peak_start, peak_end) in positions
+                        ]
+                    }
+                }
+            }
+        })
+    return {'hits': {'total': len(hits), 'hits': hits}}
+
+
 def sanitize_coordinates(term):
     ''' Sanitize the input string and return coordinates '''
 
@@ -176,7 +361,7 @@ def assembly_mapper(location, species, input_assembly, output_assembly):
         + input_assembly + '/' + location + '/' + output_assembly \
         + '/?content-type=application/json'
     try:
-        new_response = requests.get(new_url).json()
+        new_response = requests.get(new_url, timeout=_ENSEMBL_TIMEOUT).json()
     except:
         return('', '', '')
     else:
@@ -197,7 +382,7 @@ def get_rsid_coordinates(id, assembly):
         id=id
     )
     try:
-        response = requests.get(url).json()
+        response = requests.get(url, timeout=_ENSEMBL_TIMEOUT).json()
     except:
         return('', '', '')
     else:
@@ -223,7 +408,7 @@ def get_ensemblid_coordinates(id, assembly):
         id=id
     )
     try:
-        response = requests.get(url).json()
+        response = requests.get(url, timeout=_ENSEMBL_TIMEOUT).json()
     except:
         return('', '', '')
     else:
@@ -242,6 +427,131 @@ def get_ensemblid_coordinates(id, assembly):
         else:
             return ('', '', '')
 
+
+class CoordinateResolver(object):
+    '''
+    Resolves rsIDs and Ensembl ids to coordinates: from a local table if one is loaded,
+    then from a cache of recent lookups, and only then from Ensembl
+    '''
+
+    def __init__(self, table_path=None, cache_size=_COORDINATES_CACHE_SIZE,
+                 ttl=_COORDINATES_CACHE_TTL):
+        self.table = {}
+        self.cache = LRUCache(cache_size, ttl)  # (id, assembly): coordinates
+        if table_path:
+            self.load_table(table_path)
+
+    def load_table(self, path):
+        '''
+        Loads a tab separated table of id, assembly, chromosome, start, end
+        (e.g. rs10 GRCh38 chr7 92754574 92754574)
+        '''
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as table:
+            for row in csv.reader(table, delimiter='\t'):
+                if not row or row[0].startswith('#'):
+                    continue
+                (id, assembly, chromosome, start, end) = row[:5]
+                self.table[(id.lower(), assembly)] = (chromosome, start, end)
+        log.info('Loaded %d coordinates from %s', len(self.table), path)
+
+    def resolve(self, id, assembly, lookup):
+        key = (id.lower(), assembly)
+        coordinates = self.table.get(key) or self.cache.get(key)
+        if coordinates is not None:
+            return coordinates
+        coordinates = lookup(id, assembly)
+        # Errors and misses look the same from Ensembl, so neither is remembered
+        if all(coordinates):
+            self.cache.set(key, coordinates)
+        return coordinates
+
+    def rsid(self, id, assembly):
+        return self.resolve(id, assembly, get_rsid_coordinates)
+
+    def ensemblid(self, id, assembly):
+        return self.resolve(id, assembly, get_ensemblid_coordinates)
+
+
+class RegionSearchCache(object):
+    '''
+    Results of the peak and experiment searches of region search, shared by requests for the same
+    region, assembly, filters and principals.  Results of an assembly are stale once a region
+    indexer cycle has changed its files, and any are after ttl seconds, since the experiments found
+    can be edited without that.
+    '''
+
+    def __init__(self, registry, size=_RESULT_CACHE_SIZE, check_interval=_RESULT_CACHE_CHECK,
+                 ttl=_RESULT_CACHE_TTL):
+        self.registry = registry
+        self.check_interval = check_interval
+        self.entries = LRUCache(size, ttl)  # key: (cycle, json)
+        self.assembly_cycles = None
+        self.checked = 0
+
+    def cycle(self, assembly):
+        '''
+        Returns the last region indexer cycle that changed an assembly, looking it up at most
+        every check_interval
+        '''
+        now = time.time()
+        if self.assembly_cycles is None or now - self.checked > self.check_interval:
+            try:
+                es = self.registry[ELASTIC_SEARCH]
+                index = self.registry.settings['snovault.elasticsearch.index']
+                state = RegionIndexerState(es, index).get()
+                self.assembly_cycles = state.get('assembly_cycles', {})
+            except Exception:
+                log.warn('Region search cache could not read region indexer state', exc_info=True)
+                self.assembly_cycles = None
+            self.checked = now
+        if self.assembly_cycles is None:
+            return None
+        return self.assembly_cycles.get(assembly, 0)
+
+    @staticmethod
+    def key(request, assembly, coordinates, size, with_peaks):
+        params = sorted(
+            (k, v) for (k, v) in request.params.items() if k not in _RESULT_CACHE_IGNORED_PARAMS
+        )
+        principals = sorted(request.effective_principals)
+        return json.dumps([assembly, coordinates, size, with_peaks, params, principals])
+
+    def lookup(self, key, assembly):
+        '''
+        Returns (cycle, results): results are None when not cached, cycle is None when nothing may
+        be cached
+        '''
+        cycle = self.cycle(assembly)
+        if cycle is None:
+            return (None, None)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != cycle:
+            return (cycle, None)  # one stale is replaced when the fresh results are stored
+        # A fresh copy every time, since formatting results changes them
+        return (cycle, json.loads(entry[1]))
+
+    def store(self, key, cycle, results):
+        '''
+        Holds results found after looking up cycle, so they go stale with any later cycle
+        '''
+        if cycle is None:
+            return
+        self.entries.set(key, (cycle, json.dumps(results)))
+
+
+def resolve_region(resolver, region, assembly):
+    ''' Returns coordinates of a region given as an rsID, Ensembl id or chr:start-end '''
+    region = region.lower()
+    if region.startswith('rs'):
+        return resolver.rsid(sanitize_rsid(region), assembly)
+    elif region.startswith('ens'):
+        return resolver.ensemblid(region, assembly)
+    elif region.startswith('chr'):
+        return sanitize_coordinates(region)
+    return ('', '', '')
+
+
 def format_position(position, resolution):
     chromosome, start, end = re.split(':|-', position)
     start = int(start) - resolution
@@ -287,22 +597,17 @@ def region_search(context, request):
     result['assembly'] = _GENOME_TO_ALIAS.get(assembly,'GRCh38')
     annotation = request.params.get('annotation', '*')
     chromosome, start, end = ('', '', '')
+    resolver = request.registry[COORDINATE_RESOLVER]
 
     if annotation != '*':
         if annotation.lower().startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(annotation, assembly)
+            chromosome, start, end = resolver.ensemblid(annotation, assembly)
         else:
             chromosome, start, end = get_annotation_coordinates(es, annotation, assembly)
     elif region != '*':
         region = region.lower()
-        if region.startswith('rs'):
-            sanitized_region = sanitize_rsid(region)
-            chromosome, start, end = get_rsid_coordinates(sanitized_region, assembly)
-            region_inside_peak_status = True
-        elif region.startswith('ens'):
-            chromosome, start, end = get_ensemblid_coordinates(region, assembly)
-        elif region.startswith('chr'):
-            chromosome, start, end = sanitize_coordinates(region)
+        region_inside_peak_status = region.startswith('rs')
+        chromosome, start, end = resolve_region(resolver, region, assembly)
     else:
         chromosome, start, end = ('', '', '')
     # Check if there are valid coordinates
@@ -315,25 +620,25 @@ def region_search(context, request):
         )
 
     # Search for peaks for the coordinates we got
-    try:
-        # including inner hits is very slow
-        # figure out how to distinguish browser requests from .embed method requests
-        if 'peak_metadata' in request.query_string:
-            peak_query = get_peak_query(start, end, with_inner_hits=True, within_peaks=region_inside_peak_status)
-        else:
-            peak_query = get_peak_query(start, end, within_peaks=region_inside_peak_status)
-        peak_results = snp_es.search(body=peak_query,
-                                     index=chromosome.lower(),
-                                     doc_type=_GENOME_TO_ALIAS[assembly],
-                                     size=99999)
-    except Exception:
-        result['notification'] = 'Error during search'
-        return result
-    file_uuids = []
-    for hit in peak_results['hits']['hits']:
-        if hit['_id'] not in file_uuids:
-            file_uuids.append(hit['_id'])
-    file_uuids = list(set(file_uuids))
+    # Peaks themselves are only needed for peak_metadata: everything else only needs the files
+    # figure out how to distinguish browser requests from .embed method requests
+    with_peaks = 'peak_metadata' in request.query_string
+    cache = request.registry.get(REGION_SEARCH_CACHE)
+    cache_key = cached = cache_cycle = None
+    if cache is not None and size <= _RESULT_CACHE_MAX_LIMIT:
+        cache_key = cache.key(request, result['assembly'], result['coordinates'], size, with_peaks)
+        (cache_cycle, cached) = cache.lookup(cache_key, result['assembly'])
+    if cached is not None:
+        (file_uuids, peaks) = (cached['file_uuids'], cached['peaks'])
+    else:
+        try:
+            peak_results = search_peaks(request, assembly, chromosome, start, end, with_peaks,
+                                        within_peaks=region_inside_peak_status)
+        except Exception:
+            result['notification'] = 'Error during search'
+            return result
+        file_uuids = get_peak_file_uuids(peak_results)
+        peaks = list(peak_results.get('hits', {}).get('hits', []))
     result['notification'] = 'No results found'
 
 
@@ -345,6 +650,9 @@ def region_search(context, request):
         file_uuids = file_uuids[:MAX_CLAUSES_FOR_ES]
         uuid_count = len(file_uuids)
 
+    if cached is None and cache_key is not None and not uuid_count:
+        cache.store(cache_key, cache_cycle, {'file_uuids': [], 'peaks': peaks, 'experiments': None})
+
     if uuid_count:
         query = get_filtered_query('', [], set(), principals, ['Experiment'])
         del query['query']
@@ -357,13 +665,22 @@ def region_search(context, request):
         used_filters['files.uuid'] = file_uuids
         query['aggs'] = set_facets(_FACETS, used_filters, principals, ['Experiment'])
         schemas = (types[item_type].schema for item_type in ['Experiment'])
-        es_results = es.search(
-            body=query, index='experiment', doc_type='experiment', size=size, request_timeout=60
-        )
+        if cached is not None:
+            es_results = cached['experiments']
+        else:
+            es_results = es.search(
+                body=query, index='experiment', doc_type='experiment', size=size, request_timeout=60
+            )
+            if cache_key is not None:
+                cache.store(cache_key, cache_cycle, {
+                    'file_uuids': file_uuids,
+                    'peaks': peaks,
+                    'experiments': es_results
+                })
         result['@graph'] = list(format_results(request, es_results['hits']['hits']))
         result['total'] = total = es_results['hits']['total']
         result['facets'] = format_facets(es_results, _FACETS, used_filters, schemas, total, principals)
-        result['peaks'] = list(peak_results['hits']['hits'])
+        result['peaks'] = peaks
         result['download_elements'] = get_peak_metadata_links(request)
         if result['total'] > 0:
             result['notification'] = 'Success'
@@ -373,6 +690,292 @@ def region_search(context, request):
     return result
 
 
+def search_peaks(request, assembly, chromosome, start, end, with_peaks=False, within_peaks=False):
+    '''
+    Returns regions es (or interval index) results for peaks overlapping coordinates.
+    Only the file_uuids aggregation unless with_peaks, since only peak_metadata needs positions.
+    '''
+    interval_index = request.registry.get(INTERVAL_INDEX)
+    if interval_index is not None:
+        # the local index always has peak positions, so peak_metadata costs nothing extra
+        return get_interval_peak_results(interval_index, _GENOME_TO_ALIAS[assembly],
+                                         chromosome.lower(), start, end)
+    snp_es = request.registry['snp_search']
+    binned = request.registry.settings.get('region_search.layout', NESTED_LAYOUT) == BINNED_LAYOUT
+    index = binned_index(chromosome.lower()) if binned else chromosome.lower()
+    if with_peaks:
+        # including inner hits is very slow
+        if binned:
+            peak_query = get_binned_peak_query(start, end, with_positions=True)
+        else:
+            peak_query = get_peak_query(start, end, with_inner_hits=True, within_peaks=within_peaks)
+        peak_results = snp_es.search(
+            body=peak_query, index=index, doc_type=_GENOME_TO_ALIAS[assembly], size=99999
+        )
+        if binned:
+            format_binned_peak_hits(peak_results['hits']['hits'], chromosome.lower(), start, end)
+        return peak_results
+    if binned:
+        peak_query = get_binned_peak_query(start, end)
+    else:
+        peak_query = get_peak_query(start, end, within_peaks=within_peaks)
+    # One more than can be used, so a truncated list is noticed
+    peak_query = get_file_uuids_query(peak_query, MAX_CLAUSES_FOR_ES + 1)
+    return snp_es.search(body=peak_query, index=index, doc_type=_GENOME_TO_ALIAS[assembly], size=0,
+                         filter_path=['aggregations.file_uuids.buckets.key'])
+
+
+def parse_batch_regions(request):
+    '''
+    Returns the regions of a batch region search: a JSON body of {"regions": [...]} or BED text,
+    posted as the body or uploaded as the 'file' form field
+    '''
+    if request.content_type == 'application/json':
+        try:
+            regions = request.json_body.get('regions')
+        except (ValueError, AttributeError):
+            raise HTTPBadRequest(explanation='Expected a JSON object with a list of regions')
+        if not isinstance(regions, list):
+            raise HTTPBadRequest(explanation='Expected a JSON object with a list of regions')
+        return [str(region) for region in regions]
+    if request.content_type == 'multipart/form-data':
+        upload = request.POST.get('file')
+        if upload is None or not hasattr(upload, 'file'):
+            raise HTTPBadRequest(explanation='Expected a BED file upload named file')
+        text = upload.file.read().decode('utf-8')
+    else:
+        text = request.text
+    regions = []
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith('#') or fields[0] in ('track', 'browser'):
+            continue
+        try:
+            start, end = int(fields[1]), int(fields[2])
+        except (IndexError, ValueError):
+            raise HTTPBadRequest(explanation='Invalid BED line: {}'.format(line))
+        # BED is 0-based and half open, region search coordinates are 1-based
+        regions.append('{}:{}-{}'.format(fields[0], start + 1, end))
+    return regions
+
+
+def search_peak_file_uuids(request, assembly, coordinates):
+    '''
+    Returns the distinct file uuids with peaks overlapping each of (chromosome, start, end),
+    from the local interval index or with one msearch to regions es
+    '''
+    interval_index = request.registry.get(INTERVAL_INDEX)
+    if interval_index is not None:
+        return [
+            list(interval_index.overlaps(assembly, chromosome, int(start), int(end)))
+            for (chromosome, start, end) in coordinates
+        ]
+    binned = request.registry.settings.get('region_search.layout', NESTED_LAYOUT) == BINNED_LAYOUT
+    body = []
+    for (chromosome, start, end) in coordinates:
+        if binned:
+            peak_query = get_binned_peak_query(start, end)
+        else:
+            peak_query = get_peak_query(start, end)
+        peak_query = get_file_uuids_query(peak_query, MAX_CLAUSES_FOR_ES)
+        peak_query['size'] = 0
+        body.append({
+            'index': binned_index(chromosome) if binned else chromosome,
+            'type': assembly
+        })
+        body.append(peak_query)
+    responses = request.registry['snp_search'].msearch(body=body)['responses']
+    # A chromosome without peaks has no index, which is an error for that region alone
+    return [[] if 'error' in response else get_peak_file_uuids(response) for response in responses]
+
+
+def search_experiments_of_files(request, file_uuids):
+    '''
+    Returns {file uuid: experiment} of the experiments the user may view with any of the files
+    '''
+    es = request.registry[ELASTIC_SEARCH]
+    principals = request.effective_principals
+    experiments = {}
+    file_uuids = list(file_uuids)
+    for i in range(0, len(file_uuids), MAX_CLAUSES_FOR_ES):
+        chunk = file_uuids[i:i + MAX_CLAUSES_FOR_ES]
+        query = {
+            'query': {
+                'bool': {
+                    'filter': [
+                        {'terms': {'embedded.files.uuid': chunk}},
+                        {'terms': {'principals_allowed.view': principals}},
+                        {'terms': {'embedded.@type': ['Experiment']}}
+                    ]
+                }
+            },
+            '_source': _BATCH_EXPERIMENT_FIELDS
+        }
+        # A file belongs to one experiment, so there are never more experiments than files
+        es_results = es.search(
+            body=query, index='experiment', doc_type='experiment', size=len(chunk),
+            request_timeout=60
+        )
+        wanted = set(chunk)
+        for hit in es_results['hits']['hits']:
+            experiment = hit['_source']['embedded']
+            for afile in experiment.get('files', []):
+                if afile['uuid'] in wanted:
+                    experiments[afile['uuid']] = experiment
+    return experiments
+
+
+def batch_region_results(request, regions, assembly):
+    '''
+    Yields ('experiment', experiment) the first time an experiment is found, and ('region', result)
+    for every region.  Regions are resolved and searched a chunk at a time, so results stream
+    before the whole batch is resolved, and are grouped by chromosome within each chunk.
+    '''
+    resolver = request.registry[COORDINATE_RESOLVER]
+    experiments = {}  # file uuid: experiment, of every file seen so far
+    emitted = set()
+    for i in range(0, len(regions), _BATCH_CHUNK_SIZE):
+        chunk = []
+        for region in regions[i:i + _BATCH_CHUNK_SIZE]:
+            coordinates = resolve_region(resolver, region, assembly)
+            if not all(coordinates):
+                yield ('region', {'region': region, 'notification': 'No annotations found'})
+                continue
+            (chromosome, start, end) = coordinates
+            chunk.append((chromosome.lower(), int(start), int(end), region))
+        if not chunk:
+            continue
+        chunk.sort()
+        coordinates = [(chromosome, start, end) for (chromosome, start, end, _) in chunk]
+        chunk_file_uuids = search_peak_file_uuids(request, _GENOME_TO_ALIAS[assembly], coordinates)
+        new_file_uuids = set(uuid for uuids in chunk_file_uuids for uuid in uuids)
+        new_file_uuids -= set(experiments)
+        found = search_experiments_of_files(request, new_file_uuids)
+        for uuid in new_file_uuids:
+            experiments[uuid] = found.get(uuid)  # None if no experiment the user may view
+        for ((chromosome, start, end, region), file_uuids) in zip(chunk, chunk_file_uuids):
+            files = []
+            for uuid in sorted(file_uuids):
+                experiment = experiments[uuid]
+                if experiment is None:
+                    continue
+                if experiment['@id'] not in emitted:
+                    emitted.add(experiment['@id'])
+                    yield ('experiment', {k: v for k, v in experiment.items() if k != 'files'})
+                accession = next(
+                    f.get('accession') for f in experiment['files'] if f['uuid'] == uuid
+                )
+                files.append({
+                    'uuid': uuid, 'accession': accession, 'experiment': experiment['@id']
+                })
+            yield ('region', {
+                'region': region,
+                'coordinates': '{}:{}-{}'.format(chromosome, start, end),
+                'files': files,
+                'notification': 'Success' if files else 'No results found'
+            })
+
+
+def batch_region_ndjson(results):
+    for (kind, item) in results:
+        types = ['Experiment'] if kind == 'experiment' else ['region-search']
+        item = dict(item, **{'@type': types})
+        yield (json.dumps(item) + '\n').encode('utf-8')
+
+
+def batch_region_tsv(results):
+    experiments = {}
+    fout = io.StringIO()
+    writer = csv.writer(fout, delimiter='\t')
+    writer.writerow(_BATCH_TSV_HEADER)
+    for (kind, item) in results:
+        if kind == 'experiment':
+            experiments[item['@id']] = item
+            continue
+        if not item.get('files'):
+            writer.writerow([item['region'], item.get('coordinates', '')] + [''] * 5)
+        for afile in item.get('files', []):
+            experiment = experiments[afile['experiment']]
+            writer.writerow([
+                item['region'],
+                item['coordinates'],
+                afile['accession'],
+                experiment.get('accession'),
+                experiment.get('assay_term_name'),
+                experiment.get('target', {}).get('label'),
+                experiment.get('biosample_ontology', {}).get('term_name')
+            ])
+        if fout.tell() > 64 * 1024:
+            yield fout.getvalue().encode('utf-8')
+            fout.seek(0)
+            fout.truncate()
+    yield fout.getvalue().encode('utf-8')
+
+
+@view_config(route_name='region-search-batch', request_method='POST', permission='search')
+def region_search_batch(context, request):
+    """
+    Search files by many regions at once. Streams NDJSON, or TSV with format=tsv.
+    """
+    assembly = request.params.get('genome', 'GRCh38')
+    if assembly not in _GENOME_TO_ALIAS:
+        raise HTTPBadRequest(explanation='Unknown genome: {}'.format(assembly))
+    regions = parse_batch_regions(request)
+    if len(regions) > _BATCH_MAX_REGIONS:
+        raise HTTPBadRequest(
+            explanation='At most {} regions may be searched at once'.format(_BATCH_MAX_REGIONS)
+        )
+    results = batch_region_results(request, regions, assembly)
+    if request.params.get('format') == 'tsv':
+        return Response(
+            content_type='text/tsv',
+            app_iter=batch_region_tsv(results),
+            content_disposition='attachment;filename="%s"' % 'region_search.tsv'
+        )
+    return Response(
+        content_type='application/x-ndjson',
+        app_iter=batch_region_ndjson(results)
+    )
+
+
+def get_suggest_query(text, genome, size=_SUGGEST_SIZE):
+    """
+    return completion query for the annotations of one genome assembly
+    """
+    return {
+        "suggest": {
+            "default-suggest": {
+                "text": text,
+                "completion": {
+                    "field": "suggest",
+                    "size": size,
+                    "contexts": {
+                        "assembly": [genome]
+                    }
+                }
+            }
+        }
+    }
+
+
+def get_suggestions(es, text, requested_genome):
+    """
+    Returns annotation suggestions for a genome assembly, asking for no more than are shown
+    """
+    try:
+        results = es.search(index='annotations', body=get_suggest_query(text, requested_genome))
+    except RequestError:
+        # Annotations indexed before the suggest contexts were added: ask for plenty and filter here
+        query = get_suggest_query(text, requested_genome, size=100)
+        del query['suggest']['default-suggest']['completion']['contexts']
+        results = es.search(index='annotations', body=query)
+        species = _GENOME_TO_SPECIES[requested_genome].replace('_', ' ')
+        options = results['suggest']['default-suggest'][0]['options']
+        options = [item for item in options if item['_source']['payload']['species'] == species]
+        return options[:_SUGGEST_SIZE]
+    return results['suggest']['default-suggest'][0]['options'][:_SUGGEST_SIZE]
+
+
 @view_config(route_name='suggest', request_method='GET', permission='search')
 def suggest(context, request):
     text = ''
@@ -388,30 +991,20 @@ def suggest(context, request):
         'title': 'Suggest',
         '@graph': [],
     }
-    es = request.registry[ELASTIC_SEARCH]
-    query = {
-        "suggest": {
-            "default-suggest": {
-                "text": text,
-                "completion": {
-                    "field": "suggest",
-                    "size": 100
-                }
-            }
-        }
-    }
-    try:
-        results = es.search(index='annotations', body=query)
-    except:
-        return result
-    else:
-        result['@id'] = '/suggest/?' + urlencode({'genome': requested_genome, 'q': text}, ['q','genome'])
-        result['@graph'] = []
-        for item in results['suggest']['default-suggest'][0]['options']:
-            if _GENOME_TO_SPECIES[requested_genome].replace('_', ' ') == item['_source']['payload']['species']:
-                result['@graph'].append(item)
-        result['@graph'] = result['@graph'][:10]
+    if requested_genome not in _GENOME_TO_SPECIES:
         return result
+    cache = request.registry[SUGGEST_CACHE]
+    cache_key = (requested_genome, text.lower())
+    suggestions = cache.get(cache_key)
+    if suggestions is None:
+        es = request.registry[ELASTIC_SEARCH]
+        try:
+            suggestions = get_suggestions(es, text, requested_genome)
+        except:
+            return result
+        cache.set(cache_key, suggestions)
+    result['@graph'] = copy.deepcopy(suggestions)
+    return result
 
 
 def format_facets(
@@ -194,7 +194,8 @@ class MetadataReport:
 
     def _get_search_results_generator(self):
         return BatchedSearchGenerator(
-            self._build_new_request()
+            self._build_new_request(),
+            prefetch=True
         ).results()
 
     def _should_not_report_file(self, file_):
@@ -410,7 +411,7 @@ class PublicationDataMetadataReport(MetadataReport):
 
     def _get_file_search_results_generator(self):
         request = self._build_new_file_request()
-        bsg = BatchedSearchGenerator(request)
+        bsg = BatchedSearchGenerator(request, prefetch=True)
         return bsg.results()
 
     # Overrides parent.
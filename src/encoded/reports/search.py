@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from encoded.search_views import search_generator
+from pyramid.threadlocal import manager
 from snovault.elasticsearch.searches.parsers import QueryString
 
 
@@ -9,10 +11,13 @@ class BatchedSearchGenerator:
         ('limit', 'all')
     ]
 
-    def __init__(self, request, batch_field='@id', batch_size=5000):
+    def __init__(self, request, batch_field='@id', batch_size=5000, prefetch=False):
         self.request = request
         self.batch_field = batch_field
         self.batch_size = batch_size
+        # Search for the next batch on a background thread while this one is consumed.
+        # At most two batches are held at once: the one consumed and the one searched for.
+        self.prefetch = prefetch
         self.query_string = QueryString(request)
         self.param_list = self.query_string.group_values_by_key()
         self.batch_param_values = self.param_list.get(batch_field, []).copy()
@@ -39,10 +44,38 @@ class BatchedSearchGenerator:
         request.registry = self.request.registry
         return request
 
+    def _make_batched_requests(self):
+        for batched_values in self._make_batched_values_from_batch_param_values():
+            batched_params = self._make_batched_params_from_batched_values(batched_values)
+            yield self._build_new_request(batched_params)
+
+    def _search_batch(self, request):
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            return list(search_generator(request)['@graph'])
+        finally:
+            manager.pop()
+
+    def _prefetched_results(self, requests):
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            request = next(requests, None)
+            future = pool.submit(self._search_batch, request) if request is not None else None
+            while future is not None:
+                batch = future.result()
+                request = next(requests, None)
+                future = pool.submit(self._search_batch, request) if request is not None else None
+                yield from batch
+                del batch
+        finally:
+            pool.shutdown(wait=False)
+
     def results(self):
         if not self.batch_param_values:
             yield from search_generator(self._build_new_request([]))['@graph']
-        for batched_values in self._make_batched_values_from_batch_param_values():
-            batched_params = self._make_batched_params_from_batched_values(batched_values)
-            request = self._build_new_request(batched_params)
+        requests = self._make_batched_requests()
+        if self.prefetch:
+            yield from self._prefetched_results(requests)
+            return
+        for request in requests:
             yield from search_generator(request)['@graph']
@@ -4,6 +4,9 @@ from encoded.tests.features.conftest import app, app_settings, index_workbook
 from encoded.batch_download import lookup_column_value
 from encoded.batch_download import format_row
 from encoded.batch_download import _convert_camel_to_snake
+from encoded.batch_download import peak_metadata_json
+from encoded.batch_download import peak_metadata_tsv
+from encoded.batch_download import get_peak_metadata_rows
 
 
 pytestmark = [
@@ -30,6 +33,49 @@ def test_convert_camel_to_snake_with_one_words():
     assert expected == target
 
 
+def _peak_metadata_inputs():
+    columns_by_file = {
+        'file-1': {
+            'assay_term_name': 'ChIP-seq',
+            'target.label': 'CTCF',
+            'biosample.accession': 'ENCBS000AAA, ENCBS000AAB',
+            'file.accession': 'ENCFF000AAA',
+            'experiment.accession': 'ENCSR000AAA',
+        }
+    }
+    positions = [{'_source': {'start': start, 'end': start + 10}} for start in (100, 200, 300)]
+    inner_hits = {'positions': {'hits': {'hits': positions}}}
+    peaks = [
+        {'_id': 'file-1:1', '_index': 'chr1', 'inner_hits': inner_hits},
+        {'_id': 'file-2', '_index': 'chr1', 'inner_hits': inner_hits},
+    ]
+    return (peaks, columns_by_file)
+
+
+def test_batch_download_peak_metadata_tsv(monkeypatch):
+    monkeypatch.setattr('encoded.batch_download.PEAK_METADATA_ROWS_PER_CHUNK', 2)
+    (peaks, columns_by_file) = _peak_metadata_inputs()
+    chunks = list(peak_metadata_tsv(get_peak_metadata_rows(peaks, columns_by_file)))
+    assert len(chunks) == 2
+    lines = b''.join(chunks).decode('utf-8').splitlines()
+    assert len(lines) == 4
+    assert lines[1].split('\t') == [
+        'ChIP-seq', 'chr1:100-110', 'CTCF', 'ENCBS000AAA, ENCBS000AAB', 'ENCFF000AAA', 'ENCSR000AAA'
+    ]
+
+
+def test_batch_download_peak_metadata_json(monkeypatch):
+    import json
+    monkeypatch.setattr('encoded.batch_download.PEAK_METADATA_ROWS_PER_CHUNK', 2)
+    (peaks, columns_by_file) = _peak_metadata_inputs()
+    doc = json.loads(b''.join(peak_metadata_json(peaks, columns_by_file)).decode('utf-8'))
+    assert list(doc) == ['ChIP-seq']
+    assert [peak['coordinates'] for peak in doc['ChIP-seq']] == [
+        'chr1:100-110', 'chr1:200-210', 'chr1:300-310'
+    ]
+    assert doc['ChIP-seq'][0]['biosample.accession'] == ['ENCBS000AAA', 'ENCBS000AAB']
+
+
 def test_batch_download_report_download(testapp, index_workbook):
     res = testapp.get('/report.tsv?type=Experiment&sort=accession')
     assert res.headers['content-type'] == 'text/tsv; charset=UTF-8'
@@ -0,0 +1,12 @@
+def test_lru_cache():
+    from encoded.cache import LRUCache
+    cache = LRUCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None  # least recently used
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    expired = LRUCache(2, -1)
+    expired.set('a', 1)
+    assert expired.get('a') is None
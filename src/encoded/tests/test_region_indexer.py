@@ -0,0 +1,189 @@
+import gzip
+
+
+def _gzip_chunks(text, chunk_size=7):
+    data = gzip.compress(text.encode('utf-8'))
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def test_region_indexer_gunzip_lines():
+    from encoded.region_indexer import gunzip_lines
+    text = 'chr1\t10\t20\nchr2\t30\t40\nchr1\t50\t60'
+    assert list(gunzip_lines(_gzip_chunks(text))) == text.split('\n')
+
+
+def test_region_indexer_gunzip_lines_multiple_members():
+    from encoded.region_indexer import gunzip_lines
+    data = gzip.compress(b'chr1\t10\t20\nchr1\t3') + gzip.compress(b'0\t40\n')
+    assert list(gunzip_lines([data])) == ['chr1\t10\t20', 'chr1\t30\t40']
+
+
+def test_region_indexer_bed_regions():
+    from encoded.region_indexer import bed_regions
+    lines = ['track name=peaks', '#comment', 'Chr1\t10\t20\tpeak1', 'chrX\t30\t40']
+    assert list(bed_regions(lines)) == [('chr1', 11, 21), ('chrx', 31, 41)]
+
+
+def test_region_indexer_region_batches():
+    from encoded.region_indexer import region_batches
+    regions = [('chr1', i, i + 1) for i in range(5)] + [('chr2', 1, 2)]
+    batches = [
+        (chrom, part, len(positions)) for (chrom, part, positions) in region_batches(regions, 2)
+    ]
+    assert batches == [
+        ('chr1', 0, 2),
+        ('chr1', 1, 2),
+        ('chr1', 2, 1),
+        ('chr2', 0, 1),
+    ]
+
+
+def test_region_indexer_region_doc_id():
+    from encoded.region_indexer import region_doc_id, region_doc_uuid
+    uuid = 'd5bc8d9a-ab29-4a09-b3e6-4a1c3f7a53b7'
+    assert region_doc_id(uuid) == uuid
+    assert region_doc_id(uuid, 3) == uuid + ':3'
+    assert region_doc_uuid(region_doc_id(uuid, 3)) == uuid
+    assert region_doc_uuid(uuid) == uuid
+
+
+def test_region_indexer_peak_file_cache(tmpdir):
+    import hashlib
+    from encoded.region_indexer import PeakFileCache, file_chunks
+    cache = PeakFileCache(str(tmpdir), 10)
+    first = b'12345678'
+    first_md5 = hashlib.md5(first).hexdigest()
+    assert cache.open(first_md5) is None
+    assert b''.join(cache.tee(first_md5, [first[:4], first[4:]])) == first
+    assert b''.join(file_chunks(cache.open(first_md5), 3)) == first
+    second = b'abcdef'
+    second_md5 = hashlib.md5(second).hexdigest()
+    list(cache.tee(second_md5, [second]))
+    # Over the size cap, so the least recently used file is evicted
+    assert cache.open(first_md5) is None
+    assert b''.join(file_chunks(cache.open(second_md5))) == second
+    # Reloading picks up what is on disk
+    assert PeakFileCache(str(tmpdir), 10).size == len(second)
+
+
+def test_region_indexer_peak_file_cache_miss_when_removed_elsewhere(tmpdir):
+    import hashlib
+    import os
+    from encoded.region_indexer import PeakFileCache
+    cache = PeakFileCache(str(tmpdir), 100)
+    data = b'12345678'
+    md5sum = hashlib.md5(data).hexdigest()
+    list(cache.tee(md5sum, [data]))
+    os.remove(cache.file_path(md5sum))
+    assert cache.open(md5sum) is None
+    assert cache.size == 0
+
+
+def test_region_indexer_peak_file_cache_rejects_bad_md5sum(tmpdir):
+    from encoded.region_indexer import PeakFileCache
+    cache = PeakFileCache(str(tmpdir), 100)
+    md5sum = '0' * 32
+    assert b''.join(cache.tee(md5sum, [b'not what was promised'])) == b'not what was promised'
+    assert cache.open(md5sum) is None
+    assert cache.size == 0
+
+
+def test_region_indexer_file_fingerprint():
+    from encoded.region_indexer import file_fingerprint
+    afile = {'md5sum': 'abc', 'file_format': 'bed', 'output_type': 'peaks', 'status': 'released'}
+    fingerprint = file_fingerprint(afile)
+    assert file_fingerprint(dict(afile)) == fingerprint
+    assert file_fingerprint(dict(afile, status='revoked')) != fingerprint
+    assert file_fingerprint(dict(afile, md5sum='def')) != fingerprint
+
+
+def test_region_indexer_region_bin():
+    from encoded.region_indexer import region_bin
+    assert region_bin(0, 0) == 585
+    assert region_bin(1 << 17, (1 << 17) + 100) == 586
+    # straddles two 128kb bins, so falls to the 1Mb level
+    assert region_bin((1 << 17) - 1, 1 << 17) == 73
+    assert region_bin(0, (1 << 29) - 1) == 0
+
+
+def test_region_indexer_overlapping_bins_holds_every_overlapping_region():
+    import random
+    from encoded.region_indexer import overlapping_bins, region_bin
+    rng = random.Random(3)
+    for _ in range(200):
+        start = rng.randint(0, 1 << 28)
+        end = start + rng.choice([0, 100, 1 << 17, 1 << 20])
+        bins = set(overlapping_bins(start, end))
+        peak_start = rng.randint(start - 1000, end)
+        peak_end = max(peak_start, start) + rng.randint(0, 1 << 18)
+        assert region_bin(peak_start, peak_end) in bins
+
+
+def test_region_indexer_bin_batches():
+    from encoded.region_indexer import bin_batches
+    regions = [('chr1', 10, 20), ('chr2', 5, 6), ('chr1', 1 << 17, (1 << 17) + 5), ('chr1', 30, 40)]
+    assert list(bin_batches(regions)) == [
+        ('chr1', 585, [{'start': 10, 'end': 20}, {'start': 30, 'end': 40}]),
+        ('chr1', 586, [{'start': 1 << 17, 'end': (1 << 17) + 5}]),
+        ('chr2', 585, [{'start': 5, 'end': 6}]),
+    ]
+
+
+class DummyRegionsES(object):
+    def __init__(self):
+        self.docs = {}
+
+    def index(self, index, doc_type, body, id):
+        self.docs[(index, id)] = body
+
+
+class KnownMappings(object):
+    def __contains__(self, key):
+        return True
+
+
+def _bulk_loading_indexer(monkeypatch, fail_id=None):
+    from encoded.region_indexer import RegionIndexer
+    indexer = RegionIndexer.__new__(RegionIndexer)
+    indexer.layout = None
+    indexer.bulk_ingest = True
+    indexer.bulk_chunk_size = 2
+    indexer.bulk_max_chunk_bytes = 1 << 20
+    indexer.interval_index = None
+    indexer.known_mappings = KnownMappings()
+    indexer.residents_index = 'resident_regionsets'
+    indexer.regions_es = DummyRegionsES()
+
+    def bulk(es, actions, chunk_size, max_chunk_bytes, raise_on_error=True):
+        errors = []
+        for action in actions:
+            key = (action['_index'], action['_id'])
+            if action.get('_op_type') == 'delete':
+                es.docs.pop(key, None)
+            elif action['_id'] == fail_id:
+                errors.append({'index': {'_id': fail_id, 'status': 429}})
+            else:
+                es.docs[key] = action['_source']
+        return (len(es.docs), errors)
+
+    monkeypatch.setattr('encoded.region_indexer.bulk', bulk)
+    return indexer
+
+
+def test_region_indexer_load_regions_resident_once_loaded(monkeypatch):
+    indexer = _bulk_loading_indexer(monkeypatch)
+    batches = [('chr1', 0, [{'start': 1, 'end': 2}]), ('chr1', 1, [{'start': 3, 'end': 4}])]
+    assert indexer.load_regions('uuid', 'hg19', 'ChIP-seq', iter(batches))
+    assert sorted(indexer.regions_es.docs) == [
+        ('chr1', 'uuid'),
+        ('chr1', 'uuid:1'),
+        ('resident_regionsets', 'uuid'),
+    ]
+    assert indexer.regions_es.docs[('resident_regionsets', 'uuid')]['parts'] == {'chr1': 2}
+
+
+def test_region_indexer_load_regions_not_resident_when_any_fail(monkeypatch):
+    indexer = _bulk_loading_indexer(monkeypatch, fail_id='uuid:2')
+    batches = [('chr1', part, [{'start': part, 'end': part + 1}]) for part in range(4)]
+    assert not indexer.load_regions('uuid', 'hg19', 'ChIP-seq', iter(batches))
+    assert indexer.regions_es.docs == {}
@@ -0,0 +1,87 @@
+import random
+
+
+def _brute_overlaps(files, start, end):
+    results = {}
+    for uuid, positions in files.items():
+        for (peak_start, peak_end) in positions:
+            if peak_start <= end and peak_end >= start:
+                results.setdefault(uuid, []).append((peak_start, peak_end))
+    return {uuid: sorted(positions) for uuid, positions in results.items()}
+
+
+def _add(index, uuid, positions):
+    batches = [('chr1', 0, [{'start': start, 'end': end} for (start, end) in positions])]
+    assert list(index.tee('hg19', uuid, batches)) == batches
+
+
+def test_region_intervals_length_class():
+    from encoded.region_intervals import length_class
+    assert length_class(10, 10) == 0
+    assert length_class(10, 11) == 1
+    assert length_class(10, 14) == length_class(10, 17)
+    assert length_class(10, 17) < length_class(10, 18)
+
+
+def test_region_intervals_overlaps(tmpdir):
+    from encoded.region_intervals import IntervalIndex
+    index = IntervalIndex(str(tmpdir))
+    rng = random.Random(7)
+    files = {}
+    for n in range(5):
+        positions = []
+        for _ in range(500):
+            start = rng.randint(1, 100000)
+            positions.append((start, start + rng.choice([1, 50, 300, 5000])))
+        files['file-%d' % n] = positions
+        _add(index, 'file-%d' % n, positions)
+    assert index.overlaps('hg19', 'chr1', 1, 100) == {}  # nothing until segments are merged
+    assert index.compact() == 1
+    assert index.compact() == 0
+    for _ in range(50):
+        start = rng.randint(1, 100000)
+        end = start + rng.randint(0, 1000)
+        found = index.overlaps('hg19', 'chr1', start, end)
+        found = {uuid: sorted(positions) for uuid, positions in found.items()}
+        assert found == _brute_overlaps(files, start, end)
+
+
+def test_region_intervals_remove_file(tmpdir):
+    from encoded.region_intervals import IntervalIndex
+    index = IntervalIndex(str(tmpdir))
+    _add(index, 'first', [(100, 200)])
+    _add(index, 'second', [(150, 160), (1000, 1001)])
+    index.compact()
+    assert set(index.overlaps('hg19', 'chr1', 155, 155)) == {'first', 'second'}
+    index.remove_file('hg19', 'first', ['chr1'])
+    assert index.stale_chroms('hg19') == ['chr1']
+    index.compact()
+    assert index.overlaps('hg19', 'chr1', 155, 155) == {'second': [(150, 160)]}
+    index.remove_file('hg19', 'second', ['chr1'])
+    index.compact()
+    assert index.open('hg19', 'chr1') is None
+
+
+def test_region_intervals_tee_merges_batches(tmpdir):
+    from encoded.region_intervals import IntervalIndex
+    index = IntervalIndex(str(tmpdir))
+    rng = random.Random(11)
+    positions = {'chr1': [], 'chr2': []}
+    batches = []
+    for part in range(6):
+        chrom = 'chr1' if part % 2 else 'chr2'
+        batch = []
+        for _ in range(200):
+            start = rng.randint(1, 50000)
+            batch.append((start, start + rng.choice([0, 20, 700])))
+        positions[chrom].extend(batch)
+        batches.append((chrom, part, [{'start': start, 'end': end} for (start, end) in batch]))
+    assert list(index.tee('hg19', 'file', iter(batches))) == batches
+    index.compact()
+    for chrom in positions:
+        for _ in range(30):
+            start = rng.randint(1, 50000)
+            end = start + rng.randint(0, 500)
+            found = index.overlaps('hg19', chrom, start, end)
+            found = {uuid: sorted(hits) for uuid, hits in found.items()}
+            assert found == _brute_overlaps({'file': positions[chrom]}, start, end)
@@ -0,0 +1,188 @@
+def test_region_search_peak_file_uuids_from_aggregation():
+    from encoded.region_search import get_peak_file_uuids
+    peak_results = {'aggregations': {'file_uuids': {'buckets': [{'key': 'a'}, {'key': 'b'}]}}}
+    assert get_peak_file_uuids(peak_results) == ['a', 'b']
+    assert get_peak_file_uuids({}) == []  # filter_path drops empty aggregations
+
+
+def test_region_search_peak_file_uuids_from_hits():
+    from encoded.region_search import get_peak_file_uuids
+    peak_results = {'hits': {'hits': [{'_id': 'a'}, {'_id': 'a:1'}, {'_id': 'b:b585'}]}}
+    assert sorted(get_peak_file_uuids(peak_results)) == ['a', 'b']
+
+
+def test_region_search_file_uuids_query():
+    from encoded.region_search import get_file_uuids_query, get_peak_query
+    query = get_file_uuids_query(get_peak_query(10, 20), 5)
+    assert query['aggs']['file_uuids']['terms'] == {'field': 'uuid', 'size': 5}
+    assert query['_source'] is False
+
+
+def test_region_search_coordinate_resolver_table(tmpdir):
+    from encoded.region_search import CoordinateResolver
+    table = tmpdir.join('coordinates.tsv')
+    table.write('#id\tassembly\tchromosome\tstart\tend\nrs10\tGRCh38\tchr7\t92754574\t92754574\n')
+    resolver = CoordinateResolver(table_path=str(table))
+
+    def lookup(id, assembly):
+        raise AssertionError('Ensembl should not be asked')
+
+    assert resolver.resolve('RS10', 'GRCh38', lookup) == ('chr7', '92754574', '92754574')
+
+
+def test_region_search_coordinate_resolver_cache():
+    from encoded.region_search import CoordinateResolver
+    resolver = CoordinateResolver(cache_size=1, ttl=60)
+    calls = []
+
+    def lookup(id, assembly):
+        calls.append(id)
+        return ('', '', '') if id == 'missing' else ('chr1', '10', '20')
+
+    assert resolver.resolve('rs1', 'GRCh38', lookup) == ('chr1', '10', '20')
+    assert resolver.resolve('rs1', 'GRCh38', lookup) == ('chr1', '10', '20')
+    assert calls == ['rs1']
+    resolver.resolve('missing', 'GRCh38', lookup)
+    resolver.resolve('missing', 'GRCh38', lookup)
+    assert calls == ['rs1', 'missing', 'missing']  # misses are not remembered
+    resolver.resolve('rs2', 'GRCh38', lookup)
+    resolver.resolve('rs1', 'GRCh38', lookup)
+    assert calls[-2:] == ['rs2', 'rs1']  # rs1 was evicted by rs2
+
+
+def test_region_search_coordinate_resolver_expires():
+    from encoded.region_search import CoordinateResolver
+    resolver = CoordinateResolver(ttl=-1)
+    calls = []
+
+    def lookup(id, assembly):
+        calls.append(id)
+        return ('chr1', '10', '20')
+
+    resolver.resolve('rs1', 'GRCh38', lookup)
+    resolver.resolve('rs1', 'GRCh38', lookup)
+    assert calls == ['rs1', 'rs1']
+
+
+def _batch_results():
+    experiment = {
+        '@id': '/experiments/ENCSR000AAA/',
+        'accession': 'ENCSR000AAA',
+        'assay_term_name': 'ChIP-seq',
+        'target': {'label': 'CTCF'},
+        'biosample_ontology': {'term_name': 'K562'}
+    }
+    return [
+        ('region', {'region': 'rs0', 'notification': 'No annotations found'}),
+        ('experiment', experiment),
+        ('region', {
+            'region': 'chr1:10-20',
+            'coordinates': 'chr1:10-20',
+            'files': [{
+                'uuid': 'a', 'accession': 'ENCFF000AAA', 'experiment': '/experiments/ENCSR000AAA/'
+            }],
+            'notification': 'Success'
+        }),
+    ]
+
+
+def test_region_search_batch_ndjson():
+    import json
+    from encoded.region_search import batch_region_ndjson
+    lines = b''.join(batch_region_ndjson(_batch_results())).decode('utf-8').splitlines()
+    items = [json.loads(line) for line in lines]
+    assert [item['@type'] for item in items] == [
+        ['region-search'], ['Experiment'], ['region-search']
+    ]
+    assert items[2]['files'][0]['experiment'] == items[1]['@id']
+
+
+def test_region_search_batch_tsv():
+    from encoded.region_search import batch_region_tsv
+    text = b''.join(batch_region_tsv(_batch_results())).decode('utf-8')
+    rows = [line.split('\t') for line in text.splitlines()]
+    assert rows[0][:4] == ['region', 'coordinates', 'file.accession', 'experiment.accession']
+    assert rows[1] == ['rs0', '', '', '', '', '', '']
+    assert rows[2] == [
+        'chr1:10-20', 'chr1:10-20', 'ENCFF000AAA', 'ENCSR000AAA', 'ChIP-seq', 'CTCF', 'K562'
+    ]
+
+
+def test_region_search_batch_resolves_a_chunk_at_a_time(monkeypatch):
+    from types import SimpleNamespace
+    import encoded.region_search as region_search
+    resolved = []
+
+    def resolve_region(resolver, region, assembly):
+        resolved.append(region)
+        return region_search.sanitize_coordinates(region)
+
+    monkeypatch.setattr(region_search, '_BATCH_CHUNK_SIZE', 2)
+    monkeypatch.setattr(region_search, 'resolve_region', resolve_region)
+    monkeypatch.setattr(
+        region_search, 'search_peak_file_uuids',
+        lambda request, assembly, coordinates: [[]] * len(coordinates)
+    )
+    monkeypatch.setattr(region_search, 'search_experiments_of_files', lambda request, uuids: {})
+    request = SimpleNamespace(registry={region_search.COORDINATE_RESOLVER: None})
+    regions = ['chr2:1-2', 'chr1:1-2', 'chr3:1-2']
+    results = region_search.batch_region_results(request, regions, 'GRCh38')
+    first = [next(results), next(results)]
+    assert [item['region'] for (_, item) in first] == ['chr1:1-2', 'chr2:1-2']  # sorted
+    assert resolved == ['chr2:1-2', 'chr1:1-2']
+    assert [item['region'] for (_, item) in results] == ['chr3:1-2']
+
+
+class _DummyRequest(object):
+    def __init__(self, params, principals):
+        self.params = params
+        self.effective_principals = principals
+
+
+def test_region_search_cache_key():
+    from encoded.region_search import RegionSearchCache
+    anonymous = ['system.Everyone']
+
+    def key(params, principals=anonymous):
+        return RegionSearchCache.key(
+            _DummyRequest(params, principals), 'GRCh38', 'chr7:1-2', 25, False
+        )
+
+    by_rsid = key({'region': 'rs10', 'genome': 'GRCh38'})
+    by_coordinates = key({'region': 'chr7:1-2'})
+    assert by_rsid == by_coordinates
+    filtered = key({'region': 'rs10', 'assay_term_name': 'ChIP-seq'})
+    assert filtered != by_rsid
+    admin = key({'region': 'rs10'}, anonymous + ['group.admin'])
+    assert admin != by_rsid
+
+
+def test_region_search_cache_goes_stale_with_region_indexer_cycle():
+    from encoded.region_search import RegionSearchCache
+    cache = RegionSearchCache(registry=None, size=2)
+    cache.checked = float('inf')  # never look at the region indexer state
+    cache.assembly_cycles = {'GRCh38': 1}
+    (cycle, results) = cache.lookup('key', 'GRCh38')
+    assert (cycle, results) == (1, None)
+    cache.store('key', cycle, {'file_uuids': ['a']})
+    assert cache.lookup('key', 'GRCh38') == (1, {'file_uuids': ['a']})
+    cache.assembly_cycles = {'GRCh38': 2}
+    assert cache.lookup('key', 'GRCh38') == (2, None)
+    cache.store('other', 0, {'file_uuids': []})  # nothing changed hg19 yet
+    assert cache.lookup('other', 'hg19') == (0, {'file_uuids': []})
+
+
+def test_region_search_cache_expires():
+    from encoded.region_search import RegionSearchCache
+    cache = RegionSearchCache(registry=None, size=2, ttl=-1)  # expired as soon as stored
+    cache.checked = float('inf')
+    cache.assembly_cycles = {'GRCh38': 1}
+    cache.store('key', 1, {'file_uuids': ['a']})
+    assert cache.lookup('key', 'GRCh38') == (1, None)
+
+
+def test_region_search_suggest_query():
+    from encoded.region_search import get_suggest_query
+    completion = get_suggest_query('ctc', 'GRCh38')['suggest']['default-suggest']['completion']
+    assert completion['size'] == 10
+    assert completion['contexts'] == {'assembly': ['GRCh38']}
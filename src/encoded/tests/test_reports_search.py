@@ -173,3 +173,52 @@ def test_reports_search_batched_search_generator_results(index_workbook, dummy_r
     assert len(results) == 10
     for result in results:
         assert len(result.keys()) == 3
+
+
+def test_reports_search_batched_search_generator_prefetched_results(dummy_request, monkeypatch):
+    import encoded.reports.search
+    from encoded.reports.search import BatchedSearchGenerator
+    searched = []
+
+    def search_generator(request):
+        at_ids = request.params.getall('@id')
+        searched.append(at_ids)
+        return {'@graph': ({'@id': at_id} for at_id in at_ids)}
+
+    monkeypatch.setattr(encoded.reports.search, 'search_generator', search_generator)
+    dummy_request.environ['QUERY_STRING'] = (
+        'type=Experiment&@id=/files/ENCFFABC123/'
+        '&@id=/files/ENCFFABC345/&@id=/files/ENCFFABC567/'
+        '&@id=/files/ENCFFABC789/&@id=/files/ENCFFDEF123/'
+    )
+    bsg = BatchedSearchGenerator(dummy_request, batch_size=2, prefetch=True)
+    results = []
+    for result in bsg.results():
+        results.append(result['@id'])
+        # No more than the batch being consumed and the next one
+        assert len(searched) <= (len(results) - 1) // 2 + 2
+    assert results == [
+        '/files/ENCFFABC123/',
+        '/files/ENCFFABC345/',
+        '/files/ENCFFABC567/',
+        '/files/ENCFFABC789/',
+        '/files/ENCFFDEF123/',
+    ]
+    assert len(searched) == 3
+
+
+def test_reports_search_batched_search_generator_prefetched_match(index_workbook, dummy_request):
+    from encoded.reports.search import BatchedSearchGenerator
+    dummy_request.environ['QUERY_STRING'] = (
+        'type=Experiment'
+        '&@id=/experiments/ENCSR001ADI/'
+        '&@id=/experiments/ENCSR003CON/'
+        '&@id=/experiments/ENCSR000ACY/'
+        '&@id=/experiments/ENCSR001CON/'
+        '&@id=/experiments/ENCSR751STT/'
+        '&field=@id&field=status'
+    )
+    results = list(BatchedSearchGenerator(dummy_request, batch_size=2).results())
+    prefetched = list(BatchedSearchGenerator(dummy_request, batch_size=2, prefetch=True).results())
+    assert len(prefetched) == 5
+    assert prefetched == results
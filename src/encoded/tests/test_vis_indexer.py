@@ -0,0 +1,76 @@
+class DummyState(object):
+    viscached_set = 'vis_viscached'
+
+    def __init__(self):
+        self.lists = {}
+        self.failed = []
+
+    def list_extend(self, name, values):
+        self.lists.setdefault(name, []).extend(values)
+
+    def chunk_failed(self, uuids, error_message, timestamp):
+        self.failed.append((list(uuids), error_message))
+
+
+def make_indexer(update_chunk):
+    from encoded.vis_indexer import VisIndexer
+    indexer = VisIndexer.__new__(VisIndexer)
+    indexer.state = DummyState()
+    indexer.workers = 3
+    indexer.chunk_size = 2
+    indexer.update_chunk = update_chunk
+    return indexer
+
+
+def test_vis_indexer_update_objects_in_chunks(monkeypatch):
+    from pyramid.threadlocal import get_current_request
+    from encoded.tests.test_visualization import DummyRequest, dummy_pool_requests
+    request = DummyRequest()
+    pool_requests = dummy_pool_requests(monkeypatch, 'encoded.vis_indexer')
+
+    def update_chunk(chunk_request, chunk):
+        assert get_current_request() is chunk_request
+        assert chunk_request in pool_requests
+        if 'c' in chunk:
+            return ([{'uuid': 'c', 'error_message': 'gone'}], [], "ConnectionError()")
+        return ([], [uuid for uuid in chunk if uuid != 'b'], None)
+
+    indexer = make_indexer(update_chunk)
+    errors = indexer.update_objects(request, ['a', 'b', 'c', 'd', 'e'], None)
+    assert sorted(error['uuid'] for error in errors) == ['c', 'd']
+    assert sorted(indexer.state.lists['vis_viscached']) == ['a', 'e']
+    assert indexer.state.failed == [(['c', 'd'], "ConnectionError()")]
+    assert len(pool_requests) == 3
+
+
+def test_vis_indexer_update_objects_serially():
+    chunks = []
+
+    def update_chunk(request, chunk):
+        chunks.append(chunk)
+        return ([], chunk, None)
+
+    indexer = make_indexer(update_chunk)
+    indexer.workers = 1
+    assert indexer.update_objects(None, ['a', 'b', 'c'], None) == []
+    assert chunks == [['a', 'b'], ['c']]
+    assert indexer.state.lists['vis_viscached'] == ['a', 'b', 'c']
+
+
+def test_vis_indexer_skip_unchanged():
+    from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+    from encoded.tests.test_visualization import DummyMgetES, DummyRequest
+    from encoded.visualization import VisDataset
+    request = DummyRequest()
+    same = {'accession': 'ENCSR000AAA', 'assembly': ['GRCh38'], 'status': 'released'}
+    edited = {'accession': 'ENCSR001AAA', 'assembly': ['GRCh38'], 'status': 'released'}
+    uncached = {'accession': 'ENCSR002AAA', 'assembly': ['GRCh38'], 'status': 'released'}
+    fields_hash = VisDataset(request).fields_hash(same)
+    request.registry[ELASTIC_SEARCH] = DummyMgetES({
+        'ENCSR000AAA_hg38': {'name': 'ENCSR000AAA', 'fields_hash': fields_hash},
+        'ENCSR001AAA_hg38': {'name': 'ENCSR001AAA', 'fields_hash': fields_hash},
+    })
+    docs = [('a', {'embedded': same}), ('b', {'embedded': edited}), ('c', {'embedded': uncached})]
+    (to_build, unchanged) = make_indexer(None).skip_unchanged(request, docs)
+    assert [uuid for (uuid, doc) in to_build] == ['b', 'c']
+    assert unchanged == ['a']
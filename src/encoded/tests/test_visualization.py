@@ -0,0 +1,486 @@
+import time
+
+
+class DummyRegistry(dict):
+    def __init__(self, settings):
+        super(DummyRegistry, self).__init__()
+        self.settings = settings
+
+
+class DummyRequest(object):
+    url = 'http://localhost/batch_hub/type=Experiment/hg19/trackDb.txt'
+    host_url = 'http://localhost'
+
+    def __init__(self, **settings):
+        self.registry = DummyRegistry(settings)
+
+
+def dummy_pool_requests(monkeypatch, module='encoded.visualization'):
+    '''Stands DummyRequests in for pool_request(), which copies a real request.
+       Returns those made.'''
+    made = []
+
+    def pool_request(request):
+        made.append(DummyRequest())
+        made[-1].registry = request.registry
+        return made[-1]
+
+    monkeypatch.setattr(module + '.pool_request', pool_request)
+    return made
+
+
+def test_visualization_build_many_in_pool(monkeypatch):
+    from pyramid.threadlocal import get_current_request
+    from encoded.visualization import VisCollections
+    collection = VisCollections(DummyRequest(**{'visualization.build_workers': '3'}))
+    pool_requests = dummy_pool_requests(monkeypatch)
+
+    def build_one(accession, assembly, hide, request=None):
+        assert get_current_request() is request
+        assert request in pool_requests
+        return ({'accession': accession, 'assembly': assembly}, True)
+
+    monkeypatch.setattr(collection, 'build_one', build_one)
+    accessions = ['ENCSR%03dAAA' % n for n in range(20)]
+    assert collection.build_many(accessions, 'hg19') == []
+    assert sorted(collection.vis_datasets) == accessions
+    assert collection.built == 20
+    assert len(pool_requests) == 20
+
+
+def test_visualization_build_many_leaves_the_rest_when_out_of_time(monkeypatch):
+    from encoded.visualization import VisCollections
+    collection = VisCollections(DummyRequest(**{
+        'visualization.build_workers': '2',
+        'visualization.build_budget': '0.2',
+    }))
+
+    dummy_pool_requests(monkeypatch)
+
+    def build_one(accession, assembly, hide, request=None):
+        if accession != 'ENCSR000AAA':
+            time.sleep(1)
+        return ({'accession': accession}, True)
+
+    monkeypatch.setattr(collection, 'build_one', build_one)
+    accessions = ['ENCSR%03dAAA' % n for n in range(10)]
+    unbuilt = collection.build_many(accessions, 'hg19')
+    # The two builds running when time ran out are waited for, the rest are never started
+    assert sorted(collection.vis_datasets) == accessions[:3]
+    assert sorted(unbuilt) == accessions[3:]
+
+
+def test_visualization_build_many_serial_budget(monkeypatch):
+    from encoded.visualization import VisCollections
+    collection = VisCollections(DummyRequest(**{
+        'visualization.build_workers': '1',
+        'visualization.build_budget': '0.05',
+    }))
+
+    def build_one(accession, assembly, hide, request=None):
+        time.sleep(0.1)
+        return ({}, False)
+
+    monkeypatch.setattr(collection, 'build_one', build_one)
+    assert collection.build_many(['ENCSR000AAA', 'ENCSR001AAA'], 'hg19') == ['ENCSR001AAA']
+    assert collection.vis_datasets == {'ENCSR000AAA': {}}
+
+
+def test_visualization_build_many_prefetches_aligners_in_one_search(monkeypatch):
+    from encoded.visualization import VisCollections
+    request = DummyRequest(**{'visualization.build_workers': '1'})
+    searches = []
+    prefetched = []
+
+    def embed(path, as_user=None):
+        searches.append(path)
+        step_ver = {'software_versions': ['/software-versions/star/']}
+        a_file = {'file_format': 'bam', 'analysis_step_version': step_ver}
+        return {'@graph': [{'files': [a_file]}, {'files': []}]}
+
+    class DummyAlignerMemo(object):
+        def prefetch(self, ids):
+            prefetched.append(set(ids))
+
+    request.embed = embed
+    request.vis_aligners = DummyAlignerMemo()
+    collection = VisCollections(request)
+
+    def build_one(accession, assembly, hide, request=None):
+        return ({}, False)
+
+    monkeypatch.setattr(collection, 'build_one', build_one)
+    collection.build_many(['ENCSR000AAA', 'ENCSR001AAA'], 'hg19')
+    assert len(searches) == 1
+    assert 'accession=ENCSR000AAA' in searches[0] and 'accession=ENCSR001AAA' in searches[0]
+    assert prefetched == [{'/software-versions/star/'}]
+
+
+class DummyMgetES(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.requests = []
+
+    def mget(self, index, doc_type, body, _source_include=None):
+        self.requests.append(body['ids'])
+        return {'docs': [
+            {'_id': id, 'found': True, '_source': self.source(id, _source_include)}
+            if id in self.docs else {'_id': id, 'found': False}
+            for id in body['ids']
+        ]}
+
+    def source(self, id, include):
+        if include is None:
+            return self.docs[id]
+        return {key: value for (key, value) in self.docs[id].items() if key in include}
+
+
+def test_vis_cache_get_many_in_chunks():
+    from encoded.vis_defines import VisCache
+    es = DummyMgetES({'ENCSR000AAA_hg19': {'name': 'a'}, 'ENCSR002AAA_hg19': {'name': 'c'}})
+    vis_cache = VisCache(DummyRequest())
+    vis_cache.es = es
+    vis_ids = ['ENCSR000AAA_hg19', 'ENCSR001AAA_hg19', 'ENCSR002AAA_hg19']
+    assert dict(vis_cache.get_many(vis_ids, chunk_size=2)) == {
+        'ENCSR000AAA_hg19': {'name': 'a'},
+        'ENCSR002AAA_hg19': {'name': 'c'},
+    }
+    assert es.requests == [vis_ids[:2], vis_ids[2:]]
+
+
+def test_vis_cache_reads_compressed_and_uncompressed():
+    from encoded.vis_defines import (
+        VIS_CACHE_COMPRESSED, VisCache, decode_vis_dataset, encode_vis_dataset
+    )
+    vis_dataset = {
+        'name': 'ENCSR000AAA', 'tracks': [{'name': 'ENCFF000AAA', 'type': 'bigWig'}] * 20
+    }
+    compressed = encode_vis_dataset(vis_dataset, compress=True)
+    assert sorted(compressed) == ['vis_id', VIS_CACHE_COMPRESSED]
+    assert len(compressed[VIS_CACHE_COMPRESSED]) < len(str(vis_dataset))
+    assert encode_vis_dataset({}, compress=True) == {}
+    assert decode_vis_dataset(compressed) == vis_dataset
+    es = DummyMgetES({
+        'ENCSR000AAA_hg19': compressed, 'ENCSR001AAA_hg19': vis_dataset, 'ENCSR002AAA_hg19': {}
+    })
+    vis_cache = VisCache(DummyRequest(**{'visualization.vis_cache_compress': 'true'}))
+    assert vis_cache.compress
+    vis_cache.es = es
+    found = vis_cache.get_many(['ENCSR000AAA_hg19', 'ENCSR001AAA_hg19', 'ENCSR002AAA_hg19'])
+    assert dict(found) == {
+        'ENCSR000AAA_hg19': vis_dataset,
+        'ENCSR001AAA_hg19': vis_dataset,
+        'ENCSR002AAA_hg19': {},
+    }
+
+
+def test_vis_cache_exists_many_remembers_answers():
+    from encoded.cache import LRUCache
+    from encoded.vis_defines import VIS_EXISTS_CACHE, VisCache, encode_vis_dataset
+    es = DummyMgetES({
+        'ENCSR000AAA_hg19': {'vis_id': 'ENCSR000AAA_hg19', 'tracks': []},
+        'ENCSR001AAA_hg19': encode_vis_dataset(
+            {'vis_id': 'ENCSR001AAA_hg19', 'tracks': []}, compress=True
+        ),
+        'ENCSR002AAA_hg19': {},
+    })
+    request = DummyRequest()
+    request.registry[VIS_EXISTS_CACHE] = LRUCache(10, 60)
+    vis_cache = VisCache(request)
+    vis_cache.es = es
+    vis_ids = ['ENCSR000AAA_hg19', 'ENCSR001AAA_hg19', 'ENCSR002AAA_hg19', 'ENCSR003AAA_hg19']
+    assert vis_cache.exists_many(vis_ids) == {'ENCSR000AAA_hg19', 'ENCSR001AAA_hg19'}
+    assert vis_cache.exists_many(vis_ids) == {'ENCSR000AAA_hg19', 'ENCSR001AAA_hg19'}
+    assert es.requests == [vis_ids]
+    vis_cache.remember_exists({'ENCSR003AAA_hg19': {'vis_id': 'ENCSR003AAA_hg19'}})
+    assert vis_cache.exists_many(vis_ids[3:]) == {'ENCSR003AAA_hg19'}
+    assert len(es.requests) == 1
+
+
+def test_vis_defines_browsers_available_from_vis_ids():
+    from encoded.vis_defines import browsers_available
+    files = [{'file_format': 'bigWig', 'status': 'released', 'assembly': 'GRCh38'}]
+    types = ['Experiment', 'Dataset', 'Item']
+    assert sorted(browsers_available('released', ['GRCh38'], types, 'experiment', files,
+                                     'ENCSR000AAA', vis_ids={'ENCSR000AAA_hg38'})) == [
+        'Ensembl', 'UCSC'
+    ]
+    assert browsers_available('released', ['hg19'], types, 'experiment', files, 'ENCSR000AAA',
+                              vis_ids={'ENCSR000AAA_hg38'}) == []
+
+
+def test_visualization_render_vis_datasets_until_recached():
+    from encoded.cache import LRUCache
+    from encoded.visualization import RENDERED_CACHE, render_vis_datasets
+
+    class DummyResponse(object):
+        last_modified = None
+        etag = None
+
+    request = DummyRequest()
+    request.response = DummyResponse()
+    request.registry[RENDERED_CACHE] = LRUCache(10, 60)
+    rendered = []
+
+    def render():
+        rendered.append(1)
+        return 'track %d' % len(rendered)
+
+    def cached():
+        return {
+            'ENCSR000AAA_hg19': {
+                'vis_id': 'ENCSR000AAA_hg19', 'last_modified': 100.5, 'fields_hash': 'abc'
+            },
+            'ENCSR001AAA': {},
+        }
+
+    vis_datasets = cached()
+    before = int(time.time())
+    assert render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt') == 'track 1'
+    # stamps are not for output
+    assert vis_datasets['ENCSR000AAA_hg19'] == {'vis_id': 'ENCSR000AAA_hg19'}
+    etag = request.response.etag
+    assert isinstance(etag, str)  # strong, so If-Range can match it
+    # Collections may gain older vis_datasets, so are modified when first seen with these
+    first_seen = request.response.last_modified
+    assert first_seen >= before
+    assert render_vis_datasets(request, cached(), render, 'trackDb', 'txt') == 'track 1'
+    assert request.response.etag == etag
+    assert request.response.last_modified == first_seen
+    assert render_vis_datasets(request, cached(), render, 'trackDb', 'json') == 'track 2'
+    assert request.response.etag != etag
+    vis_datasets = cached()
+    vis_datasets['ENCSR000AAA_hg19']['last_modified'] = 200.0
+    assert render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt') == 'track 3'
+    assert request.response.etag != etag
+    vis_datasets = cached()
+    del vis_datasets['ENCSR001AAA']
+    text = render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt', one_dataset=True)
+    assert text == 'track 4'
+    assert request.response.etag != etag
+    assert request.response.last_modified == 100
+    # Unstamped vis_datasets may have changed unseen, so are left to an md5 of the text
+    request.response = DummyResponse()
+    vis_datasets = cached()
+    del vis_datasets['ENCSR000AAA_hg19']['last_modified']
+    assert render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt') == 'track 5'
+    assert request.response.etag is None
+    assert request.response.last_modified is None
+
+
+def test_visualization_last_modified_unknown_for_unstamped_vis_datasets():
+    from encoded.visualization import vis_datasets_last_modified
+    assert vis_datasets_last_modified(
+        {'a': {'last_modified': 5}, 'b': {'last_modified': 7}, 'c': {}}
+    ) == 7
+    assert vis_datasets_last_modified({'a': {'last_modified': 5}, 'b': {'vis_id': 'b'}}) is None
+    assert vis_datasets_last_modified({}) is None
+
+
+def test_vis_defines_compiled_masks_match_scanning():
+    from encoded.vis_defines import COMPILED_MASKS, VisDefines
+    dataset = {
+        'accession': 'ENCSR000AAA',
+        'assay_title': 'TF ChIP-seq',
+        'assay_term_name': 'ChIP-seq',
+        '@id': '/experiments/ENCSR000AAA/',
+        'target': {
+            'label': 'CTCF', 'name': 'CTCF-human', 'investigated_as': ['transcription factor']
+        },
+        'biosample_ontology': {'term_name': 'K562'},
+        'replicates': [{'library': {'biosample': {'summary': 'Homo sapiens K562'}}}],
+        'lab': {'title': 'ENCODE Processing Pipeline'},
+        'award': {'rfa': 'ENCODE3'},
+    }
+    a_file = {
+        'accession': 'ENCFF000AAA',
+        'output_type': 'fold change over control',
+        'rep_tech': 'rep1_2',
+        'lab': {'title': 'Mike Snyder, Stanford'},
+    }
+    vis_defines = VisDefines(DummyRequest(), dataset=dataset)
+    masks = list(COMPILED_MASKS) + ['{unknown} of {accession}', '{accession} stray}', '{accession']
+    assert len(masks) > 10
+    for mask in masks:
+        assert vis_defines.convert_mask(mask) == vis_defines.scan_mask(mask, dataset)
+        converted = vis_defines.convert_mask(mask, dataset, a_file)
+        assert converted == vis_defines.scan_mask(mask, dataset, a_file)
+
+
+def test_visualization_aligner_memo_searches_once():
+    from urllib.parse import parse_qs
+    from encoded.visualization import AlignerMemo
+    request = DummyRequest()
+    searches = []
+
+    def embed(path, as_user=None):
+        ids = parse_qs(path.split('?', 1)[1])['@id']
+        searches.append(ids)
+        return {'@graph': [
+            {'@id': swv_key, 'version': '2.5'} for swv_key in ids if 'star' in swv_key
+        ]}
+
+    request.embed = embed
+    memo = AlignerMemo(request)
+    memo.prefetch(['/software-versions/star/', '/software-versions/bowtie-script/'])
+    star = {'@id': '/software-versions/star/', 'version': '2.5'}
+    assert memo.get_many(['/software-versions/star/']) == [star]
+    assert memo.get_many(['/software-versions/bowtie-script/']) == []
+    assert len(searches) == 1
+    shared = memo.shared_with(DummyRequest())
+    assert shared.get_many(['/software-versions/star/']) == [star]
+    assert len(searches) == 1
+
+
+def test_visualization_software_version_ids():
+    from encoded.visualization import software_version_ids
+    dataset = {'files': [
+        {
+            'file_format': 'bam',
+            'analysis_step_version': {'software_versions': ['/software-versions/a/']}
+        },
+        {
+            'file_format': 'bigWig',
+            'analysis_step_version': {'software_versions': ['/software-versions/b/']}
+        },
+        {'file_format': 'bam', 'analysis_step_version': '/analysis-step-versions/c/'},
+        {'file_format': 'bam',
+         'analysis_step_version': {'software_versions': [{'@id': '/software-versions/d/'}]}},
+        '/files/ENCFF000AAA/',
+    ]}
+    assert software_version_ids(dataset) == {'/software-versions/a/', '/software-versions/d/'}
+
+
+def test_vis_defines_json_dict_chunks_match_json_dumps():
+    import json
+    from encoded.vis_defines import json_dict_chunks
+    value = {
+        'b': {'tracks': [{'name': 'x', 'on': True}, {}], 'empty': {}},
+        'a': [],
+        'c': 'text "quoted"'
+    }
+    expected = json.dumps(value, indent=4, sort_keys=True)
+    assert ''.join(json_dict_chunks(sorted(value.items()))) == expected
+    assert ''.join(json_dict_chunks([])) == json.dumps({}, indent=4)
+    nested = {'datasets': value}
+    chunks = list(json_dict_chunks(sorted(value.items()), level=1))
+    chunks = ['{\n    "datasets": '] + chunks + ['\n}']
+    assert ''.join(chunks) == json.dumps(nested, indent=4, sort_keys=True)
+
+
+def test_visualization_render_vis_datasets_streams_then_caches():
+    from encoded.cache import LRUCache
+    from encoded.visualization import RENDERED_CACHE, render_vis_datasets
+
+    class DummyResponse(object):
+        last_modified = None
+        etag = None
+
+    request = DummyRequest()
+    request.response = DummyResponse()
+    request.registry[RENDERED_CACHE] = LRUCache(10, 60)
+    vis_datasets = {'ENCSR000AAA_hg19': {'vis_id': 'ENCSR000AAA_hg19', 'last_modified': 100.5}}
+
+    def render():
+        return iter(['track a\n', 'track b\n'])
+
+    chunks = render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt', stream=True)
+    assert not isinstance(chunks, str)
+    assert ''.join(chunks) == 'track a\ntrack b\n'
+    # Once streamed through, the text is kept
+    vis_datasets = {'ENCSR000AAA_hg19': {'vis_id': 'ENCSR000AAA_hg19', 'last_modified': 100.5}}
+    text = render_vis_datasets(request, vis_datasets, render, 'trackDb', 'txt', stream=True)
+    assert text == 'track a\ntrack b\n'
+
+
+def test_visualization_fields_hash_only_changes_with_fields_build_reads():
+    from encoded.visualization import VisDataset
+    dataset = {
+        'accession': 'ENCSR000AAA',
+        'assay_term_name': 'ChIP-seq',
+        'status': 'released',
+        'description': 'first',
+        'files': [
+            {'accession': 'ENCFF000AAA', 'md5sum': 'abc', 'status': 'released', 'notes': 'first'}
+        ],
+    }
+    vis_factory = VisDataset(DummyRequest())
+    fields_hash = vis_factory.fields_hash(dataset)
+    assert vis_factory.fields_hash(dict(dataset, description='second')) == fields_hash
+
+    def with_file(**changes):
+        return dict(dataset, files=[dict(dataset['files'][0], **changes)])
+
+    assert vis_factory.fields_hash(with_file(notes='second')) == fields_hash
+    # Added by build itself
+    assert vis_factory.fields_hash(with_file(rep_tech='rep1_1')) == fields_hash
+    assert vis_factory.fields_hash(dict(dataset, status='revoked')) != fields_hash
+    assert vis_factory.fields_hash(with_file(md5sum='def')) != fields_hash
+    assert vis_factory.fields_hash(dataset, hide=True) != fields_hash
+
+
+def test_visualization_dataset_vis_ids():
+    from encoded.visualization import dataset_vis_ids
+    assert dataset_vis_ids({'accession': 'ENCSR000AAA', 'assembly': ['GRCh38', 'mm10']}) == [
+        'ENCSR000AAA_hg38', 'ENCSR000AAA_mm10']
+    assert dataset_vis_ids({'accession': 'ENCSR000AAA'}) == []
+
+
+def test_visualization_ihec_reference_registry_ids_in_one_search():
+    from encoded.vis_defines import IhecDefines
+    queries = []
+
+    def embed(path):
+        queries.append(path)
+        return {'@graph': [
+            {'dbxrefs': ['GEO:GSM1', 'IHEC:IHECRE00000001.2'],
+             'related_datasets': [{'accession': 'ENCSR000AAA'}, {'accession': 'ENCSR001AAA'}]},
+            {
+                'dbxrefs': ['IHEC:IHECRE00000009.1'],
+                'related_datasets': [{'accession': 'ENCSR001AAA'}]
+            },
+            {'dbxrefs': [], 'related_datasets': [{'accession': 'ENCSR002AAA'}]},
+        ]}
+
+    request = DummyRequest()
+    request.embed = embed
+    vis_datasets = {
+        accession: {'name': accession, 'ihec_exp_type': 'H3K4me3'}
+        for accession in ('ENCSR000AAA', 'ENCSR001AAA', 'ENCSR002AAA')
+    }
+    vis_datasets['ENCSR003AAA'] = {'name': 'ENCSR003AAA'}
+    ihec = IhecDefines(request)
+    assert ihec.reference_registry_ids(vis_datasets) == {
+        'ENCSR000AAA': 'IHECRE00000001',
+        'ENCSR001AAA': 'IHECRE00000001',
+    }
+    assert len(queries) == 1
+    assert 'related_datasets.accession=ENCSR002AAA' in queries[0]
+    assert 'ENCSR003AAA' not in queries[0]
+    assert ihec.reference_registry_ids({'ENCSR003AAA': vis_datasets['ENCSR003AAA']}) == {}
+    assert len(queries) == 1
+
+
+def test_visualization_render_hub_page_reused():
+    from encoded.cache import LRUCache
+    from encoded.visualization import HUB_PAGE_CACHE, render_hub_page
+
+    class DummyResponse(object):
+        last_modified = None
+
+    request = DummyRequest()
+    request.effective_principals = ['system.Everyone']
+    request.response = DummyResponse()
+    request.registry[HUB_PAGE_CACHE] = LRUCache(10, 60)
+    rendered = []
+
+    def render():
+        rendered.append(1)
+        return 'genome hg19 %d' % len(rendered)
+
+    assert render_hub_page(request, render) == 'genome hg19 1'
+    last_modified = request.response.last_modified
+    assert render_hub_page(request, render) == 'genome hg19 1'
+    assert request.response.last_modified == last_modified
+    request.effective_principals = ['system.Everyone', 'group.admin']
+    assert render_hub_page(request, render) == 'genome hg19 2'
@@ -3,6 +3,9 @@ from snovault.util import ensurelist
 from .assay_data import assay_terms
 from urllib.parse import urljoin
 from encoded.vis_defines import (
+    VISIBLE_FILE_STATUSES,
+    VisCache,
+    vis_cache_id,
     vis_format_url,
     browsers_available
     )
@@ -194,12 +197,18 @@ class CalculatedVisualize:
             if properties.get('status') in viewable_file_status
             if 'assembly' in properties
         }
+        vis_ids = None
+        if status in VISIBLE_FILE_STATUSES:
+            # One lookup for the vis_blobs of every assembly
+            vis_ids = VisCache(request).exists_many(
+                vis_cache_id(accession, assembly_name) for assembly_name in vis_assembly
+            )
         for assembly_name in vis_assembly:
             if assembly_name in viz:
                 continue
             browsers = browsers_available(status, [assembly_name],
                                           self.base_types, self.item_type,
-                                          files, accession, request)
+                                          files, accession, request, vis_ids)
             if len(browsers) > 0:
                 viz[assembly_name] = browsers
         if viz:
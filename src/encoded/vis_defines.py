@@ -1,15 +1,21 @@
 from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.compat import bytes_
+from pyramid.settings import asbool
 from snovault import Item
 from collections import OrderedDict
 from copy import deepcopy
+import base64
+import hashlib
 import json
 import os
+import zlib
 from urllib.parse import (
     parse_qs,
     urlencode,
 )
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import bulk
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
 import time
 from pkg_resources import resource_filename
@@ -190,6 +196,12 @@ SUPPORTED_MASK_TOKENS = [
 SIMPLE_DATASET_TOKENS = ["{accession}", "{assay_title}",
                          "{assay_term_name}", "{annotation_type}", "{@id}", "{@type}"]
 
+# Masks compiled by compile_mask():
+# {mask: (literal strings and token accessors), or None if it must be scanned}
+COMPILED_MASKS = {}
+# Dotted paths of embedded tokens: {name: (terms)}
+EMBEDDED_PATHS = {}
+
 # static group defs are keyed by group title (or special token) and consist of
 # tag: (optional) unique terse key for referencing group
 # groups: (optional) { subgroups keyed by subgroup title }
@@ -204,6 +216,8 @@ SIMPLE_DATASET_TOKENS = ["{accession}", "{assay_title}",
 VIS_DEFS_FOLDER = "static/vis_defs/"
 VIS_DEFS_BY_TYPE = {}
 VIS_DEFS_DEFAULT = {}
+# Digest of the vis_defs files loaded, since vis_datasets built with other vis_defs differ
+VIS_DEFS_DIGEST = ''
 
 
 # vis_defs may not have the default experiment group defined
@@ -413,6 +427,60 @@ BIOSAMPLE_COLOR = {
     }
 
 VIS_CACHE_INDEX = "vis_cache"
+VIS_CACHE_CHUNK_SIZE = 500  # vis_datasets per bulk add or mget
+# Compressed vis_datasets are stored as this field, base64 of zlib compressed json, beside their
+# vis_id.
+# Uncompressed vis_datasets are still read, so either may be in the cache.
+VIS_CACHE_COMPRESSED = 'vis_zlib'
+# Whether non-empty vis_datasets exist is remembered a short while, for the visualize calculated
+# property
+VIS_EXISTS_CACHE = 'vis_exists_cache'
+VIS_EXISTS_CACHE_SIZE = 20000
+VIS_EXISTS_CACHE_TTL = 60
+
+
+def vis_cache_id(accession, assembly):
+    '''Returns the vis_id of the vis_dataset of an accession on an assembly.'''
+    # key on normalized assembly!
+    return accession + '_' + ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)
+
+
+def encode_vis_dataset(vis_dataset, compress=False):
+    '''Returns the document to store in the vis_cache for a vis_dataset.'''
+    if not compress or not vis_dataset:
+        return vis_dataset
+    packed = zlib.compress(json.dumps(vis_dataset, separators=(',', ':')).encode('utf-8'))
+    return {
+        VIS_CACHE_COMPRESSED: base64.b64encode(packed).decode('ascii'),
+        'vis_id': vis_dataset.get('vis_id')
+    }
+
+
+def decode_vis_dataset(source):
+    '''Returns the vis_dataset of a document from the vis_cache, compressed or not.'''
+    packed = source.get(VIS_CACHE_COMPRESSED) if source else None
+    if packed is None:
+        return source
+    return json.loads(zlib.decompress(base64.b64decode(packed)).decode('utf-8'))
+
+
+def indented_json(value, level=0):
+    '''Returns json.dumps(value, indent=4, sort_keys=True) as it would appear nested level deep.'''
+    return json.dumps(value, indent=4, sort_keys=True).replace('\n', '\n' + '    ' * level)
+
+
+def json_dict_chunks(items, level=0):
+    '''Yields the text of indented_json(dict(items), level) an item at a time.
+       Items must come in key order.'''
+    pad = '    ' * (level + 1)
+    separator = '{'
+    for (key, value) in items:
+        yield '%s\n%s%s: %s' % (separator, pad, json.dumps(key), indented_json(value, level + 1))
+        separator = ','
+    if separator == '{':
+        yield '{}'
+    else:
+        yield '\n%s}' % ('    ' * level)
 
 
 class Sanitize(object):
@@ -475,6 +543,75 @@ class Sanitize(object):
 sanitize = Sanitize()
 
 
+def embedded_path(name):
+    '''Returns the terms of the dotted path that lookup_embedded_token follows for a name.'''
+    path = EMBEDDED_PATHS.get(name)
+    if path is None:
+        token = ENCODED_DATASET_EMBEDDED_TERMS.get(name, name)
+        if token[0] == '{' and token[-1] == '}':
+            token = token[1:-1]
+        path = EMBEDDED_PATHS[name] = tuple(token.split('.'))
+    return path
+
+
+def token_accessor(token):
+    '''Returns accessor(vis_defines, dataset, a_file) giving the value lookup_token would for a
+       token.'''
+    if token in SIMPLE_DATASET_TOKENS:
+        key = token[1:-1]
+        noun = key.split('_')[0].capitalize()
+
+        def simple_accessor(vis_defines, dataset, a_file):
+            term = dataset.get(key)
+            if term is None:
+                return "Unknown " + noun
+            elif isinstance(term, list) and len(term) > 3:
+                return "Collection of %d %ss" % (len(term), noun)
+            return term
+        return simple_accessor
+
+    def accessor(vis_defines, dataset, a_file):
+        return vis_defines.lookup_token(token, dataset, a_file=a_file)
+    return accessor
+
+
+def compile_mask(mask):
+    '''Parses a mask like "{replicate} {biosample_term_name}" into literal strings and token
+       accessors.
+       Returns None for masks with stray '}'s, which convert_mask leaves to scan_mask.'''
+    parts = []
+    pos = 0
+    while pos < len(mask):
+        beg_ix = mask.find('{', pos)
+        end_ix = mask.find('}', pos)
+        if beg_ix == -1 or end_ix == -1:
+            break
+        if end_ix < beg_ix:
+            return None
+        if beg_ix > pos:
+            parts.append(mask[pos:beg_ix])
+        parts.append(token_accessor(mask[beg_ix:end_ix + 1]))
+        pos = end_ix + 1
+    if pos < len(mask):
+        if '}' in mask[pos:]:
+            return None
+        parts.append(mask[pos:])
+    return tuple(parts)
+
+
+def compile_masks(vis_def):
+    '''Compiles every mask found in a vis_def.'''
+    if isinstance(vis_def, str):
+        if '{' in vis_def and vis_def not in COMPILED_MASKS:
+            COMPILED_MASKS[vis_def] = compile_mask(vis_def)
+    elif isinstance(vis_def, dict):
+        for value in vis_def.values():
+            compile_masks(value)
+    elif isinstance(vis_def, list):
+        for value in vis_def:
+            compile_masks(value)
+
+
 class VisDefines(object):
     # Loads vis_def static files and other defines for vis formatting
     # This class is also a swiss army knife of vis formatting conversions
@@ -497,13 +634,17 @@ class VisDefines(object):
         #global VIS_DEFS_FOLDER
         global VIS_DEFS_BY_TYPE
         global VIS_DEFS_DEFAULT
+        global VIS_DEFS_DIGEST
         folder = resource_filename(__name__, VIS_DEFS_FOLDER)
         files = os.listdir(folder)
-        for filename in files:
+        digest = hashlib.sha1()
+        for filename in sorted(files):
             if filename.endswith('.json'):
                 with open(folder + filename) as fh:
                     log.debug('Preparing to load %s' % (filename))
-                    vis_def = json.load(fh)
+                    text = fh.read()
+                    digest.update(text.encode('utf-8'))
+                    vis_def = json.loads(text)
                     # Could alter vis_defs here if desired.
                     if vis_def:
                         VIS_DEFS_BY_TYPE.update(vis_def)
@@ -511,6 +652,13 @@ class VisDefines(object):
         self.vis_defs = VIS_DEFS_BY_TYPE
         VIS_DEFS_DEFAULT = self.vis_defs.get("opaque",{})
         self.vis_def_default = VIS_DEFS_DEFAULT
+        VIS_DEFS_DIGEST = digest.hexdigest()
+        # Masks are parsed once here rather than on every track of every file
+        compile_masks(VIS_DEFS_BY_TYPE)
+        compile_masks(DEFAULT_EXPERIMENT_GROUP)
+
+    def vis_defs_digest(self):
+        return VIS_DEFS_DIGEST
 
     def get_vis_type(self):
         '''returns the best visualization definition type, based upon dataset.'''
@@ -727,15 +875,12 @@ class VisDefines(object):
 
     def lookup_embedded_token(self, name, obj):
         '''Encodes the string to swap special characters and remove spaces.'''
-        token = ENCODED_DATASET_EMBEDDED_TERMS.get(name, name)
-        if token[0] == '{' and token[-1] == '}':
-            token = token[1:-1]
-        terms = token.split('.')
+        terms = embedded_path(name)
+        last = len(terms) - 1
         cur_obj = obj
-        while len(terms) > 0:
-            term = terms.pop(0)
+        for (ix, term) in enumerate(terms):
             cur_obj = cur_obj.get(term)
-            if len(terms) == 0 or cur_obj is None:
+            if ix == last or cur_obj is None:
                 return cur_obj
             if isinstance(cur_obj,list):
                 if len(cur_obj) == 0:
@@ -881,10 +1026,29 @@ class VisDefines(object):
 
     def convert_mask(self, mask, dataset=None, a_file=None):
         '''Given a mask with one or more known {term_name}s, replaces with values.'''
-        working_on = mask
         # dataset might not be self.dataset
         if dataset is None:
             dataset = self.dataset
+        if mask in COMPILED_MASKS:
+            parts = COMPILED_MASKS[mask]
+        else:
+            parts = COMPILED_MASKS[mask] = compile_mask(mask)
+        if parts is None:
+            return self.scan_mask(mask, dataset, a_file)
+        values = []
+        for part in parts:
+            if isinstance(part, str):
+                values.append(part)
+                continue
+            value = "%s" % (part(self, dataset, a_file),)
+            if '{' in value or '}' in value:  # scanning would look up tokens within values too
+                return self.scan_mask(mask, dataset, a_file)
+            values.append(value)
+        return ''.join(values)
+
+    def scan_mask(self, mask, dataset, a_file=None):
+        '''Replaces {term_name}s by scanning the mask, for those masks that can't be compiled.'''
+        working_on = mask
         chars = len(working_on)
         while chars > 0:
             beg_ix = working_on.find('{')
@@ -905,8 +1069,14 @@ class VisDefines(object):
 
     def ucsc_single_composite_trackDb(self, vis_format, title):
         '''Given a single vis_format (vis_dataset or vis_by_type dict, returns single UCSC trackDb composite text'''
+        return ''.join(self.ucsc_composite_trackDb_chunks(vis_format, title))
+
+    def ucsc_composite_trackDb_chunks(self, vis_format, title):
+        '''Yields the UCSC trackDb text of a single vis_format: the composite, then each view and
+           each track.'''
         if vis_format is None or len(vis_format) == 0:
-            return "# Empty composite for %s.  It cannot be visualized at this time.\n" % title
+            yield "# Empty composite for %s.  It cannot be visualized at this time.\n" % title
+            return
 
         blob = ""
         # First the composite structure
@@ -1015,7 +1185,8 @@ class VisDefines(object):
 
             # Now cycle through tracks in view
             for track in tracks:
-                blob += "        track %s\n" % (track["name"])
+                yield blob
+                blob = "        track %s\n" % (track["name"])
                 blob += "        parent %s_%s_view" % (vis_format["name"], view["tag"])
                 dimA_subgroup = track.get("membership", {}).get(dimA_tag)
                 if dimA_subgroup is not None and dimA_subgroup != dimA_checked:
@@ -1047,7 +1218,7 @@ class VisDefines(object):
 
                 blob += '\n'
         blob += '\n'
-        return blob
+        yield blob
 
 
 class IhecDefines(object):
@@ -1056,6 +1227,8 @@ class IhecDefines(object):
     def __init__(self, request):
         self._request = request
         self.samples = {}
+        self.assembly = ''   # of the vis_datasets last remodelled, for the hub_description
+        self.taxon_id = 0
         self.vis_defines = None
 
 
@@ -1161,7 +1334,30 @@ class IhecDefines(object):
         #    return "Annotation"
         return None  # vis_dataset.get('assay_term_name','Unknown')
 
-    def experiment_attributes(self, vis_dataset):
+    def reference_registry_ids(self, vis_datasets):
+        '''Returns {accession: EpiRR id} for the IHEC-able vis_datasets, from one search of
+           reference epigenomes.'''
+        accessions = sorted(
+            vis_dataset['name'] for vis_dataset in vis_datasets.values()
+            if vis_dataset and vis_dataset.get('ihec_exp_type') is not None
+        )
+        if not accessions:
+            return {}
+        query = (
+            '/search/?type=ReferenceEpigenome&status=released'
+            '&field=dbxrefs&field=related_datasets.accession&limit=all'
+        ) + ''.join('&related_datasets.accession={}'.format(accession) for accession in accessions)
+        registry_ids = {}
+        for ref_epi in self._request.embed(query)['@graph']:
+            for dbxref in ref_epi.get('dbxrefs', []):
+                if dbxref.startswith('IHEC:IHECRE'):
+                    for related in ref_epi.get('related_datasets', []):
+                        registry_ids.setdefault(related.get('accession'), dbxref[5:].split('.')[0])
+                    break
+        return registry_ids
+
+    def experiment_attributes(self, vis_dataset, registry_ids):
+        '''registry_ids are as returned by reference_registry_ids().'''
         assay_id = vis_dataset.get('assay_term_id')
         if not assay_id:
             return {}
@@ -1175,15 +1371,9 @@ class IhecDefines(object):
         if assay_name:
             attributes["assay_type"] = assay_name
         attributes['library_strategy'] = IHEC_LIB_STRATEGY[assay_name]
-        query = (
-            '/search/?type=ReferenceEpigenome&related_datasets.accession={}'
-            '&status=released&field=dbxrefs&limit=all'
-        ).format(vis_dataset['name'])
-        for ref_epi in self._request.embed(query)['@graph']:
-            for dbxref in ref_epi.get('dbxrefs', []):
-                if dbxref.startswith('IHEC:IHECRE'):
-                    attributes['reference_registry_id'] = dbxref[5:].split('.')[0]
-                    break
+        registry_id = registry_ids.get(vis_dataset['name'])
+        if registry_id:
+            attributes['reference_registry_id'] = registry_id
         return attributes
 
     def analysis_attributes(self, vis_dataset):
@@ -1377,18 +1567,48 @@ class IhecDefines(object):
         #    'experiment_2': {...},
         # }
 
+        registry_ids = self.reference_registry_ids(vis_datasets)
+        datasets.update(self.ihec_datasets(host_url, vis_datasets, registry_ids))
+        return {
+            'hub_description': self.hub_description(host_url),
+            'datasets': datasets,
+            'samples': self.samples,
+        }
+
+    def remodel_to_json_chunks(self, host_url, vis_datasets):
+        '''Returns an iterable of the text of remodel_to_json() as indented json, one dataset at a
+           time.
+           Reference epigenomes are looked up now, so streaming makes no further requests.'''
+        if not vis_datasets:
+            return ['{}']
+        registry_ids = self.reference_registry_ids(vis_datasets)
+        return self.ihec_json_chunks(host_url, vis_datasets, registry_ids)
+
+    def ihec_json_chunks(self, host_url, vis_datasets, registry_ids):
+        yield '{\n    "datasets": '
+        datasets = self.ihec_datasets(host_url, vis_datasets, registry_ids)
+        yield from json_dict_chunks(datasets, level=1)
+        # Sorted after datasets, so samples are complete by now
+        hub_description = self.hub_description(host_url)
+        yield ',\n    "hub_description": %s' % indented_json(hub_description, level=1)
+        yield ',\n    "samples": %s\n}' % indented_json(self.samples, level=1)
+
+    def ihec_datasets(self, host_url, vis_datasets, registry_ids):
+        '''Yields (key, IHEC dataset) in key order for a collection of vis_datasets, gathering
+           samples as it goes.'''
         # TODO: If properties aren't found then warn and skip dataset!
-        assembly = ''
-        taxon_id = 0
-        included_accessions = []
-        for accession in vis_datasets.keys():
+        self.samples = {}
+        self.assembly = ''
+        self.taxon_id = 0
+        for accession in sorted(vis_datasets.keys()):
             vis_dataset = vis_datasets[accession]
+            datasets = {}  # of this accession: one for ChIP and one per replicate for non-ChIP
             if vis_dataset is None or len(vis_dataset) == 0:
                 continue
 
             # From any vis_dataset, update these:
-            assembly = vis_dataset.get('ucsc_assembly') or assembly
-            taxon_id = vis_dataset.get('taxon_id') or taxon_id
+            self.assembly = vis_dataset.get('ucsc_assembly') or self.assembly
+            self.taxon_id = vis_dataset.get('taxon_id') or self.taxon_id
 
             dataset = {}
 
@@ -1399,7 +1619,7 @@ class IhecDefines(object):
                 log.warn('Could not determine IHEC analysis attributes for %s', accession)
 
             # Check if experiment is IHEC-able first
-            experiment_attributes = self.experiment_attributes(vis_dataset)
+            experiment_attributes = self.experiment_attributes(vis_dataset, registry_ids)
             if experiment_attributes:
                 dataset['experiment_attributes'] = experiment_attributes
             else:
@@ -1523,8 +1743,12 @@ class IhecDefines(object):
                             break
                 dataset['browser'] = browser
                 datasets[accession] = dataset
-            included_accessions.append(accession)
+            for key in sorted(datasets.keys()):
+                yield (key, datasets[key])
 
+    def hub_description(self, host_url):
+        '''Returns the IHEC hub_description of the vis_datasets last passed through
+           ihec_datasets().'''
         hub_description = {  # similar to hub.txt/genome.txt
             'publishing_group': 'ENCODE',
             'name': 'ENCODE reference epigenomes',
@@ -1537,30 +1761,11 @@ class IhecDefines(object):
             # 'taxon_id': ...,  # Species taxonomy id. (human: 9606, mouse: 10090)
             # 'assembly': '...',  # UCSC: hg19, hg38
         }
-        if assembly:
-            hub_description['assembly'] = assembly
-        if taxon_id:
-            hub_description['taxon_id'] = int(taxon_id)
-        # Find corresponding reference epigenome
-        query = (
-            '/search/?type=ReferenceEpigenome'
-            '&{}&status=released&field=accession&limit=all'
-        ).format(
-            '&'.join(
-                'related_datasets.accession={}'.format(acc)
-                for acc in included_accessions
-            )
-        )
-        ref_epi_accs = [
-            ref_epi['accession']
-            for ref_epi in self._request.embed(query)['@graph']
-        ]
-
-        return {
-            'hub_description': hub_description,
-            'datasets': datasets,
-            'samples': self.samples,
-        }
+        if self.assembly:
+            hub_description['assembly'] = self.assembly
+        if self.taxon_id:
+            hub_description['taxon_id'] = int(self.taxon_id)
+        return hub_description
 
 
 # TODO: move to separate vis_cache module?
@@ -1571,6 +1776,8 @@ class VisCache(object):
         self.request = request
         self.es = self.request.registry.get(ELASTIC_SEARCH, None)
         self.index = VIS_CACHE_INDEX
+        settings = self.request.registry.settings
+        self.compress = asbool(settings.get('visualization.vis_cache_compress', False))
 
     def create_cache(self):
         if not self.es:
@@ -1589,32 +1796,111 @@ class VisCache(object):
         if not self.es.indices.exists(self.index):
             self.create_cache()  # Only bother creating on add
 
-        self.es.index(index=self.index, doc_type='default', body=vis_dataset, id=vis_id)
+        if vis_dataset:
+            # When rendered hubs built from it became stale
+            vis_dataset['last_modified'] = time.time()
+        self.remember_exists({vis_id: vis_dataset})
+        self.es.index(index=self.index, doc_type='default',
+                      body=encode_vis_dataset(vis_dataset, self.compress), id=vis_id)
+
+    def add_many(self, vis_datasets):
+        '''Adds {vis_id: vis_dataset} to elastic-search in bulk requests.
+           Returns the number added.'''
+        if not self.es or not vis_datasets:
+            return 0
+        if not self.es.indices.exists(self.index):
+            self.create_cache()  # Only bother creating on add
+
+        now = time.time()
+        for vis_dataset in vis_datasets.values():
+            if vis_dataset:
+                vis_dataset['last_modified'] = now
+        self.remember_exists(vis_datasets)
+        actions = (
+            {'_index': self.index, '_type': 'default', '_id': vis_id,
+             '_source': encode_vis_dataset(vis_dataset, self.compress)}
+            for (vis_id, vis_dataset) in vis_datasets.items()
+        )
+        (added, errors) = bulk(
+            self.es, actions, chunk_size=VIS_CACHE_CHUNK_SIZE, raise_on_error=False
+        )
+        for error in errors:
+            log.error("Failed to add vis_dataset: %s" % error)
+        return added
 
     def get(self, vis_id=None, accession=None, assembly=None):
         '''Returns the vis_dataset json object from elastic-search, or None if not found.'''
         if vis_id is None and accession is not None and assembly is not None:
-            vis_id = accession + '_' + ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)
+            vis_id = vis_cache_id(accession, assembly)
         if self.es:
             try:
                 result = self.es.get(index=self.index, doc_type='default', id=vis_id)
-                return result['_source']
+                return decode_vis_dataset(result['_source'])
             except:
                 pass  # Missing index will return None
         return None
 
+    def get_many(self, vis_ids, chunk_size=VIS_CACHE_CHUNK_SIZE):
+        '''Yields (vis_id, vis_dataset) for each vis_id found in elastic-search, one mget per chunk
+           of ids.'''
+        if not self.es:
+            return
+        vis_ids = list(vis_ids)
+        for offset in range(0, len(vis_ids), chunk_size):
+            try:
+                res = self.es.mget(index=self.index, doc_type='default',
+                                   body={'ids': vis_ids[offset:offset + chunk_size]})
+            except NotFoundError:
+                return  # Missing index has nothing to find
+            for doc in res.get('docs', []):
+                if doc.get('found'):
+                    yield (doc['_id'], decode_vis_dataset(doc['_source']))
+
+    def exists_many(self, vis_ids):
+        '''Returns the vis_ids that have a non-empty vis_dataset in elastic-search, in one mget for
+           those whose answer is not remembered in the VIS_EXISTS_CACHE.'''
+        cache = self.request.registry.get(VIS_EXISTS_CACHE)
+        exists = set()
+        unknown = []
+        for vis_id in vis_ids:
+            known = cache.get(vis_id) if cache is not None else None
+            if known is None:
+                unknown.append(vis_id)
+            elif known:
+                exists.add(vis_id)
+        if not unknown or not self.es:
+            return exists
+        try:
+            # Non-empty vis_datasets have a vis_id, compressed or not
+            res = self.es.mget(index=self.index, doc_type='default', body={'ids': unknown},
+                               _source_include=['vis_id'])
+            found = set(
+                doc['_id'] for doc in res.get('docs', []) if doc.get('found') and doc.get('_source')
+            )
+        except NotFoundError:
+            found = set()  # Missing index has nothing to find
+        except Exception:
+            log.warning('Could not look up %d vis_datasets', len(unknown), exc_info=True)
+            return exists  # Not remembered, so asked again next time
+        if cache is not None:
+            for vis_id in unknown:
+                cache.set(vis_id, vis_id in found)
+        return exists | found
+
+    def remember_exists(self, vis_datasets):
+        '''Updates the VIS_EXISTS_CACHE of this process for {vis_id: vis_dataset} being added.'''
+        cache = self.request.registry.get(VIS_EXISTS_CACHE)
+        if cache is not None:
+            for (vis_id, vis_dataset) in vis_datasets.items():
+                cache.set(vis_id, bool(vis_dataset))
+
     def search(self, accessions, assembly):
-        '''Returns a list of composites from elastic-search, or None if not found.'''
+        '''Returns a dict of composites from elastic-search, or {} if none are found.'''
         if self.es:
             ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)  # Normalized accession
             vis_ids = [accession + "_" + ucsc_assembly for accession in accessions]
             try:
-                query = {"query": {"ids": {"values": vis_ids}}}
-                res = self.es.search(body=query, index=self.index, doc_type='default', size=99999)  # size=200?
-                hits = res.get("hits", {}).get("hits", [])
-                results = {}
-                for hit in hits:
-                    results[hit["_id"]] = hit["_source"]  # make this a generator? No... len(results)
+                results = dict(self.get_many(vis_ids))
                 log.debug("ids found: %d" % (len(results)))
                 return results
             except:
@@ -1682,9 +1968,11 @@ def browsers_available(
     item_type=None,
     files=None,
     accession=None,
-    request=None
+    request=None,
+    vis_ids=None
 ):
-    '''Returns list of browsers based upon vis_blobs or else files list.'''
+    '''Returns list of browsers based upon vis_blobs or else files list.
+       vis_ids: those with vis_blobs, if already looked up by VisCache.exists_many.'''
     # NOTES:When called by visualize calculated property,
     #   vis_blob should be in vis_cache, but if not files are used.
     #       When called by visindexer, neither vis_cache nor files are
@@ -1701,8 +1989,14 @@ def browsers_available(
     full_set = {'ucsc', 'ensembl', 'hic'}
     file_assemblies = None
     file_types = None
-    if request is not None:
-        vis_cache = VisCache(request)
+    if (vis_ids is None
+            and request is not None
+            and accession is not None
+            and status in VISIBLE_FILE_STATUSES):
+        # use of find_or_make_acc_composite() will recurse!
+        vis_ids = VisCache(request).exists_many(
+            vis_cache_id(accession, assembly) for assembly in assemblies
+        )
     if files is not None:
         # Make a set of all file types in all dataset files
         file_types = set(map(_file_to_format, files))
@@ -1710,12 +2004,11 @@ def browsers_available(
         mapped_assembly = ASSEMBLY_DETAILS.get(assembly)
         if not mapped_assembly:
             continue
-        vis_blob = None
-        if (request is not None
+        vis_blob = False
+        if (vis_ids is not None
                 and accession is not None
                 and status in VISIBLE_FILE_STATUSES):
-            # use of find_or_make_acc_composite() will recurse!
-            vis_blob = vis_cache.get(accession=accession, assembly=assembly)
+            vis_blob = vis_cache_id(accession, assembly) in vis_ids
         if not vis_blob and file_assemblies is None and files is not None:
             file_assemblies = visualizable_assemblies(assemblies, files)
         if file_types is None:
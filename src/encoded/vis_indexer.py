@@ -1,3 +1,7 @@
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
 from elasticsearch.exceptions import (
     ConflictError,
     ConnectionError,
@@ -34,9 +38,18 @@ from snovault.elasticsearch.indexer_state import (
 
 from .vis_defines import (
     VISIBLE_DATASET_TYPES_LC,
-    VIS_CACHE_INDEX
+    VIS_CACHE_CHUNK_SIZE,
+    VIS_CACHE_INDEX,
+    VisCache,
+)
+from .visualization import (
+    VisDataset,
+    build_vis_datasets,
+    dataset_vis_ids,
+    pool_request,
+    pool_transaction,
+    software_version_ids,
 )
-from .visualization import vis_cache_add
 
 
 log = logging.getLogger(__name__)
@@ -58,6 +71,8 @@ class VisIndexerState(IndexerState):
         self.viscached_set      = self.title + '_viscached'
         self.success_set        = self.viscached_set
         self.cleanup_last_cycle.append(self.viscached_set)  # Clean up at beginning of next cycle
+        self.failed_chunks_list = self.title + '_failed_chunks'
+        self.cleanup_last_cycle.append(self.failed_chunks_list)
         # DO NOT INHERIT! These keys are for passing on to other indexers
         self.followup_prep_list = None                        # No followup to a following indexer
         self.staged_cycles_list = self.title + '_staged'      # Will take from  primary self.staged_for_vis_list
@@ -69,6 +84,19 @@ class VisIndexerState(IndexerState):
     def viscached_uuid(self, uuid):
         self.list_extend(self.viscached_set, [uuid])
 
+    def chunk_failed(self, uuids, error_message, timestamp):
+        '''Records a chunk of uuids that failed as a whole, for display until the next cycle.'''
+        self.list_extend(self.failed_chunks_list, [json.dumps({
+            'error_message': error_message,
+            'timestamp': timestamp,
+            'first_uuid': str(uuids[0]),
+            'uuids': len(uuids),
+        })])
+
+    def schedule(self, uuids):
+        '''Stages uuids for the next cycle the same way the primary indexer hands them off.'''
+        self.list_extend(self.staged_for_vis_list, uuids)
+
     def get_one_cycle(self, xmin, request):
         uuids = []
         next_xmin = None
@@ -123,6 +151,9 @@ class VisIndexerState(IndexerState):
         display = super(VisIndexerState, self).display(uuids=uuids)
         display['staged_to_process'] = self.get_count(self.staged_cycles_list)
         display['datasets_vis_cached_current_cycle'] = self.get_count(self.success_set)
+        failed_chunks = self.get_list(self.failed_chunks_list)
+        if failed_chunks:
+            display['chunks_failed_current_cycle'] = [json.loads(chunk) for chunk in failed_chunks]
         return display
 
 
@@ -252,6 +283,13 @@ class VisIndexer(Indexer):
         self.esstorage = registry[STORAGE]
         self.index = registry.settings['snovault.elasticsearch.index']
         self.state = VisIndexerState(self.es, self.index)  # WARNING, race condition is avoided because there is only one worker
+        # Chunks of uuids are built on a pool of threads, since that is mostly waiting on es and
+        # embeds
+        settings = registry.settings
+        self.workers = int(settings.get('visindexer.workers', 1) or 1)
+        self.chunk_size = int(
+            settings.get('visindexer.chunk_size', VIS_CACHE_CHUNK_SIZE) or VIS_CACHE_CHUNK_SIZE
+        )
 
     def get_from_es(request, comp_id):
         '''Returns composite json blob from elastic-search, or None if not found.'''
@@ -259,48 +297,157 @@ class VisIndexer(Indexer):
 
     def update_objects(self, request, uuids, xmin):
         # pylint: disable=too-many-arguments, unused-argument
-        '''Run indexing process on uuids'''
+        '''Run indexing process on uuids, visindexer.chunk_size at a time on visindexer.workers
+           threads, each chunk with a request and transaction of its own.
+           The indexer state is only updated on this thread.'''
+        chunks = [
+            uuids[offset:offset + self.chunk_size]
+            for offset in range(0, len(uuids), self.chunk_size)
+        ]
         errors = []
-        for i, uuid in enumerate(uuids):
-            error = self.update_object(request, uuid, xmin)
-            if error is not None:
-                errors.append(error)
-            if (i + 1) % 1000 == 0:
-                log.info('Indexing %d', i + 1)
+        indexed = 0
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {
+                    pool.submit(self.update_chunk_in_thread, pool_request(request), chunk): chunk
+                    for chunk in chunks
+                }
+                for future in as_completed(futures):
+                    chunk = futures[future]
+                    errors.extend(self.record_chunk(chunk, future.result()))
+                    indexed += len(chunk)
+                    log.info('Indexing %d of %d', indexed, len(uuids))
+        else:
+            for chunk in chunks:
+                errors.extend(self.record_chunk(chunk, self.update_chunk(request, chunk)))
+                indexed += len(chunk)
+                log.info('Indexing %d of %d', indexed, len(uuids))
         return errors
 
-    def update_object(self, request, uuid, xmin, restart=False):
+    def update_chunk_in_thread(self, request, chunk):
+        '''update_chunk on a pool thread, with a pool_request() of its own.'''
+        with pool_transaction(request):
+            return self.update_chunk(request, chunk)
 
-        last_exc = None
-        # First get the object currently in es
+    def update_chunk(self, request, chunk):
+        '''Builds the vis_datasets of a chunk of uuids and adds them in bulk.
+           Returns (errors, viscached uuids, error message if the chunk failed as a whole).'''
+        errors = []
+        try:
+            docs = []
+            for uuid in chunk:
+                (doc, error) = self.get_object(uuid)
+                if error is not None:
+                    errors.append(error)
+                else:
+                    docs.append((uuid, doc))
+            (docs, unchanged) = self.skip_unchanged(request, docs)
+            self.prefetch_aligners(request, docs)
+            vis_datasets = {}    # {vis_id: vis_dataset} built but not yet added
+            # uuids with something visualizable in vis_datasets or already cached
+            viscached = unchanged
+            for (uuid, doc) in docs:
+                built = self.build_object(request, uuid, doc)
+                vis_datasets.update(built)
+                if any(built.values()):
+                    viscached.append(uuid)
+            if vis_datasets:
+                VisCache(request).add_many(vis_datasets)
+        except StatementError:
+            # Can't reconnect until invalid transaction is rolled back
+            raise
+        except Exception as e:
+            log.error('Error indexing chunk of %d starting with %s', len(chunk), chunk[0],
+                      exc_info=True)
+            return (errors, [], repr(e))
+        return (errors, viscached, None)
+
+    def record_chunk(self, chunk, outcome):
+        '''Accounts for a finished chunk in the indexer state.  Returns its errors.'''
+        (errors, viscached, chunk_error) = outcome
+        if chunk_error is not None:
+            timestamp = datetime.datetime.now().isoformat()
+            self.state.chunk_failed(chunk, chunk_error, timestamp)
+            failed = set(error['uuid'] for error in errors)
+            errors = errors + [
+                {'error_message': chunk_error, 'timestamp': timestamp, 'uuid': str(uuid)}
+                for uuid in chunk if str(uuid) not in failed
+            ]
+        if viscached:
+            self.state.list_extend(self.state.viscached_set, [str(uuid) for uuid in viscached])
+        return errors
+
+    def skip_unchanged(self, request, docs):
+        '''Returns (docs to build, uuids of the rest) where the rest have every vis_dataset cached
+           already, built from the same fields.'''
+        vis_factory = VisDataset(request)
+        hashes = {}  # uuid: (fields_hash, vis_ids)
+        for (uuid, doc) in docs:
+            vis_ids = dataset_vis_ids(doc['embedded'])
+            if vis_ids:
+                hashes[uuid] = (vis_factory.fields_hash(doc['embedded']), vis_ids)
+        cached = VisCache(request).get_many(
+            vis_id for (_, vis_ids) in hashes.values() for vis_id in vis_ids
+        )
+        cached_hashes = {
+            vis_id: vis_dataset.get('fields_hash')
+            for (vis_id, vis_dataset) in cached if vis_dataset
+        }
+        to_build = []
+        unchanged = []
+        for (uuid, doc) in docs:
+            (fields_hash, vis_ids) = hashes.get(uuid, (None, []))
+            if vis_ids and all(cached_hashes.get(vis_id) == fields_hash for vis_id in vis_ids):
+                unchanged.append(uuid)
+            else:
+                to_build.append((uuid, doc))
+        if unchanged:
+            log.debug('Skipped %d of %d with unchanged vis fields', len(unchanged), len(docs))
+        return (to_build, unchanged)
+
+    def prefetch_aligners(self, request, docs):
+        '''Looks up the aligners of a whole chunk of datasets in one search, rather than one per
+           dataset.'''
+        ids = set()
+        for (uuid, doc) in docs:
+            ids.update(software_version_ids(doc['embedded']))
+        try:
+            request.vis_aligners.prefetch(ids)
+        except Exception:
+            # Each dataset will try again
+            log.error('Error looking up %d aligners', len(ids), exc_info=True)
+
+    def get_object(self, uuid):
+        '''Returns (the object currently in es, None) or (None, error).'''
         try:
             result = self.esstorage.get_by_uuid(uuid)  # No reason to restrict by version and that could interfere with reindex all signal.
             #result = self.es.get(index=self.index, id=str(uuid), version=xmin, version_type='external_gte')
-            doc = result.source
+            return (result.source, None)
         except StatementError:
             # Can't reconnect until invalid transaction is rolled back
             raise
         except Exception as e:
             log.error("Error can't find %s in %s", uuid, ELASTIC_SEARCH)
-            last_exc = repr(e)
-
-        ### NOTE: if other work is to be done, this can be renamed "secondary indexer", and work can be added here
-
-        if last_exc is None:
-            try:
-                result = vis_cache_add(
-                    request,
-                    doc['embedded'],
-                    is_vis_indexer=True,
-                )
-                if len(result):
-                    # Warning: potentiallly slow uuid-level accounting, but single process so no concurency issue
-                    self.state.viscached_uuid(uuid)
-            except Exception as e:
-                log.error('Error indexing %s', uuid, exc_info=True)
-                #last_exc = repr(e)
-                pass  # It's only a vis_blob.
-
-        if last_exc is not None:
             timestamp = datetime.datetime.now().isoformat()
-            return {'error_message': last_exc, 'timestamp': timestamp, 'uuid': str(uuid)}
+            return (None, {'error_message': repr(e), 'timestamp': timestamp, 'uuid': str(uuid)})
+
+    ### NOTE: if other work is to be done, this can be renamed "secondary indexer", and work can be
+    ### added here
+
+    def build_object(self, request, uuid, doc):
+        '''Builds the vis_datasets of one object without caching them.
+           Returns {vis_id: vis_dataset}.'''
+        try:
+            return build_vis_datasets(
+                request,
+                doc['embedded'],
+                is_vis_indexer=True,
+            )
+        except Exception:
+            log.error('Error indexing %s', uuid, exc_info=True)
+            return {}  # It's only a vis_blob.
+
+    def update_object(self, request, uuid, xmin, restart=False):
+        errors = self.record_chunk([uuid], self.update_chunk(request, [uuid]))
+        if errors:
+            return errors[0]
@@ -1,25 +1,43 @@
+from pyramid.request import apply_request_extensions
 from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.compat import bytes_
+from pyramid.threadlocal import manager
 from snovault import Item
+from snovault.embed import make_subrequest
 from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager
 from copy import deepcopy
+import hashlib
 import json
 import os
+import threading
+import transaction
 from urllib.parse import (
     parse_qs,
     urlencode,
 )
 from snovault.elasticsearch.interfaces import ELASTIC_SEARCH
+from .cache import LRUCache
 from .vis_defines import (
     ASSEMBLY_TO_UCSC_ID,
     VISIBLE_DATASET_STATUSES,
     VISIBLE_FILE_FORMATS,
     IHEC_DEEP_DIG,
+    SUPPORTED_MASK_TOKENS,
     Sanitize,
     VisDefines,
     IhecDefines,
+    VIS_EXISTS_CACHE,
+    VIS_EXISTS_CACHE_SIZE,
+    VIS_EXISTS_CACHE_TTL,
     VisCache,
+    json_dict_chunks,
     object_is_visualizable
 )
 import time
@@ -35,9 +53,60 @@ def includeme(config):
     config.add_route('batch_hub', '/batch_hub/{search_params}/{txt}')
     config.add_route('batch_hub:trackdb', '/batch_hub/{search_params}/{assembly}/{txt}')
     config.scan(__name__)
+    config.add_request_method(AlignerMemo, 'vis_aligners', reify=True)
+    settings = config.registry.settings
+    cache_size = int(settings.get('visualization.rendered_cache_size', RENDERED_CACHE_SIZE))
+    if cache_size > 0:
+        config.registry[RENDERED_CACHE] = LRUCache(cache_size, RENDERED_CACHE_TTL)
+    page_cache_size = int(settings.get('visualization.hub_page_cache_size', HUB_PAGE_CACHE_SIZE))
+    if page_cache_size > 0:
+        config.registry[HUB_PAGE_CACHE] = LRUCache(page_cache_size, HUB_PAGE_CACHE_TTL)
+    exists_cache_size = int(
+        settings.get('visualization.vis_exists_cache_size', VIS_EXISTS_CACHE_SIZE)
+    )
+    if exists_cache_size > 0:
+        config.registry[VIS_EXISTS_CACHE] = LRUCache(exists_cache_size, VIS_EXISTS_CACHE_TTL)
 
 PROFILE_START_TIME = 0  # For profiling within this module
 
+# Missing vis_datasets are built for hubs by this many threads, for up to this many secs.
+# The rest are left to the vis_indexer, so a big hub is partial rather than a gateway timeout.
+BUILD_WORKERS = 4
+BUILD_BUDGET = 30
+
+# Rendered trackDb text is reused until any vis_dataset it was rendered from is re-cached
+RENDERED_CACHE = 'vis_rendered_cache'
+RENDERED_CACHE_SIZE = 50
+RENDERED_CACHE_TTL = 60 * 60
+RENDERED_CACHE_MAX_TEXT = 1024 * 1024  # streamed text longer than this is not kept
+
+# hub.txt and genomes.txt, which browsers poll constantly, are reused for a few minutes
+HUB_PAGE_CACHE = 'vis_hub_page_cache'
+HUB_PAGE_CACHE_SIZE = 500
+HUB_PAGE_CACHE_TTL = 5 * 60
+
+ALIGNER_SEARCH_CHUNK_SIZE = 100  # software_version @ids per search
+
+# The fields of an embedded dataset and of its files that VisDataset.build reads, with the head of
+# any path a vis_defs mask might look up.  A vis_dataset is only rebuilt when its fields_hash over
+# these changes, so bump VIS_BUILD_VERSION whenever build makes something different of the same
+# fields.
+VIS_BUILD_VERSION = 1
+MASK_TOKEN_FIELDS = frozenset(
+    token[1:-1].split('|')[0].split('.')[0] for token in SUPPORTED_MASK_TOKENS
+)
+VIS_DATASET_FIELDS = MASK_TOKEN_FIELDS.union([
+    '@id', '@type', 'accession', 'annotation_type', 'assay_term_id', 'assay_term_name',
+    'assay_title', 'assembly', 'award', 'biosample_ontology', 'biosample_summary', 'control_type',
+    'files', 'lab', 'replicates', 'status', 'target',
+])
+VIS_FILE_FIELDS = MASK_TOKEN_FIELDS.union([
+    '@id', 'accession', 'analysis_step_version', 'assembly', 'biological_replicates',
+    'cloud_metadata', 'dataset', 'derived_from', 'file_format', 'file_format_type', 'href', 'lab',
+    'md5sum', 'output_type', 'replicate', 'status', 'submitted_file_name', 'tech_replicates',
+    'technical_replicates',
+]).difference(['rep_tech', 'rep_tag'])  # set on files by build itself
+
 # ASSEMBLY_FAMILIES is needed to ensure that mm10 and mm10-minimal will
 #                   get combined into the same trackHub.txt
 # This is necessary because mm10 and mm10-minimal are only mm10 at UCSC,
@@ -81,6 +150,7 @@ class VisCollections(object):
         self.vis_by_types = {}   # dict of assay based composites of files from vis_datasets
         self.found = 0
         self.built = 0
+        self.deferred = []  # accessions left for the vis_indexer
         self.regen_requested = False
         self.request = request
         self.page_requested = self.request.url.split('/')[-1]
@@ -111,10 +181,15 @@ class VisCollections(object):
         self.vis_datasets = self.vis_cache.search(accessions, assembly)
         return self.vis_datasets
 
-    def find_or_build(self, accessions, assembly, hide=False, must_build=False):
+    def find_or_build(self, accessions, assembly, hide=False, must_build=False, uuids=None):
+        '''Finds cached vis_datasets and builds those missing, within the
+           visualization.build_budget.
+           uuids: {accession: uuid} so that datasets left unbuilt can be handed to the
+           vis_indexer.'''
         self.vis_by_types = {}
         self.found = 0
         self.built = 0
+        self.deferred = []
 
         if not must_build:
             (page, suffix, cmd) = urlpage(self.page_requested)
@@ -124,29 +199,146 @@ class VisCollections(object):
         if not must_build:
             self.vis_datasets = self.find(accessions, assembly)
             self.found = self.len()
-            if self.found > 0:
-                accessions = []
-            # Don't bother if cache is primed.
-            # if self.found < (len(accessions) * 3 / 4):  # some heuristic to decide when too few means regenerate
-            #     missing = list(set(accs) - set(self.vis_datasets.keys()))
+            ucsc_assembly = ASSEMBLY_TO_UCSC_ID.get(assembly, assembly)
+            accessions = [accession for accession in accessions
+                          if accession + '_' + ucsc_assembly not in self.vis_datasets]
 
         if len(accessions) > 0:  # accessions not found in cache... try generating (for pre-primed-cache access)
-            vis_factory = VisDataset(self.request)
-            for accession in accessions:
-                vis_dataset = vis_factory.find_or_build(accession, assembly, dataset=None, hide=hide, must_build=True)
-                # vis_dataset could legitimately be {}... no visualizable files.
-                if vis_factory.built:
-                    self.built += 1
-                else:
-                    self.found += 1  # Not expecting this since find turned up empty!
-                self.add_one(accession, vis_dataset)
+            self.deferred = self.build_many(accessions, assembly, hide)
+            if self.deferred:
+                self.schedule_for_vis_indexer(self.deferred, uuids)
         return self.vis_datasets
 
+    def build_one(self, accession, assembly, hide, request=None):
+        '''Builds and caches one vis_dataset on request, by default this collection's.
+           Returns (vis_dataset, built).'''
+        vis_factory = VisDataset(request or self.request)
+        vis_dataset = vis_factory.find_or_build(
+            accession, assembly, dataset=None, hide=hide, must_build=True
+        )
+        return (vis_dataset, vis_factory.built)
+
+    def build_one_in_thread(self, request, accession, assembly, hide):
+        '''build_one on a pool thread, with a pool_request() of its own.'''
+        with pool_transaction(request):
+            return self.build_one(accession, assembly, hide, request)
+
+    def add_built(self, accession, vis_dataset, built):
+        # vis_dataset could legitimately be {}... no visualizable files.
+        if built:
+            self.built += 1
+        else:
+            self.found += 1  # Not expecting this since find turned up empty!
+        self.add_one(accession, vis_dataset)
+
+    def build_many(self, accessions, assembly, hide=False):
+        '''Builds vis_datasets on visualization.build_workers threads until
+           visualization.build_budget secs have passed.  Returns the accessions left unbuilt, so a
+           hub can be emitted before the gateway gives up.'''
+        settings = self.request.registry.settings
+        workers = int(settings.get('visualization.build_workers', BUILD_WORKERS) or 1)
+        budget = float(settings.get('visualization.build_budget', BUILD_BUDGET) or 0)
+        deadline = (time.time() + budget) if budget > 0 else None
+        to_build = list(accessions)
+        self.prefetch_aligners(to_build)
+
+        if workers <= 1:
+            while to_build and (deadline is None or time.time() < deadline):
+                accession = to_build.pop(0)
+                self.add_built(accession, *self.build_one(accession, assembly, hide))
+            return to_build
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        pending = {}
+        finished = 0
+        try:
+            while to_build or pending:
+                # Only a few builds are queued ahead, so nothing much is started once the budget
+                # is spent
+                while (to_build and len(pending) < workers * 2 and
+                       (deadline is None or time.time() < deadline)):
+                    accession = to_build.pop(0)
+                    future = pool.submit(
+                        self.build_one_in_thread, pool_request(self.request), accession, assembly,
+                        hide
+                    )
+                    pending[future] = accession
+                if not pending:
+                    break
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                (done, not_done) = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break  # out of time
+                for future in done:
+                    accession = pending.pop(future)
+                    try:
+                        self.add_built(accession, *future.result())
+                    except Exception:
+                        log.error('Error building vis_dataset for %s', accession, exc_info=True)
+                    finished += 1
+                    if finished % 100 == 0:
+                        log.info('Built %d of %d vis_datasets', finished, len(accessions))
+        finally:
+            # Nothing more is started, but builds already running are waited for so none outlives
+            # this request
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+        unbuilt = []
+        for (future, accession) in pending.items():
+            if future.cancelled():
+                unbuilt.append(accession)
+                continue
+            try:
+                self.add_built(accession, *future.result())
+            except Exception:
+                log.error('Error building vis_dataset for %s', accession, exc_info=True)
+        return unbuilt + to_build
+
+    def prefetch_aligners(self, accessions):
+        '''Looks up the aligners of all the datasets about to be built at once, rather than in a
+           search per build, with concurrent builds all missing the memo for the same ones.'''
+        ids = set()
+        try:
+            for offset in range(0, len(accessions), ALIGNER_SEARCH_CHUNK_SIZE):
+                params = {
+                    'type': 'Dataset',
+                    'accession': accessions[offset:offset + ALIGNER_SEARCH_CHUNK_SIZE],
+                    'field': ['files.file_format', 'files.analysis_step_version.software_versions'],
+                    'limit': 'all',
+                }
+                path = '/search/?%s' % urlencode(params, True)
+                for dataset in self.request.embed(path, as_user=True)['@graph']:
+                    ids.update(software_version_ids(dataset))
+            self.request.vis_aligners.prefetch(ids)
+        except Exception:
+            # Each build will look up its own
+            log.error('Error looking up aligners of %d datasets', len(accessions), exc_info=True)
+
+    def schedule_for_vis_indexer(self, accessions, uuids=None):
+        '''Hands accessions that could not be built in time to the vis_indexer, which will cache
+           them.'''
+        uuids = uuids or {}
+        scheduled = [uuids[accession] for accession in accessions if accession in uuids]
+        log.warn('Out of time building vis_datasets: %d of %d left to the vis_indexer' %
+                 (len(scheduled), len(accessions)))
+        es = self.request.registry.get(ELASTIC_SEARCH)
+        if not scheduled or es is None:
+            return
+        from .vis_indexer import VisIndexerState  # vis_indexer imports this module
+        try:
+            index = self.request.registry.settings['snovault.elasticsearch.index']
+            VisIndexerState(es, index).schedule(scheduled)
+        except Exception:
+            log.error('Failed to schedule vis_datasets for the vis_indexer', exc_info=True)
+
     def found_or_built(self, assays=True):
         if assays:
-            return "vis_by_types: %d from %d (%d found, %d built)" % \
-                    (len(self.vis_by_types), len(self.vis_datasets), self.found, self.built)
-        return "%d gathered: %d found, %d built" % (len(self.vis_datasets), self.found, self.built)
+            return "vis_by_types: %d from %d (%d found, %d built, %d deferred)" % \
+                    (len(self.vis_by_types), len(self.vis_datasets), self.found, self.built,
+                     len(self.deferred))
+        return "%d gathered: %d found, %d built, %d deferred" % \
+                (len(self.vis_datasets), self.found, self.built, len(self.deferred))
 
     def insert_live_group(self, live_groups, new_tag, new_group):
         '''Inserts new group into a set of live groups during remodelling to vis_asset coolections.'''
@@ -309,41 +501,47 @@ class VisCollections(object):
 
     def ucsc_trackDb(self):
         '''Formats collection into UCSC trackDb.ra text'''
-        trackdb_txt = ""
+        return ''.join(self.ucsc_trackDb_chunks())
 
+    def ucsc_trackDb_chunks(self):
+        '''Yields the UCSC trackDb.ra text of the collection a track at a time'''
         vis_defines = VisDefines(self.request)
 
-        if self.vis_by_types:
-            for tag in sorted(self.vis_by_types.keys()):
-                trackdb_txt += vis_defines.ucsc_single_composite_trackDb(self.vis_by_types[tag], tag)
-        else:
-            for tag in sorted(self.vis_datasets.keys()):
-                trackdb_txt += vis_defines.ucsc_single_composite_trackDb(self.vis_datasets[tag], tag)
-        return trackdb_txt
+        vis_formats = self.vis_by_types if self.vis_by_types else self.vis_datasets
+        for tag in sorted(vis_formats.keys()):
+            yield from vis_defines.ucsc_composite_trackDb_chunks(vis_formats[tag], tag)
 
-    def stringify(self, prepend_label=None):
-        '''returns string of trakDb.txt or json as appropriate.'''
+    def stringify(self, prepend_label=None, stream=False):
+        '''returns string of trakDb.txt or json as appropriate.
+           When streaming, may instead return an iterable of text chunks.'''
 
         (page, suffix, cmd) = urlpage(self.page_requested)
         json_out = (suffix == 'json')                 # .../trackDb.json
         vis_json = (page == 'vis_blob' and json_out)  # .../vis_blob.json
         ihec_out = (page == 'ihec' and json_out)      # .../ihec.json
 
-        if self.len():
+        if not self.len():
+            return ""
+
+        def render():
             if ihec_out:
-                return json.dumps(self.remodel_to_ihec_json(), indent=4, sort_keys=True)
+                return IhecDefines(self.request).remodel_to_json_chunks(
+                    self.host, self.vis_datasets
+                )
             if vis_json:
-                return json.dumps(self.vis_datasets, indent=4, sort_keys=True)
+                return json_dict_chunks(sorted(self.vis_datasets.items()))
             else:
                 vis_by_types = self.remodel_to_type_collections(hide_after=100)
                 if prepend_label is not None:
                     vis_by_types = self.prepend_assay_labels(prepend_label)
 
                 if json_out:
-                    return json.dumps(vis_by_types, indent=4, sort_keys=True)
+                    return json_dict_chunks(sorted(vis_by_types.items()))
                 else:
-                    return self.ucsc_trackDb()
-        return ""
+                    return self.ucsc_trackDb_chunks()
+
+        return render_vis_datasets(self.request, self.vis_datasets, render, page, suffix,
+                                   prepend_label, stream=stream)
 
 class VisDataset(object):
     # Finds, builds, stores, remodels vis_blobs
@@ -368,7 +566,9 @@ class VisDataset(object):
             self.ucsc_assembly = self.vis_dataset['ucsc_assembly']
             self.vis_id = self.vis_dataset['vis_id']
 
-    def find_or_build(self, accession, assembly, dataset=None, hide=False, must_build=False):
+    def find_or_build(self, accession, assembly, dataset=None, hide=False, must_build=False,
+                      store=True):
+        '''Returns the cached vis_dataset, or builds it and, if store, caches it.'''
         self.found = False
         self.built = False
         self.vis_dataset = None
@@ -399,7 +599,9 @@ class VisDataset(object):
             assert(self.accession == self.dataset['accession'])
 
             self.vis_dataset = self.build(hide)
-            self.vis_cache.add(self.vis_id, self.vis_dataset)  # Added even if empty (valid state)
+            if store:
+                # Added even if empty (valid state)
+                self.vis_cache.add(self.vis_id, self.vis_dataset)
             if self.vis_dataset:
                 self.built = True
 
@@ -916,11 +1118,7 @@ class VisDataset(object):
 
         if software_files:
             aligners = {'files': {}, 'rep_techs': {}}
-            # TODO: software_type='aligner' is weakly associated!
-            # Note: lab!=/labs/encode-processing-pipeline/ should eliminate analysis_steps themselves
-            params = { 'type': 'SoftwareVersion', 'software.software_type': 'aligner', '@id': software_files.keys() }
-            path = '/search/?%s&software.lab!=/labs/encode-processing-pipeline/&frame=embedded' % (urlencode(params, True))
-            results = self.request.embed(path, as_user=True)['@graph']
+            results = self.request.vis_aligners.get_many(software_files.keys())
             # More than one for some: LRNA (star v. tophat)
             for sw_version in results:
                 swv_key = sw_version['@id']
@@ -1030,6 +1228,8 @@ class VisDataset(object):
             log.debug("%s (vis_type: %s) has undiscoverable vis_defs." %
                     (self.dataset["accession"], vis_type))
             return {}
+        # before build adds rep_tech and rep_tag to files
+        fields_hash = self.fields_hash(self.dataset, hide)
         self.vis_dataset = {}
         # log.debug("%s has vis_type: %s." % (self.dataset["accession"],vis_type))
         self.vis_dataset["vis_type"] = vis_type
@@ -1080,8 +1280,23 @@ class VisDataset(object):
             # Already warned about files log.debug("No tracks for %s" % self.dataset["accession"])
             return {}
         self.vis_dataset["tracks"] = tracks
+        self.vis_dataset["fields_hash"] = fields_hash
         return self.vis_dataset
 
+    def fields_hash(self, dataset, hide=False):
+        '''Returns a hash of just what goes into building the vis_datasets of an embedded
+           dataset.'''
+        fields = {key: dataset[key] for key in VIS_DATASET_FIELDS if key in dataset}
+        if 'files' in fields:
+            fields['files'] = [
+                {key: a_file[key] for key in VIS_FILE_FIELDS if key in a_file}
+                if isinstance(a_file, dict) else a_file
+                for a_file in fields['files']
+            ]
+        vis_defs_digest = VisDefines(self.request).vis_defs_digest()
+        basis = [VIS_BUILD_VERSION, vis_defs_digest, self.host, hide, fields]
+        return hashlib.sha1(json.dumps(basis, sort_keys=True).encode('utf-8')).hexdigest()
+
     def len(self):
         if self.vis_dataset:
             return len(json.dumps(self.vis_dataset))
@@ -1126,42 +1341,259 @@ class VisDataset(object):
         vis_json = (page == 'vis_blob' and json_out)  # .../vis_blob.json
         ihec_out = (page == 'ihec' and json_out)      # .../ihec.json
 
-        if ihec_out:
-            return json.dumps(self.remodel_to_ihec_json(), indent=4, sort_keys=True)
-        if vis_json:
-            return json.dumps(self.vis_dataset, indent=4, sort_keys=True)
-        elif json_out:
-            return json.dumps(self.as_collection(), indent=4, sort_keys=True)
+        def render():
+            if ihec_out:
+                return [json.dumps(self.remodel_to_ihec_json(), indent=4, sort_keys=True)]
+            if vis_json:
+                return [json.dumps(self.vis_dataset, indent=4, sort_keys=True)]
+            elif json_out:
+                return [json.dumps(self.as_collection(), indent=4, sort_keys=True)]
 
-        return self.ucsc_trackDb()
+            return [self.ucsc_trackDb()]
 
+        return render_vis_datasets(self.request, self.as_collection(), render, page, suffix,
+                                   self.vis_id, one_dataset=True)
 
-def vis_cache_add(request, dataset, is_vis_indexer=False):
-    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant assembly.'''
+
+def build_vis_datasets(request, dataset, is_vis_indexer=False):
+    '''For a single embedded dataset, builds {vis_id: vis_dataset} for each relevant assembly
+       without caching them.'''
     if (
             not is_vis_indexer and
             not object_is_visualizable(dataset, exclude_quickview=True)
         ):
-        return []
+        return {}
 
-    if 'accession' not in dataset or 'assembly' not in dataset:
-        return []
+    if not dataset_vis_ids(dataset):
+        return {}
 
     accession = dataset['accession']
     assemblies = dataset['assembly']
 
-    vis_datasets = []
+    vis_datasets = {}
     vis_factory = VisDataset(request)
     for assembly in assemblies:
-        vis_dataset = vis_factory.find_or_build(accession, assembly, dataset, must_build=True)
-        if vis_dataset:  # Don't bother caching empties (e.g. {} == no visualizable files).
-            vis_datasets.append(vis_dataset)
-            log.debug("primed vis_cache with vis_dataset %s '%s'" %
-                        (vis_factory.vis_id, vis_factory.vis_type))
+        vis_dataset = vis_factory.find_or_build(
+            accession, assembly, dataset, must_build=True, store=False
+        )
+        vis_datasets[vis_factory.vis_id] = vis_dataset  # Added even if empty (valid state)
+        if vis_dataset:
+            log.debug("built vis_dataset %s '%s'" % (vis_factory.vis_id, vis_factory.vis_type))
 
     return vis_datasets
 
 
+def dataset_vis_ids(dataset):
+    '''Returns the vis_ids of the vis_datasets built for an embedded dataset, one per assembly.'''
+    if 'accession' not in dataset or 'assembly' not in dataset:
+        return []
+    return ["%s_%s" % (dataset['accession'], ASSEMBLY_TO_UCSC_ID.get(assembly, assembly))
+            for assembly in dataset['assembly']]
+
+
+class AlignerMemo(object):
+    '''Aligner software_versions by @id, fetched once for all the vis_datasets built on a request
+       (a batch hub, or a vis_indexer cycle) rather than by a search per dataset.'''
+
+    def __init__(self, request):
+        self.request = request
+        # software_version @id: embedded software_version, or None if not an aligner
+        self.aligners = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, ids):
+        '''Fetches the software_versions not already known, ALIGNER_SEARCH_CHUNK_SIZE to a
+           search.'''
+        with self.lock:
+            missing = sorted(set(ids) - set(self.aligners))
+        for offset in range(0, len(missing), ALIGNER_SEARCH_CHUNK_SIZE):
+            chunk = missing[offset:offset + ALIGNER_SEARCH_CHUNK_SIZE]
+            # TODO: software_type='aligner' is weakly associated!
+            # Note: lab!=/labs/encode-processing-pipeline/ should eliminate analysis_steps
+            # themselves
+            params = {
+                'type': 'SoftwareVersion',
+                'software.software_type': 'aligner',
+                '@id': chunk,
+                'limit': 'all'
+            }
+            path = ('/search/?%s&software.lab!=/labs/encode-processing-pipeline/&frame=embedded' %
+                    (urlencode(params, True)))
+            results = self.request.embed(path, as_user=True)['@graph']
+            found = dict.fromkeys(chunk)
+            found.update((sw_version['@id'], sw_version) for sw_version in results)
+            with self.lock:
+                self.aligners.update(found)
+
+    def get_many(self, ids):
+        '''Returns the aligner software_versions among ids.'''
+        ids = list(ids)
+        self.prefetch(ids)
+        with self.lock:
+            return [self.aligners[swv_key] for swv_key in ids if self.aligners.get(swv_key)]
+
+    def shared_with(self, request):
+        '''Returns a memo of the same aligners that fetches any others through request.'''
+        memo = AlignerMemo(request)
+        memo.aligners = self.aligners
+        memo.lock = self.lock
+        return memo
+
+
+def pool_request(request):
+    '''Returns a request of its own for work on a pool thread, as the user of request, with its
+       registry, datastore and vis_aligners.  Embeds keep state on their request, so threads can't
+       share one.'''
+    subrequest = make_subrequest(request, request.path_qs)
+    subrequest.registry = request.registry
+    apply_request_extensions(subrequest)
+    subrequest.invoke_subrequest = request.invoke_subrequest
+    subrequest.datastore = request.datastore
+    subrequest._stats = {}
+    subrequest.vis_aligners = request.vis_aligners.shared_with(subrequest)
+    return subrequest
+
+
+@contextmanager
+def pool_transaction(request):
+    '''Pushes a pool_request() onto the threadlocals of this pool thread, in a read only
+       transaction of its own that is aborted after.  pyramid_tm only ends the transaction of the
+       thread that began the request, so the session of a pool thread would otherwise be left open,
+       or invalid after a StatementError.'''
+    txn = transaction.begin()
+    txn.doom()
+    manager.push({'request': request, 'registry': request.registry})
+    try:
+        yield request
+    finally:
+        manager.pop()
+        transaction.abort()
+
+
+def software_version_ids(dataset):
+    '''Returns the @ids of software_versions that produced the bam files of an embedded dataset,
+       or of a search result with those fields.'''
+    ids = set()
+    for a_file in dataset.get('files', []):
+        if not isinstance(a_file, dict) or a_file.get('file_format') != 'bam':
+            continue
+        step_ver = a_file.get('analysis_step_version')
+        if not isinstance(step_ver, dict):
+            continue
+        for sw_version in step_ver.get('software_versions') or []:
+            if isinstance(sw_version, dict):
+                sw_version = sw_version.get('@id')
+            if isinstance(sw_version, str):
+                ids.add(sw_version)
+    return ids
+
+
+def vis_datasets_last_modified(vis_datasets):
+    '''Returns when the latest of the vis_datasets was cached, or None if that can't be known.'''
+    stamps = [
+        vis_dataset.get('last_modified') for vis_dataset in vis_datasets.values() if vis_dataset
+    ]
+    if not stamps or None in stamps:  # vis_datasets cached before they were stamped
+        return None
+    return max(stamps)
+
+
+def render_vis_datasets(request, vis_datasets, render, *variant, stream=False, one_dataset=False):
+    '''Returns the text of render() chunks of vis_datasets, reusing the text rendered for the same
+       variant (e.g. page and suffix) of the same vis_datasets, as last cached.
+       Once every vis_dataset was stamped when cached, the text is the same wherever these are
+       rendered by the same app version, so that is what the strong ETag is over.  The Last-Modified
+       is when the latest was cached, or when a collection, whose membership can change, was first
+       seen with these members if that is later: gaining an older vis_dataset modifies it too.
+       When streaming, text not already cached is returned as the chunks, to be cached once they
+       are consumed.'''
+    # Keyed before rendering, since rendering remodels the vis_datasets in place
+    stamps = sorted(
+        (key, vis_dataset.get('vis_id'), vis_dataset.get('last_modified'))
+        if vis_dataset else (key, None, None)
+        for (key, vis_dataset) in vis_datasets.items()
+    )
+    digest = hashlib.sha1(json.dumps(stamps).encode('utf-8')).hexdigest()
+    stamped = all(vis_dataset.get('last_modified') is not None
+                  for vis_dataset in vis_datasets.values() if vis_dataset)
+    last_modified = vis_datasets_last_modified(vis_datasets)
+    strip_vis_cache_stamps(vis_datasets)
+
+    key = (request.host_url,) + variant + (digest,)
+    cache = request.registry.get(RENDERED_CACHE)
+    entry = cache.get(key) if cache is not None else None  # (when first seen, text if kept)
+    if entry is None:
+        entry = (time.time(), None)
+        if cache is not None:
+            cache.set(key, entry)
+    (first_seen, text) = entry
+
+    if stamped:  # else respond_with_text falls back on an md5 of the text
+        version = request.registry.settings.get('snovault.app_version')
+        request.response.etag = hashlib.sha1(json.dumps([version, key]).encode('utf-8')).hexdigest()
+        modified = [last_modified] if last_modified is not None else []
+        if not one_dataset and cache is not None:
+            modified.append(first_seen)
+        if modified:
+            request.response.last_modified = int(max(modified))
+
+    if text is None:
+        if stream:
+            return tee_rendered(cache, key, first_seen, render()) if cache is not None else render()
+        text = ''.join(render())
+        if cache is not None:
+            cache.set(key, (first_seen, text))
+    return text
+
+
+def render_hub_page(request, render):
+    '''Returns the text of a hub.txt or genomes.txt, reusing what was rendered for the same url and
+       user for HUB_PAGE_CACHE_TTL secs.  The Last-Modified is when it was rendered, and
+       respond_with_text adds an ETag.'''
+    cache = request.registry.get(HUB_PAGE_CACHE)
+    key = (request.url, tuple(sorted(request.effective_principals)))
+    entry = cache.get(key) if cache is not None else None  # (when rendered, text)
+    if entry is None:
+        entry = (time.time(), render())
+        if cache is not None:
+            cache.set(key, entry)
+    request.response.last_modified = int(entry[0])
+    return entry[1]
+
+
+def strip_vis_cache_stamps(vis_datasets):
+    '''Removes what the vis_cache stamps on vis_datasets, which is not for output.'''
+    for vis_dataset in vis_datasets.values():
+        if vis_dataset:
+            vis_dataset.pop('last_modified', None)
+            vis_dataset.pop('fields_hash', None)
+
+
+def tee_rendered(cache, key, first_seen, chunks):
+    '''Passes rendered chunks through, caching their text once all are consumed unless it is too
+       long to keep.'''
+    kept = []
+    size = 0
+    for chunk in chunks:
+        if kept is not None:
+            kept.append(chunk)
+            size += len(chunk)
+            if size > RENDERED_CACHE_MAX_TEXT:
+                kept = None
+        yield chunk
+    if kept is not None:
+        cache.set(key, (first_seen, ''.join(kept)))
+
+
+def vis_cache_add(request, dataset, is_vis_indexer=False):
+    '''For a single embedded dataset, builds and adds vis_dataset to es cache for each relevant
+       assembly.'''
+    vis_datasets = build_vis_datasets(request, dataset, is_vis_indexer)
+    VisCache(request).add_many(vis_datasets)
+    # Don't bother returning empties (e.g. {} == no visualizable files).
+    return [vis_dataset for vis_dataset in vis_datasets.values() if vis_dataset]
+
+
 def generate_trackDb(request, dataset, assembly, hide=False, regen=False):
     '''Returns string content for a requested  single experiment trackDb.txt.'''
     # local test: bigBed: curl http://localhost:8000/experiments/ENCSR000DZQ/@@hub/hg19/trackDb.txt
@@ -1190,16 +1622,21 @@ def generate_trackDb(request, dataset, assembly, hide=False, regen=False):
     return vis_factory.stringify()
 
 
-def generate_by_accessions(request, accessions, assembly, hide, regen, prepend_label=None):
+def generate_by_accessions(request, accessions, assembly, hide, regen, prepend_label=None,
+                           uuids=None):
     '''Actual generation of trackDb for collections (batch and file_sets).'''
 
     vis_collection = VisCollections(request)
-    vis_datasets = vis_collection.find_or_build(accessions, assembly, hide, must_build=regen)
+    vis_datasets = vis_collection.find_or_build(
+        accessions, assembly, hide, must_build=regen, uuids=uuids
+    )
 
-    blob = vis_collection.stringify(prepend_label)
+    blob = vis_collection.stringify(prepend_label, stream=True)
 
-    msg = "%s. len(txt):%s  %.3f secs" % \
-                 (vis_collection.found_or_built(), len(blob), (time.time() - PROFILE_START_TIME))
+    msg = "%s. %s  %.3f secs" % \
+                 (vis_collection.found_or_built(),
+                  ("len(txt):%s" % len(blob)) if isinstance(blob, str) else "streamed",
+                  (time.time() - PROFILE_START_TIME))
     if vis_collection.regen_requested:  # Want to see message if regen was requested
         log.info(msg)
     else:
@@ -1212,6 +1649,7 @@ def generate_set_trackDb(request, accession, dataset, assembly, hide=False, rege
     '''Handles 'Series' and 'FileSet' dataset types similar to search results.'''
 
     sub_accessions = []
+    uuids = {}
     related_datasets = []
     if 'FileSet' in dataset['@type'] and 'files' in dataset:
         files = dataset['files']
@@ -1228,6 +1666,8 @@ def generate_set_trackDb(request, accession, dataset, assembly, hide=False, rege
         try:
             if isinstance(related_datasets[0],dict):
                 sub_accessions = [ related['accession'] for related in related_datasets ]
+                uuids = { related['accession']: related['uuid']
+                          for related in related_datasets if 'uuid' in related }
             else:
                 sub_accessions = [ related.split('/')[1] for related in related_datasets ]
         except:
@@ -1237,7 +1677,8 @@ def generate_set_trackDb(request, accession, dataset, assembly, hide=False, rege
         log.error("failed to find true datasets for files in collection %s" % accession)
         return ""
 
-    return generate_by_accessions(request, sub_accessions, assembly, hide, regen, prepend_label=accession)
+    return generate_by_accessions(request, sub_accessions, assembly, hide, regen,
+                                  prepend_label=accession, uuids=uuids)
 
 
 def generate_batch_trackDb(request, hide=False, regen=False):
@@ -1269,9 +1710,10 @@ def generate_batch_trackDb(request, hide=False, regen=False):
     # Note: better memory usage to get accession array from non-embedded results,
     # since acc_composites should be in cache
     accessions = [result['accession'] for result in results]
+    uuids = {result['accession']: result['uuid'] for result in results if 'uuid' in result}
     del results
 
-    return generate_by_accessions(request, accessions, assembly, hide, regen)
+    return generate_by_accessions(request, accessions, assembly, hide, regen, uuids=uuids)
 
 
 #def readable_time(secs_float):
@@ -1412,59 +1854,9 @@ def generate_batch_hubs(context, request):
         return generate_batch_trackDb(request)
 
     elif page == 'hub' and suffix == 'txt':
-        terms = request.matchdict['search_params'].replace(',,', '&')
-        pairs = terms.split('&')
-        label = "search:"
-        for pair in sorted(pairs):
-            (var, val) = pair.split('=')
-            if var not in ["type", "assembly", "status", "limit"]:
-                label += " %s" % val.replace('+', ' ')
-        return '\n'.join(get_hub(label, request.url))
+        return render_hub_page(request, lambda: batch_hub_txt(request))
     elif page == 'genomes' and suffix == 'txt':
-        search_params = request.matchdict['search_params']
-        if search_params.find('bed6+') > -1:
-            search_params = search_params.replace('bed6+,,','bed6%2B,,')
-        log.debug('search_params: %s' % (search_params))
-        #param_list = parse_qs(request.matchdict['search_params'].replace(',,', '&'))
-        param_list = parse_qs(search_params.replace(',,', '&'))
-        log.debug('parse_qs: %s' % (param_list))
-
-        view = 'search'
-        if 'region' in param_list:
-            view = 'region-search'
-        path = '/%s/?%s' % (view, urlencode(param_list, True))
-        log.debug('Path in hunt for assembly %s' % (path))
-        results = request.embed(path, as_user=True)
-        # log.debug("generate_batch(genomes) len(results) = %d   %.3f secs" %
-        #           (len(results),(time.time() - PROFILE_START_TIME)))
-        g_text = ''
-        if 'assembly' in param_list:
-            g_text = get_genomes_txt(param_list.get('assembly'))
-        else:
-            for facet in results['facets']:
-                if facet['field'] == 'assembly':
-                    assemblies = []
-                    for term in facet['terms']:
-                        if term['doc_count'] != 0:
-                            assemblies.append(term['key'])
-                    if len(assemblies) > 0:
-                        g_text = get_genomes_txt(assemblies)
-            if g_text == '':
-                assembly_set = {
-                    result['assemblies']
-                    for result in results['@graph']
-                    if 'assemblies' in result
-                }
-                if len(assembly_set) > 0:
-                    g_text = get_genomes_txt(list(assembly_set))
-                    log.debug(
-                        'Requesting %s.%s#%s NO ASSEMBLY !!!  Found %d anyway' %
-                        (page, suffix, cmd, len(assembly_set))
-                    )
-                else:
-                    g_text = json.dumps(results, indent=4)
-                    log.debug('Found 0 ASSEMBLIES !!!')
-        return g_text
+        return render_hub_page(request, lambda: batch_genomes_txt(request))
 
     else:
         # Should generate a HTML page for requests other than those supported
@@ -1472,16 +1864,92 @@ def generate_batch_hubs(context, request):
                        'ENCODE data use policy</p>')
         return generate_html(context, request) + data_policy
 
+
+def batch_hub_txt(request):
+    '''Returns the hub.txt of a batch hub.'''
+    terms = request.matchdict['search_params'].replace(',,', '&')
+    pairs = terms.split('&')
+    label = "search:"
+    for pair in sorted(pairs):
+        (var, val) = pair.split('=')
+        if var not in ["type", "assembly", "status", "limit"]:
+            label += " %s" % val.replace('+', ' ')
+    return '\n'.join(get_hub(label, request.url))
+
+
+def batch_genomes_txt(request):
+    '''Returns the genomes.txt of a batch hub, with the assemblies of its search.'''
+    (page, suffix, cmd) = urlpage(request.url)
+    search_params = request.matchdict['search_params']
+    if search_params.find('bed6+') > -1:
+        search_params = search_params.replace('bed6+,,','bed6%2B,,')
+    log.debug('search_params: %s' % (search_params))
+    #param_list = parse_qs(request.matchdict['search_params'].replace(',,', '&'))
+    param_list = parse_qs(search_params.replace(',,', '&'))
+    log.debug('parse_qs: %s' % (param_list))
+
+    view = 'search'
+    if 'region' in param_list:
+        view = 'region-search'
+    path = '/%s/?%s' % (view, urlencode(param_list, True))
+    log.debug('Path in hunt for assembly %s' % (path))
+    results = request.embed(path, as_user=True)
+    # log.debug("generate_batch(genomes) len(results) = %d   %.3f secs" %
+    #           (len(results),(time.time() - PROFILE_START_TIME)))
+    g_text = ''
+    if 'assembly' in param_list:
+        g_text = get_genomes_txt(param_list.get('assembly'))
+    else:
+        for facet in results['facets']:
+            if facet['field'] == 'assembly':
+                assemblies = []
+                for term in facet['terms']:
+                    if term['doc_count'] != 0:
+                        assemblies.append(term['key'])
+                if len(assemblies) > 0:
+                    g_text = get_genomes_txt(assemblies)
+        if g_text == '':
+            assembly_set = {
+                result['assemblies']
+                for result in results['@graph']
+                if 'assemblies' in result
+            }
+            if len(assembly_set) > 0:
+                g_text = get_genomes_txt(list(assembly_set))
+                log.debug(
+                    'Requesting %s.%s#%s NO ASSEMBLY !!!  Found %d anyway' %
+                    (page, suffix, cmd, len(assembly_set))
+                )
+            else:
+                g_text = json.dumps(results, indent=4)
+                log.debug('Found 0 ASSEMBLIES !!!')
+    return g_text
+
+
 def respond_with_text(request, text, content_mime):
     '''Resonse that can handle range requests.'''
     # UCSC broke trackhubs and now we must handle byterange requests on these CGI files
     response = request.response
     response.content_type = content_mime
     response.charset = 'UTF-8'
+    if not isinstance(text, str):  # chunks, from a hub too big to hold rendered
+        if 'Range' not in request.headers:
+            # Only streamed with the ETag render_vis_datasets set, since an md5 would need the
+            # whole body
+            response.app_iter = (bytes_(chunk, 'utf-8') for chunk in text)
+            response.conditional_response = response.etag is not None
+            return response
+        text = ''.join(text)
     response.body = bytes_(text, 'utf-8')
     response.accept_ranges = "bytes"
-    response.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
-    if 'Range' in request.headers:
+    # ETag and Last-Modified are set by those rendering from vis_datasets, which know when they
+    # were cached
+    if response.etag is None:
+        response.md5_etag()
+    # 304 Not Modified when If-None-Match or If-Modified-Since hold
+    response.conditional_response = True
+    # A range of what the client already holds part of, else If-Range asks for all of it
+    if 'Range' in request.headers and response in request.if_range:
         range_request = True
         range = request.headers['Range']
         if range.startswith('bytes'):
@@ -1501,27 +1969,16 @@ def hub(context, request):
     global PROFILE_START_TIME
     PROFILE_START_TIME = time.time()
 
-    embedded = request.embed(request.resource_path(context))
-
     (page,suffix,cmd) = urlpage(request.url)
     content_mime = 'text/plain'
     if page == 'hub' and suffix == 'txt':
-        typeof = embedded.get("assay_title")
-        if typeof is None:
-            typeof = embedded["@id"].split('/')[1]
-
-        label = "%s %s" % (typeof, embedded['accession'])
-        name = sanitize.name(label)
-        text = '\n'.join(get_hub(label, request.url, name))
+        text = render_hub_page(request, lambda: item_hub_txt(request, context))
     elif page == 'genomes' and suffix == 'txt':
-        assemblies = ''
-        if 'assembly' in embedded:
-            assemblies = embedded['assembly']
-
-        text = get_genomes_txt(assemblies)
+        text = render_hub_page(request, lambda: item_genomes_txt(request, context))
 
     elif (suffix == 'txt' and page == 'trackDb') or \
          (suffix == 'json' and page in ['trackDb','ihec','vis_blob']):
+        embedded = request.embed(request.resource_path(context))
         url_ret = (request.url).split('@@hub')
         url_end = url_ret[1][1:]
         text = generate_trackDb(request, embedded, url_end.split('/')[0])
@@ -1534,6 +1991,24 @@ def hub(context, request):
     return respond_with_text(request, text, content_mime)
 
 
+def item_hub_txt(request, context):
+    '''Returns the hub.txt of one dataset, which only needs its object frame.'''
+    properties = request.embed(request.resource_path(context), '@@object')
+    typeof = properties.get("assay_title")
+    if typeof is None:
+        typeof = properties["@id"].split('/')[1]
+
+    label = "%s %s" % (typeof, properties['accession'])
+    name = sanitize.name(label)
+    return '\n'.join(get_hub(label, request.url, name))
+
+
+def item_genomes_txt(request, context):
+    '''Returns the genomes.txt of one dataset, which only needs its object frame.'''
+    properties = request.embed(request.resource_path(context), '@@object')
+    return get_genomes_txt(properties.get('assembly', ''))
+
+
 @view_config(route_name='batch_hub')
 @view_config(route_name='batch_hub:trackdb')
 def batch_hub(context, request):